@@ -0,0 +1,89 @@
+"""Cached board list and detail responses, invalidated on every write.
+
+Each user's board list, and each of their boards, has a version token in
+the Django cache. Responses are cached under the current token, so a
+write only has to drop the tokens it affects; entries stored under the
+old one are never read again and simply expire. Tokens are random, so a
+token that was evicted or dropped can never come back and revive old
+entries.
+"""
+import hashlib
+import json
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils.http import parse_etags
+from rest_framework import status
+from rest_framework.response import Response
+
+LIST = "list"
+
+
+def board_scope(board_id):
+    """Cache scope of one board's detail response."""
+    return f"board:{board_id}"
+
+
+def _version_key(user_id, scope):
+    return f"boards:{user_id}:{scope}:version"
+
+
+def _version(user_id, scope):
+    key = _version_key(user_id, scope)
+    version = cache.get(key)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(key, version, settings.BOARD_CACHE_TIMEOUT):
+            # Another request created one first; use theirs
+            version = cache.get(key, version)
+    return version
+
+
+def invalidate(user_id, board_ids=()):
+    """Drop a user's cached board list and the given boards' details.
+
+    Runs once the current transaction commits, so a request cannot read
+    the old rows after the drop and cache them under the new version.
+    """
+    if user_id is None:
+        return
+    keys = [_version_key(user_id, LIST)]
+    keys += [_version_key(user_id, board_scope(board_id)) for board_id in board_ids]
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def cached_response(request, scope, build, variant=""):
+    """The response of ``build()``, from the cache when nothing changed.
+
+    ``variant`` tells apart responses in the same scope, such as the pages
+    of the board list. Only 200 responses are cached. Each carries an
+    ETag of its content; a request whose If-None-Match matches gets 304
+    Not Modified, answered from the cache without loading any boards.
+    """
+    user_id = request.user.id
+    key = f"boards:{user_id}:{scope}:{_version(user_id, scope)}:{variant}"
+    entry = cache.get(key)
+    if entry is None:
+        response = build()
+        if response.status_code != status.HTTP_200_OK:
+            return response
+        body = json.dumps(response.data, cls=DjangoJSONEncoder, sort_keys=True)
+        etag = f'"{hashlib.sha256(body.encode("utf-8")).hexdigest()[:32]}"'
+        headers = {
+            name: value
+            for name, value in response.items()
+            if name.lower() != "content-type"
+        }
+        entry = (etag, response.data, headers)
+        cache.set(key, entry, settings.BOARD_CACHE_TIMEOUT)
+
+    etag, data, headers = entry
+    # Per user, and revalidated on every use
+    headers = {**headers, "ETag": etag, "Cache-Control": "private, no-cache", "Vary": "Authorization"}
+    if_none_match = parse_etags(request.headers.get("If-None-Match", ""))
+    if etag in if_none_match or if_none_match == ["*"]:
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(data, headers=headers)
@@ -0,0 +1,31 @@
+# Generated by Django 5.0.3 on 2026-10-17 23:07
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("boards", "0003_board_owner_clusterjob_owner"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="board",
+            name="cluster_index",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="clusterjob",
+            name="parent",
+            field=models.ForeignKey(
+                blank=True,
+                help_text="For jobs that add images to an earlier job's clusters.",
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="additions",
+                to="boards.clusterjob",
+            ),
+        ),
+    ]
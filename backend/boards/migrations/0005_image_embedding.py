@@ -0,0 +1,22 @@
+# Generated by Django 5.0.3 on 2026-10-17 23:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("boards", "0004_board_cluster_index_clusterjob_parent"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="image",
+            name="embedding",
+            field=models.BinaryField(
+                blank=True,
+                help_text="L2-normalised float32 CLIP embedding, for similarity search.",
+                null=True,
+            ),
+        ),
+    ]
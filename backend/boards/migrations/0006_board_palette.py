@@ -0,0 +1,22 @@
+# Generated by Django 5.0.3 on 2026-10-17 23:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("boards", "0005_image_embedding"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="board",
+            name="palette",
+            field=models.JSONField(
+                blank=True,
+                default=list,
+                help_text='Dominant colours, most common first: [{"color": "#rrggbb", "share": 0.4}].',
+            ),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.0.3 on 2026-10-17 23:39
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("boards", "0006_board_palette"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="board",
+            index=models.Index(fields=["owner", "-created_at", "-id"], name="board_owner_created_idx"),
+        ),
+    ]
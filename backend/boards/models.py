@@ -11,6 +11,14 @@ class ClusterJob(models.Model):
     result = models.JSONField(null=True, blank=True)
     board_name = models.CharField(max_length=256, default="Untitled Board")
     boards_created = models.BooleanField(default=False)
+    parent = models.ForeignKey(
+        "self",
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name="additions",
+        help_text="For jobs that add images to an earlier job's clusters.",
+    )
     owner = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
@@ -52,10 +60,22 @@ class Board(models.Model):
         blank=True,
         related_name="boards",
     )
+    cluster_index = models.PositiveIntegerField(null=True, blank=True)
     tags = models.ManyToManyField(Tag, blank=True, related_name="boards")
+    palette = models.JSONField(
+        default=list,
+        blank=True,
+        help_text='Dominant colours, most common first: [{"color": "#rrggbb", "share": 0.4}].',
+    )
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # Board list pages: a user's boards, newest first
+            models.Index(fields=["owner", "-created_at", "-id"], name="board_owner_created_idx"),
+        ]
+
     def __str__(self):
         return self.name
 
@@ -69,6 +89,11 @@ class Image(models.Model):
         related_name="images",
     )
     url = models.URLField(max_length=1024)
+    embedding = models.BinaryField(
+        null=True,
+        blank=True,
+        help_text="L2-normalised float32 CLIP embedding, for similarity search.",
+    )
     uploaded_at = models.DateTimeField(default=timezone.now)
 
     def __str__(self):
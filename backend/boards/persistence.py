@@ -0,0 +1,127 @@
+"""Saving finished clustering jobs as boards."""
+from celery import states
+from django.db import transaction
+
+from .board_cache import invalidate
+from .models import Board, ClusterJob, Image, Tag
+from .vector_index import load_embeddings
+
+# Rows per INSERT statement when saving a job's images
+IMAGE_BATCH_SIZE = 1000
+
+
+def strip_embeddings(result):
+    """Return ``result`` without the per-image embeddings.
+
+    They are kept on the Image rows; in the stored result they would only
+    bloat every status poll.
+    """
+    if not isinstance(result, dict):
+        return result
+    return {
+        key: {k: v for k, v in data.items() if k != "embeddings"} if isinstance(data, dict) else data
+        for key, data in result.items()
+    }
+
+
+def save_job_result(job, result):
+    """Store a successful job's result and turn its clusters into boards.
+
+    Everything is written in one transaction with bulk inserts, so a job
+    takes the same handful of queries however many images it has. The
+    job is claimed first by switching its status to SUCCESS, so when the
+    worker's callback and a status poll race only one of them writes.
+    Returns False if the job had already been saved.
+    """
+    has_clusters = isinstance(result, dict) and "error" not in result
+    stored = strip_embeddings(result)
+    with transaction.atomic():
+        claimed = (
+            ClusterJob.objects.filter(pk=job.pk)
+            .exclude(status=states.SUCCESS)
+            .update(status=states.SUCCESS, result=stored, boards_created=has_clusters)
+        )
+        if not claimed:
+            return False
+        if has_clusters:
+            _create_boards(job, result)
+
+    job.status = states.SUCCESS
+    job.result = stored
+    job.boards_created = has_clusters
+    return True
+
+
+def _create_boards(job, clusters):
+    """Turn cluster results into Board + Image + Tag rows in bulk."""
+    clusters = {
+        int(cluster_id): data
+        for cluster_id, data in clusters.items()
+        if cluster_id != "meta"  # worker run statistics, not a cluster
+    }
+    if not clusters:
+        return
+
+    # Images added to an earlier job go onto that job's boards
+    board_job_id = job.parent_id or job.pk
+
+    boards = {}
+    if job.parent_id is not None:
+        boards = {
+            board.cluster_index: board
+            for board in Board.objects.filter(
+                cluster_job_id=board_job_id,
+                cluster_index__in=list(clusters),
+                owner_id=job.owner_id,
+            )
+        }
+
+    new_boards = [
+        Board(
+            name=f"{job.board_name} — Group {index + 1}",
+            cluster_job_id=board_job_id,
+            cluster_index=index,
+            owner_id=job.owner_id,
+            palette=clusters[index].get("palette", []),
+        )
+        for index in sorted(clusters)
+        if index not in boards
+    ]
+    Board.objects.bulk_create(new_boards)
+    boards.update((board.cluster_index, board) for board in new_boards)
+
+    # Only new boards take the worker's tags and palette; existing ones keep theirs
+    board_tags = {
+        board.id: {name.lower() for name in clusters[board.cluster_index].get("tags", [])}
+        for board in new_boards
+    }
+    tag_names = set().union(*board_tags.values())
+    if tag_names:
+        Tag.objects.bulk_create([Tag(name=name) for name in sorted(tag_names)], ignore_conflicts=True)
+        tag_ids = dict(Tag.objects.filter(name__in=tag_names).values_list("name", "id"))
+        BoardTag = Board.tags.through
+        BoardTag.objects.bulk_create(
+            [
+                BoardTag(board_id=board_id, tag_id=tag_ids[name])
+                for board_id, names in board_tags.items()
+                for name in sorted(names)
+            ],
+            ignore_conflicts=True,
+        )
+
+    images = []
+    states = {}
+    for index, data in clusters.items():
+        embeddings = data.get("embeddings")
+        vectors = load_embeddings(embeddings, states) if embeddings else None
+        images.extend(
+            Image(
+                board=boards[index],
+                url=url,
+                embedding=vectors[i].tobytes() if vectors is not None else None,
+            )
+            for i, url in enumerate(data.get("images", []))
+        )
+    Image.objects.bulk_create(images, batch_size=IMAGE_BATCH_SIZE)
+
+    invalidate(job.owner_id, [board.id for board in boards.values()])
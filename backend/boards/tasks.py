@@ -1,5 +1,9 @@
 from celery import shared_task
 
+from .models import ClusterJob
+from .persistence import save_job_result
+
+
 @shared_task(name="tasks.cluster_images")
 def cluster_images(image_urls, n_clusters):
     # TODO: your clustering logic here
@@ -9,3 +13,16 @@ def cluster_images(image_urls, n_clusters):
             "tags": ["example"]
         }
     }
+
+
+@shared_task(name="boards.persist_job")
+def persist_job(result, job_id):
+    """Save a finished job's boards; linked to the worker's clustering tasks.
+
+    Celery calls it with the worker task's return value as soon as the
+    task succeeds, so boards exist before the client's next poll.
+    """
+    job = ClusterJob.objects.filter(job_id=job_id).first()
+    if job is None:
+        return  # the job was deleted while it ran
+    save_job_result(job, result)
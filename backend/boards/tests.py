@@ -1,8 +1,20 @@
-from django.test import TestCase, override_settings
+import json
+import os
+import tempfile
+from unittest import mock
+
+import numpy as np
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import AsyncClient, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth.models import User
 from rest_framework.test import APIClient
 from rest_framework.authtoken.models import Token
+from . import vector_index
 from .models import ClusterJob, Board, Image, Tag
+from .tasks import persist_job
 
 
 DATABASES_OVERRIDE = {
@@ -92,6 +104,7 @@ class AuthAPITests(TestCase):
 @override_settings(DATABASES=DATABASES_OVERRIDE)
 class BoardAPITests(TestCase):
     def setUp(self):
+        cache.clear()
         self.user = User.objects.create_user(username="testuser", password="testpass")
         self.token = Token.objects.create(user=self.user)
         self.client = APIClient()
@@ -121,6 +134,58 @@ class BoardAPITests(TestCase):
         response = self.client.get("/api/boards/")
         self.assertEqual(len(response.data), 1)
 
+    def _pages(self, url):
+        """Follow a board list's Link headers; returns every page's names."""
+        pages = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            pages.append([board["name"] for board in response.data])
+            link = response.headers.get("Link")
+            url = link[1:link.index(">")] if link else None
+        return pages
+
+    def test_list_boards_pages_by_cursor(self):
+        created_at = self.board.created_at
+        # Equal timestamps are ordered by id, so none is skipped or repeated
+        for i in range(4):
+            Board.objects.create(name=f"Board {i}", owner=self.user, created_at=created_at)
+        Board.objects.create(name="Newest", owner=self.user)
+
+        pages = self._pages("/api/boards/?limit=2")
+        self.assertEqual(
+            pages,
+            [["Newest", "Board 3"], ["Board 2", "Board 1"], ["Board 0", "Test Board"]],
+        )
+
+    def test_list_boards_compact(self):
+        for i in range(6):
+            Image.objects.create(board=self.board, url=f"https://example.com/{i}.jpg")
+        response = self.client.get("/api/boards/?compact=1")
+        self.assertEqual(response.status_code, 200)
+        board = response.data[0]
+        self.assertNotIn("images", board)
+        self.assertEqual(board["image_count"], 7)
+        self.assertEqual(
+            [img["url"] for img in board["preview"]],
+            ["https://example.com/a.jpg"] + [f"https://example.com/{i}.jpg" for i in range(3)],
+        )
+        self.assertEqual(board["tags"], ["warm tones"])
+
+    def test_list_boards_selected_fields(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/api/boards/?fields=id,name")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, [{"id": self.board.id, "name": "Test Board"}])
+        # No images or tags are loaded when they are not asked for
+        self.assertFalse(any("boards_image" in q["sql"] for q in queries.captured_queries))
+        self.assertFalse(any("boards_tag" in q["sql"] for q in queries.captured_queries))
+
+    def test_list_boards_rejects_bad_parameters(self):
+        for query in ("limit=0", "limit=x", "fields=id,owner", "fields=", "cursor=not-a-cursor"):
+            response = self.client.get(f"/api/boards/?{query}")
+            self.assertEqual(response.status_code, 400, query)
+
     def test_get_board_detail(self):
         response = self.client.get(f"/api/boards/{self.board.id}/")
         self.assertEqual(response.status_code, 200)
@@ -156,6 +221,46 @@ class BoardAPITests(TestCase):
         self.assertEqual(response.status_code, 204)
         self.assertEqual(Board.objects.count(), 0)
 
+    def test_board_responses_cached_until_patched(self):
+        self.client.get("/api/boards/")
+        self.client.get(f"/api/boards/{self.board.id}/")
+        # Each request only looks up its token
+        with self.assertNumQueries(2):
+            self.assertEqual(self.client.get("/api/boards/").data[0]["name"], "Test Board")
+            self.assertEqual(self.client.get(f"/api/boards/{self.board.id}/").data["name"], "Test Board")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(f"/api/boards/{self.board.id}/", {"name": "Renamed"}, format="json")
+
+        self.assertEqual(self.client.get("/api/boards/").data[0]["name"], "Renamed")
+        self.assertEqual(self.client.get(f"/api/boards/{self.board.id}/").data["name"], "Renamed")
+
+    def test_board_detail_not_modified(self):
+        url = f"/api/boards/{self.board.id}/"
+        etag = self.client.get(url).headers["ETag"]
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers["ETag"], etag)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(url, {"tags": ["bold"]}, format="json")
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(url)
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertEqual(self.client.get("/api/boards/").data, [])
+
+    def test_saved_job_invalidates_board_list(self):
+        self.assertEqual(len(self.client.get("/api/boards/").data), 1)
+        ClusterJob.objects.create(job_id="job-1", board_name="Trip", owner=self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            persist_job({"0": {"images": ["https://example.com/b.jpg"], "tags": []}}, "job-1")
+        names = [board["name"] for board in self.client.get("/api/boards/").data]
+        self.assertEqual(names, ["Trip — Group 1", "Test Board"])
+
     def test_upload_no_files_returns_400(self):
         response = self.client.post("/api/upload/", {}, format="multipart")
         self.assertEqual(response.status_code, 400)
@@ -165,3 +270,389 @@ class BoardAPITests(TestCase):
             "/api/cluster/", {"image_urls": []}, format="json"
         )
         self.assertEqual(response.status_code, 400)
+
+    def test_cluster_auto_n_clusters(self):
+        with mock.patch("boards.views.current_app.send_task") as send_task:
+            response = self.client.post(
+                "/api/cluster/",
+                {"image_urls": ["https://example.com/a.jpg"], "n_clusters": "auto"},
+                format="json",
+            )
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(send_task.call_args.kwargs["args"][1], "auto")
+        job_id = response.data["job_id"]
+        self.assertEqual(send_task.call_args.kwargs["task_id"], job_id)
+        link = send_task.call_args.kwargs["link"]
+        self.assertEqual(link.task, "boards.persist_job")
+        self.assertEqual(link.args, (job_id,))
+        self.assertTrue(ClusterJob.objects.filter(job_id=job_id).exists())
+
+    def test_large_cluster_job_sends_manifest(self):
+        urls = [f"https://example.com/{i}.jpg" for i in range(3)]
+        with tempfile.TemporaryDirectory() as media_root, override_settings(
+            MEDIA_ROOT=media_root, CLUSTER_MANIFEST_THRESHOLD=2
+        ), mock.patch("boards.views.current_app.send_task") as send_task:
+            response = self.client.post(
+                "/api/cluster/", {"image_urls": urls, "n_clusters": 2}, format="json"
+            )
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(send_task.call_args.kwargs["args"], [[], 2])
+            manifest_url = send_task.call_args.kwargs["kwargs"]["manifest_url"]
+            self.assertTrue(manifest_url.startswith("http://testserver/media/manifests/"))
+            path = os.path.join(media_root, manifest_url.split("/media/", 1)[1])
+            with open(path) as f:
+                self.assertEqual(f.read().splitlines(), urls)
+
+    def test_cluster_invalid_n_clusters_returns_400(self):
+        response = self.client.post(
+            "/api/cluster/",
+            {"image_urls": ["https://example.com/a.jpg"], "n_clusters": "many"},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(DATABASES=DATABASES_OVERRIDE)
+class JobStatusAPITests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="testuser", password="testpass")
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {self.token.key}")
+        self.job = ClusterJob.objects.create(
+            job_id="job-1", board_name="Trip", owner=self.user
+        )
+
+    def _mock_result(self, result):
+        async_result = mock.Mock(status="SUCCESS", result=result)
+        async_result.ready.return_value = True
+        async_result.successful.return_value = True
+        return mock.patch("boards.views.AsyncResult", return_value=async_result)
+
+    def test_completed_job_creates_boards(self):
+        palette = [{"color": "#aa3311", "share": 0.7}, {"color": "#f0f0f0", "share": 0.3}]
+        result = {
+            "0": {"images": ["https://example.com/a.jpg"], "tags": ["Cozy"], "palette": palette},
+            "1": {"images": ["https://example.com/b.jpg"], "tags": []},
+            "meta": {"embedding_cache": {"hits": 1, "misses": 1}},
+        }
+        with self._mock_result(result):
+            response = self.client.get("/api/jobs/job-1/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["status"], "SUCCESS")
+        names = sorted(Board.objects.filter(owner=self.user).values_list("name", flat=True))
+        self.assertEqual(names, ["Trip — Group 1", "Trip — Group 2"])
+        self.assertEqual(Image.objects.count(), 2)
+        self.assertTrue(Tag.objects.filter(name="cozy").exists())
+        self.job.refresh_from_db()
+        self.assertTrue(self.job.boards_created)
+
+        boards = {board["name"]: board for board in self.client.get("/api/boards/").data}
+        self.assertEqual(boards["Trip — Group 1"]["palette"], palette)
+        self.assertEqual(boards["Trip — Group 2"]["palette"], [])
+
+    def test_completed_job_stores_embeddings(self):
+        # The worker's job state holds the vectors; the result only refers to its rows
+        vectors = np.array([[0.0, 1.0], [3.0, 4.0], [1.0, 0.0]], dtype=np.float32)
+        result = {
+            "0": {
+                "images": ["https://example.com/a.jpg", "https://example.com/b.jpg"],
+                "tags": [],
+                "embeddings": {"job_id": "job-1", "rows": [[1, 3]]},
+            },
+        }
+        with tempfile.TemporaryDirectory() as state_dir, self.settings(JOB_STATE_DIR=state_dir):
+            np.savez(os.path.join(state_dir, "job-1.npz"), embeddings=vectors)
+            with self._mock_result(result):
+                response = self.client.get("/api/jobs/job-1/")
+
+        self.assertNotIn("embeddings", response.data["result"]["0"])
+        image = Image.objects.get(url="https://example.com/a.jpg")
+        np.testing.assert_allclose(np.frombuffer(image.embedding, dtype=np.float32), [0.6, 0.8])
+        image = Image.objects.get(url="https://example.com/b.jpg")
+        np.testing.assert_allclose(np.frombuffer(image.embedding, dtype=np.float32), [1.0, 0.0])
+
+    def test_missing_job_state_saves_images_without_embeddings(self):
+        result = {
+            "0": {
+                "images": ["https://example.com/a.jpg"],
+                "tags": [],
+                "embeddings": {"job_id": "job-1", "rows": [[0, 1]]},
+            },
+        }
+        with tempfile.TemporaryDirectory() as state_dir, self.settings(JOB_STATE_DIR=state_dir):
+            with self._mock_result(result):
+                response = self.client.get("/api/jobs/job-1/")
+
+        self.assertEqual(response.data["status"], "SUCCESS")
+        self.assertIsNone(Image.objects.get(url="https://example.com/a.jpg").embedding)
+
+    def test_persist_job_saves_boards_in_bulk(self):
+        def result(n_images):
+            return {
+                str(i): {
+                    "images": [f"https://example.com/{i}-{j}.jpg" for j in range(n_images)],
+                    "tags": ["Cozy", "warm"],
+                }
+                for i in range(3)
+            }
+
+        with CaptureQueriesContext(connection) as small:
+            persist_job(result(2), "job-1")
+        ClusterJob.objects.create(job_id="job-big", board_name="Big", owner=self.user)
+        with CaptureQueriesContext(connection) as large:
+            persist_job(result(200), "job-big")
+
+        # SQLite caps the rows per INSERT, so a few more image batches at most
+        self.assertLessEqual(len(large), len(small) + 3)
+        self.assertEqual(Image.objects.count(), 606)
+        self.assertEqual(Board.objects.count(), 6)
+        self.assertEqual(Tag.objects.count(), 2)
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, "SUCCESS")
+        self.assertTrue(self.job.boards_created)
+
+        # A saved job is answered without asking the result backend
+        with mock.patch("boards.views.AsyncResult") as async_result:
+            response = self.client.get("/api/jobs/job-1/")
+        async_result.assert_not_called()
+        self.assertEqual(response.data["status"], "SUCCESS")
+        self.assertEqual(len(response.data["result"]), 3)
+
+        # Saving again, as a racing status poll would, writes nothing
+        persist_job(result(2), "job-1")
+        self.assertEqual(Image.objects.count(), 606)
+
+    def test_completed_addition_attaches_to_existing_boards(self):
+        self.job.status = "SUCCESS"
+        self.job.boards_created = True
+        self.job.save()
+        board = Board.objects.create(
+            name="Trip — Group 1",
+            cluster_job=self.job,
+            cluster_index=0,
+            owner=self.user,
+        )
+        ClusterJob.objects.create(
+            job_id="job-2", board_name="Trip", owner=self.user, parent=self.job
+        )
+        result = {
+            "0": {"images": ["https://example.com/c.jpg"], "tags": ["bold"], "new": False},
+            "3": {"images": ["https://example.com/d.jpg"], "tags": ["bold"], "new": True},
+        }
+        with self._mock_result(result):
+            response = self.client.get("/api/jobs/job-2/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            list(board.images.values_list("url", flat=True)),
+            ["https://example.com/c.jpg"],
+        )
+        self.assertFalse(board.tags.exists())
+        new_board = Board.objects.get(cluster_job=self.job, cluster_index=3)
+        self.assertEqual(new_board.name, "Trip — Group 4")
+        self.assertEqual(new_board.images.count(), 1)
+
+    def test_add_images_to_job(self):
+        self.job.status = "SUCCESS"
+        self.job.save()
+        with mock.patch("boards.views.current_app.send_task") as send_task:
+            response = self.client.post(
+                "/api/jobs/job-1/images/",
+                {"image_urls": ["https://example.com/e.jpg"]},
+                format="json",
+            )
+
+        self.assertEqual(response.status_code, 202)
+        job_id = response.data["job_id"]
+        send_task.assert_called_once_with(
+            "tasks.add_to_clusters",
+            args=["job-1", ["https://example.com/e.jpg"]],
+            task_id=job_id,
+            link=mock.ANY,
+        )
+        self.assertEqual(ClusterJob.objects.get(job_id=job_id).parent, self.job)
+
+    def test_add_images_to_unfinished_job_returns_409(self):
+        response = self.client.post(
+            "/api/jobs/job-1/images/",
+            {"image_urls": ["https://example.com/e.jpg"]},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 409)
+
+    def test_running_job_reports_progress(self):
+        progress = {"stage": "embedding", "total": 10, "downloaded": 4, "embedded": 2}
+        async_result = mock.Mock(status="PROGRESS", info=progress)
+        async_result.ready.return_value = False
+        with mock.patch("boards.views.AsyncResult", return_value=async_result):
+            response = self.client.get("/api/jobs/job-1/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["status"], "PROGRESS")
+        self.assertEqual(response.data["progress"], progress)
+        self.assertIsNone(response.data["result"])
+
+
+@override_settings(DATABASES=DATABASES_OVERRIDE, CELERY_RESULT_BACKEND="cache+memory://")
+class JobEventsAPITests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser", password="testpass")
+        self.token = Token.objects.create(user=self.user)
+        self.job = ClusterJob.objects.create(
+            job_id="job-1", board_name="Trip", owner=self.user
+        )
+
+    async def _events(self, url, **headers):
+        response = await AsyncClient().get(url, headers=headers)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        body = b"".join([chunk async for chunk in response.streaming_content]).decode()
+        return [
+            json.loads(event.split("data: ", 1)[1])
+            for event in body.split("\n\n")
+            if event.startswith("event: status")
+        ]
+
+    async def test_streams_progress_until_complete(self):
+        running = mock.Mock(status="PROGRESS", info={"stage": "embedding", "embedded": 3})
+        running.ready.return_value = False
+        done = mock.Mock(
+            status="SUCCESS",
+            result={"0": {"images": ["https://example.com/a.jpg"], "tags": []}},
+        )
+        done.ready.return_value = True
+        done.successful.return_value = True
+
+        with mock.patch(
+            "boards.views.AsyncResult", side_effect=[running, running, done]
+        ), mock.patch("boards.views.JOB_EVENTS_POLL_INTERVAL", 0):
+            events = await self._events(
+                "/api/jobs/job-1/events/", authorization=f"Token {self.token.key}"
+            )
+
+        # The unchanged second check sends nothing
+        self.assertEqual([event["status"] for event in events], ["PROGRESS", "SUCCESS"])
+        self.assertEqual([event["ready"] for event in events], [False, True])
+        self.assertEqual(events[0]["progress"]["embedded"], 3)
+        self.assertEqual(events[1]["result"]["0"]["images"], ["https://example.com/a.jpg"])
+        self.assertEqual(await Image.objects.acount(), 1)
+
+    async def test_finished_job_sends_one_event_with_query_token(self):
+        self.job.status = "SUCCESS"
+        self.job.result = {"0": {"images": [], "tags": []}}
+        await self.job.asave()
+
+        with mock.patch("boards.views.AsyncResult") as async_result:
+            events = await self._events(f"/api/jobs/job-1/events/?token={self.token.key}")
+
+        async_result.assert_not_called()
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]["status"], "SUCCESS")
+
+    async def test_revoked_job_ends_the_stream(self):
+        revoked = mock.Mock(status="REVOKED", result="revoked")
+        revoked.ready.return_value = True
+        revoked.successful.return_value = False
+
+        with mock.patch("boards.views.AsyncResult", return_value=revoked) as async_result:
+            events = await self._events(f"/api/jobs/job-1/events/?token={self.token.key}")
+
+        self.assertEqual([(event["status"], event["ready"]) for event in events], [("REVOKED", True)])
+        async_result.assert_called_once()
+
+    async def test_events_require_auth_and_ownership(self):
+        response = await AsyncClient().get("/api/jobs/job-1/events/")
+        self.assertEqual(response.status_code, 401)
+
+        other = await User.objects.acreate(username="other")
+        token = await Token.objects.acreate(user=other)
+        response = await AsyncClient().get(f"/api/jobs/job-1/events/?token={token.key}")
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(DATABASES=DATABASES_OVERRIDE)
+class SimilarImagesAPITests(TestCase):
+    def setUp(self):
+        vector_index._indexes.clear()
+        self.user = User.objects.create_user(username="testuser", password="testpass")
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {self.token.key}")
+        self.board = Board.objects.create(name="Board", owner=self.user)
+        self.other_board = Board.objects.create(name="Other", owner=self.user)
+
+    def _image(self, board, name, vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        return Image.objects.create(
+            board=board,
+            url=f"https://example.com/{name}.jpg",
+            embedding=(vector / np.linalg.norm(vector)).tobytes(),
+        )
+
+    def test_similar_images_across_boards(self):
+        query = self._image(self.board, "query", [1.0, 0.0])
+        close = self._image(self.other_board, "close", [0.9, 0.1])
+        far = self._image(self.board, "far", [0.0, 1.0])
+        stranger = User.objects.create_user(username="other", password="pass")
+        self._image(Board.objects.create(name="Theirs", owner=stranger), "theirs", [1.0, 0.0])
+
+        response = self.client.get(f"/api/images/{query.id}/similar/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([hit["id"] for hit in response.data], [close.id, far.id])
+        self.assertEqual(response.data[0]["board_name"], "Other")
+
+    def test_similar_images_sees_new_and_deleted_images(self):
+        query = self._image(self.board, "query", [1.0, 0.0])
+        self._image(self.board, "a", [0.0, 1.0])
+        self.client.get(f"/api/images/{query.id}/similar/")
+
+        added = self._image(self.other_board, "b", [1.0, 0.1])
+        response = self.client.get(f"/api/images/{query.id}/similar/?limit=1")
+        self.assertEqual([hit["id"] for hit in response.data], [added.id])
+
+        self.client.delete(f"/api/boards/{self.other_board.id}/")
+        response = self.client.get(f"/api/images/{query.id}/similar/?limit=1")
+        self.assertNotEqual([hit["id"] for hit in response.data], [added.id])
+
+    def test_index_loads_rows_committed_below_its_highest_id(self):
+        query = self._image(self.board, "query", [1.0, 0.0])
+        later = self._image(self.board, "later", [0.0, 1.0])
+        Image.objects.filter(id=later.id).update(id=query.id + 10)
+        self.assertEqual(vector_index.user_index(self.user).ids(), {query.id, query.id + 10})
+
+        # Committed by a transaction that took its id before the image above
+        late = Image.objects.create(
+            id=query.id + 5,
+            board=self.other_board,
+            url="https://example.com/late.jpg",
+            embedding=np.asarray([1.0, 0.0], dtype=np.float32).tobytes(),
+        )
+        # and one deleted by another process
+        Image.objects.filter(id=query.id + 10).delete()
+        self.assertEqual(vector_index.user_index(self.user).ids(), {query.id, late.id})
+
+    def test_image_without_embedding_returns_409(self):
+        image = Image.objects.create(board=self.board, url="https://example.com/x.jpg")
+        response = self.client.get(f"/api/images/{image.id}/similar/")
+        self.assertEqual(response.status_code, 409)
+
+    def test_invalid_limit_returns_400(self):
+        query = self._image(self.board, "query", [1.0, 0.0])
+        response = self.client.get(f"/api/images/{query.id}/similar/?limit=abc")
+        self.assertEqual(response.status_code, 400)
+
+    def test_partitioned_index_finds_nearest_neighbour(self):
+        rng = np.random.default_rng(0)
+        vectors = rng.normal(size=(500, 16)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        index = vector_index.VectorIndex()
+        with mock.patch.object(vector_index, "IVF_MIN_SIZE", 100):
+            index.add(range(1, 301), vectors[:300])
+            index.add(range(301, 501), vectors[300:])
+
+        self.assertIsNotNone(index._centroids)
+        for i in (0, 250, 499):
+            self.assertEqual(index.search(vectors[i], 1)[0][0], i + 1)
@@ -5,9 +5,12 @@ from .views import AnonymousTokenView
 from .views import (
     UploadView,
     ClusterView,
+    ClusterAddView,
     JobStatusView,
+    JobEventsView,
     BoardListView,
     BoardDetailView,
+    SimilarImagesView,
 )
 from .auth_views import RegisterView, LoginView
 
@@ -19,8 +22,11 @@ urlpatterns = [
     path("upload/", UploadView.as_view()),
     path("cluster/", ClusterView.as_view()),
     path("jobs/<str:job_id>/", JobStatusView.as_view()),
+    path("jobs/<str:job_id>/images/", ClusterAddView.as_view()),
+    path("jobs/<str:job_id>/events/", JobEventsView.as_view()),
     path("boards/", BoardListView.as_view()),
     path("boards/<int:board_id>/", BoardDetailView.as_view()),
+    path("images/<int:image_id>/similar/", SimilarImagesView.as_view()),
 
     path("auth/anonymous/", AnonymousTokenView.as_view()),
 ]
@@ -0,0 +1,269 @@
+"""In-process nearest-neighbour search over stored image embeddings."""
+import base64
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from django.conf import settings
+from django.db.models import Count, Sum
+
+from .models import Image
+
+# Indexes smaller than this are searched exhaustively, which is both exact
+# and faster than probing partitions at that size
+IVF_MIN_SIZE = 4096
+# Partitions scanned per query once an index is partitioned
+IVF_NPROBE = 8
+# Users whose indexes stay in memory in each server process
+MAX_CACHED_INDEXES = 64
+# Ids per query when loading the rows an index missed
+RECONCILE_BATCH_SIZE = 500
+
+_JOB_ID_RE = re.compile(r"^[A-Za-z0-9_-]+$")
+
+logger = logging.getLogger(__name__)
+
+
+def decode_embeddings(packed):
+    """Decode a worker's base64 float32 matrix into L2-normalised rows."""
+    data = base64.b64decode(packed["data"])
+    X = np.frombuffer(data, dtype=np.float32).reshape(packed["shape"])
+    return X / np.maximum(np.linalg.norm(X, axis=1, keepdims=True), 1e-12)
+
+
+def load_embeddings(ref, states):
+    """Load the rows a worker result refers to as L2-normalised vectors.
+
+    Workers keep each job's embeddings in its state in JOB_STATE_DIR and
+    only send the job id and ``[start, stop)`` row ranges. ``states``
+    caches the loaded matrices by job id while a result is saved; it
+    holds None for a state that is missing, whose images are then saved
+    without embeddings. Results of older workers carry the matrix itself.
+    """
+    if "data" in ref:
+        return decode_embeddings(ref)
+    job_id = ref["job_id"]
+    if job_id not in states:
+        states[job_id] = None
+        if _JOB_ID_RE.match(job_id):
+            path = os.path.join(settings.JOB_STATE_DIR, f"{job_id}.npz")
+            try:
+                with np.load(path) as state:
+                    states[job_id] = state["embeddings"]
+            except FileNotFoundError:
+                logger.warning("Job state %s not found; its images get no embeddings", path)
+    X = states[job_id]
+    if X is None:
+        return None
+    rows = np.concatenate([np.arange(start, stop) for start, stop in ref["rows"]] or [[]]).astype(int)
+    if len(rows) and rows.max() >= len(X):
+        logger.warning("Job state of %s has no row %d", job_id, rows.max())
+        return None
+    X = X[rows].astype(np.float32)
+    return X / np.maximum(np.linalg.norm(X, axis=1, keepdims=True), 1e-12)
+
+
+class VectorIndex:
+    """Cosine-similarity index over L2-normalised float32 vectors.
+
+    Small indexes are searched exactly. From IVF_MIN_SIZE vectors on it
+    becomes an inverted-file (IVF) index: vectors are bucketed under the
+    nearest of about sqrt(n) k-means centroids and a query only scans the
+    IVF_NPROBE buckets whose centroids are closest to it.
+
+    Inserts are incremental: new vectors join their nearest bucket, and
+    the centroids are retrained once the index has doubled in size since
+    they were last trained.
+    """
+
+    def __init__(self):
+        self.max_id = 0
+        # Sum of the ids the index returns, to compare with the database's
+        self.id_sum = 0
+        self._ids = np.empty(0, dtype=np.int64)
+        self._vectors = None
+        self._alive = np.empty(0, dtype=bool)
+        self._positions = {}
+        self._size = 0
+        self._centroids = None
+        self._lists = None
+        self._trained_size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._positions)
+
+    def ids(self):
+        """The set of ids the index currently returns."""
+        with self._lock:
+            return set(self._positions)
+
+    def add(self, ids, vectors):
+        """Insert vectors (rows already L2-normalised) under the given ids."""
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(ids):
+            return
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(ids), -1)
+
+        with self._lock:
+            # Concurrent top-ups can load the same rows twice
+            new = np.array([image_id not in self._positions for image_id in ids.tolist()])
+            ids, vectors = ids[new], vectors[new]
+            if not len(ids):
+                return
+
+            start = self._size
+            self._reserve(start + len(ids), vectors.shape[1])
+            self._ids[start:start + len(ids)] = ids
+            self._vectors[start:start + len(ids)] = vectors
+            self._alive[start:start + len(ids)] = True
+            self._positions.update(zip(ids.tolist(), range(start, start + len(ids))))
+            self._size += len(ids)
+            self.max_id = max(self.max_id, int(ids.max()))
+            self.id_sum += int(ids.sum())
+
+            if self._size >= IVF_MIN_SIZE and self._size >= 2 * self._trained_size:
+                self._train()
+            elif self._centroids is not None:
+                rows = np.arange(start, self._size)
+                buckets = np.argmax(vectors @ self._centroids.T, axis=1)
+                for bucket in np.unique(buckets):
+                    self._lists[bucket] = np.concatenate([self._lists[bucket], rows[buckets == bucket]])
+
+    def remove(self, ids):
+        """Stop returning the given ids (e.g. after their board was deleted)."""
+        with self._lock:
+            for image_id in ids:
+                position = self._positions.pop(image_id, None)
+                if position is not None:
+                    self._alive[position] = False
+                    self.id_sum -= int(image_id)
+
+    def search(self, vector, k, exclude=()):
+        """Return up to ``k`` ``(id, similarity)`` pairs, most similar first."""
+        with self._lock:
+            if not self._size:
+                return []
+            query = np.asarray(vector, dtype=np.float32)
+            query = query / max(np.linalg.norm(query), 1e-12)
+
+            if self._centroids is None:
+                rows = np.arange(self._size)
+            else:
+                nearest = np.argsort(-(self._centroids @ query))[:IVF_NPROBE]
+                rows = np.concatenate([self._lists[bucket] for bucket in nearest])
+
+            rows = rows[self._alive[rows]]
+            if exclude:
+                rows = rows[~np.isin(self._ids[rows], list(exclude))]
+            if not len(rows):
+                return []
+
+            scores = self._vectors[rows] @ query
+            k = min(k, len(rows))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top], kind="stable")]
+            return [(int(self._ids[rows[i]]), float(scores[i])) for i in top]
+
+    def _reserve(self, size, dim):
+        """Grow the backing arrays geometrically so inserts stay amortised O(1)."""
+        if self._vectors is not None and size <= len(self._vectors):
+            return
+        capacity = max(size, 2 * self._size, 256)
+        vectors = np.empty((capacity, dim), dtype=np.float32)
+        ids = np.empty(capacity, dtype=np.int64)
+        alive = np.zeros(capacity, dtype=bool)
+        if self._vectors is not None:
+            vectors[:self._size] = self._vectors[:self._size]
+            ids[:self._size] = self._ids[:self._size]
+            alive[:self._size] = self._alive[:self._size]
+        self._vectors, self._ids, self._alive = vectors, ids, alive
+
+    def _train(self, iterations=10, sample_size=20_000):
+        """Fit spherical k-means centroids and rebuild the inverted lists."""
+        X = self._vectors[:self._size]
+        n_lists = max(1, int(np.sqrt(self._size)))
+        rng = np.random.default_rng(0)
+        sample = X[rng.choice(self._size, min(sample_size, self._size), replace=False)]
+
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            order = np.argsort(assignment, kind="stable")
+            used, starts = np.unique(assignment[order], return_index=True)
+            sums = np.zeros_like(centroids)
+            sums[used] = np.add.reduceat(sample[order], starts)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # Empty clusters keep their previous centroid
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+
+        buckets = np.empty(self._size, dtype=np.int64)
+        for start in range(0, self._size, 8192):
+            buckets[start:start + 8192] = np.argmax(X[start:start + 8192] @ centroids.T, axis=1)
+        order = np.argsort(buckets, kind="stable")
+        bounds = np.searchsorted(buckets[order], np.arange(n_lists + 1))
+        self._lists = [order[bounds[i]:bounds[i + 1]] for i in range(n_lists)]
+        self._centroids = centroids
+        self._trained_size = self._size
+
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def user_index(user):
+    """Return ``user``'s index, topped up with any images stored since last use.
+
+    Each server process builds the index from the database on first use,
+    then loads rows with ids above the highest one it already has, so
+    images saved by any process show up on the next query. Ids are taken
+    when rows are inserted, not when they commit, so a transaction that
+    commits late can add rows below that mark, and another process may
+    have deleted rows. When the count or sum of the stored ids then
+    differs from the index's, the two are reconciled.
+    """
+    with _indexes_lock:
+        index = _indexes.get(user.id)
+        if index is None:
+            index = _indexes[user.id] = VectorIndex()
+        _indexes.move_to_end(user.id)
+        while len(_indexes) > MAX_CACHED_INDEXES:
+            _indexes.popitem(last=False)
+
+    stored = Image.objects.filter(board__owner=user, embedding__isnull=False)
+    _load(index, stored.filter(id__gt=index.max_id))
+    totals = stored.aggregate(count=Count("id"), id_sum=Sum("id"))
+    if (totals["count"], totals["id_sum"] or 0) != (len(index), index.id_sum):
+        _reconcile(index, stored)
+    return index
+
+
+def _load(index, images):
+    rows = list(images.order_by("id").values_list("id", "embedding"))
+    if rows:
+        index.add(
+            [image_id for image_id, _ in rows],
+            np.vstack([np.frombuffer(embedding, dtype=np.float32) for _, embedding in rows]),
+        )
+
+
+def _reconcile(index, stored):
+    """Load the stored rows ``index`` lacks and drop those no longer stored."""
+    stored_ids = set(stored.values_list("id", flat=True))
+    held = index.ids()
+    index.remove(held - stored_ids)
+    missing = sorted(stored_ids - held)
+    for start in range(0, len(missing), RECONCILE_BATCH_SIZE):
+        _load(index, stored.filter(id__in=missing[start:start + RECONCILE_BATCH_SIZE]))
+
+
+def forget_images(user, image_ids):
+    """Drop deleted images from ``user``'s index in this process, if loaded."""
+    with _indexes_lock:
+        index = _indexes.get(user.id)
+    if index is not None:
+        index.remove(image_ids)
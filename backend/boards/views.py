@@ -1,11 +1,30 @@
+import asyncio
+import base64
+import hashlib
+import json
 import logging
+import time
+import uuid
+from contextlib import asynccontextmanager
 
+import numpy as np
+import redis.asyncio
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files.base import ContentFile
 from django.core.files.storage import default_storage
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count, Prefetch, Q
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils.dateparse import parse_datetime
+from django.views import View
 
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.authentication import TokenAuthentication
+from rest_framework.exceptions import AuthenticationFailed
 from rest_framework.permissions import IsAuthenticated
 
 from django.contrib.auth.models import User
@@ -13,13 +32,64 @@ from rest_framework.authtoken.models import Token
 from rest_framework.permissions import AllowAny
 
 
-from celery import current_app
+from celery import current_app, states
 from celery.result import AsyncResult
 
+from .board_cache import LIST, board_scope, cached_response, invalidate
 from .models import ClusterJob, Board, Image, Tag
+from .persistence import save_job_result
+from .vector_index import forget_images, user_index
 
 logger = logging.getLogger(__name__)
 
+# Seconds between status checks of a streamed job when the result backend
+# cannot notify us of updates (anything but Redis)
+JOB_EVENTS_POLL_INTERVAL = 1.0
+# Seconds of silence after which a job event stream sends a keep-alive
+# comment, so proxies do not close the idle connection
+JOB_EVENTS_KEEPALIVE = 15.0
+
+# Boards per page of the board list, unless ?limit= asks for up to BOARD_PAGE_MAX
+BOARD_PAGE_SIZE = 50
+BOARD_PAGE_MAX = 200
+# Images a compact board listing shows as its preview
+BOARD_PREVIEW_IMAGES = 4
+
+# Fields of a board in the board list, by their ?fields= name
+BOARD_FIELDS = {
+    "id": lambda board: board.id,
+    "name": lambda board: board.name,
+    "created_at": lambda board: board.created_at.isoformat(),
+    "images": lambda board: [{"id": img.id, "url": img.url} for img in board.images.all()],
+    "image_count": lambda board: board.image_count,
+    "preview": lambda board: [{"id": img.id, "url": img.url} for img in board.preview_images],
+    "tags": lambda board: [tag.name for tag in board.tags.all()],
+    "palette": lambda board: board.palette,
+}
+BOARD_DEFAULT_FIELDS = ["id", "name", "created_at", "images", "tags", "palette"]
+# ?compact=1: a count and a few previews instead of every image
+BOARD_COMPACT_FIELDS = ["id", "name", "created_at", "image_count", "preview", "tags", "palette"]
+
+
+def _send_job(task_name, args, job, **kwargs):
+    """Create ``job`` and queue its worker task under the job's id.
+
+    The job row exists before the task is sent, and the task is linked to
+    boards.persist_job, which saves the result as boards once it succeeds.
+    """
+    job.job_id = str(uuid.uuid4())
+    job.save()
+    current_app.send_task(
+        task_name,
+        args=args,
+        task_id=job.job_id,
+        link=current_app.signature(
+            "boards.persist_job", args=[job.job_id], queue=settings.PERSIST_QUEUE
+        ),
+        **kwargs,
+    )
+    return job
+
 
 class UploadView(APIView):
     """Upload images to storage (S3 via django-storages) and return URLs."""
@@ -68,32 +138,130 @@ class ClusterView(APIView):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        if not isinstance(n, int) or n < 1:
+        if n != "auto" and (not isinstance(n, int) or isinstance(n, bool) or n < 1):
             return Response(
-                {"error": "n_clusters must be a positive integer."},
+                {"error": "n_clusters must be a positive integer or \"auto\"."},
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        task = current_app.send_task(
+        task_kwargs = {}
+        if len(urls) > settings.CLUSTER_MANIFEST_THRESHOLD:
+            # Pass large URL lists by reference to keep the task message small
+            task_kwargs["manifest_url"] = self._store_manifest(request, urls)
+            urls = []
+
+        job = _send_job(
             "tasks.cluster_images",
-            args=[urls, n],
+            [urls, n],
+            ClusterJob(status="PENDING", board_name=board_name, owner=request.user),
+            kwargs=task_kwargs,
         )
 
-        ClusterJob.objects.create(
-            job_id=task.id,
-            status="PENDING",
-            board_name=board_name,
-            owner=request.user,
+        return Response(
+            {"job_id": job.job_id, "board_name": board_name},
+            status=status.HTTP_202_ACCEPTED,
+        )
+
+    def _store_manifest(self, request, urls):
+        """Save the URL list to storage, one per line, and return its URL."""
+        filename = default_storage.save(
+            f"manifests/{uuid.uuid4().hex}.txt",
+            ContentFile("\n".join(urls).encode("utf-8")),
+        )
+        url = default_storage.url(filename)
+        if url.startswith("/"):
+            url = request.build_absolute_uri(url)
+        return url
+
+
+class ClusterAddView(APIView):
+    """Add images to a completed clustering job without re-clustering it."""
+
+    authentication_classes = [TokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, job_id):
+        try:
+            job = ClusterJob.objects.get(job_id=job_id, owner=request.user)
+        except ClusterJob.DoesNotExist:
+            return Response(
+                {"error": "Job not found"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+
+        # The worker keeps clusters under the job that first created them
+        root = job.parent or job
+        if root.status != "SUCCESS":
+            return Response(
+                {"error": "Job has not completed successfully."},
+                status=status.HTTP_409_CONFLICT,
+            )
+
+        urls = request.data.get("image_urls")
+        if not isinstance(urls, list) or len(urls) == 0:
+            return Response(
+                {"error": "image_urls must be a non-empty list."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        job = _send_job(
+            "tasks.add_to_clusters",
+            [root.job_id, urls],
+            ClusterJob(
+                status="PENDING",
+                board_name=root.board_name,
+                owner=request.user,
+                parent=root,
+            ),
         )
 
         return Response(
-            {"job_id": task.id, "board_name": board_name},
+            {"job_id": job.job_id, "parent_job_id": root.job_id},
             status=status.HTTP_202_ACCEPTED,
         )
 
 
+def _job_status(job):
+    """The job's current status payload, as JobStatusView returns it.
+
+    Finished jobs are answered from the database: boards.persist_job saves
+    the result and its boards as soon as the worker task succeeds. Until
+    then the result backend is asked, without writing anything, and a
+    successful result that was not saved yet (no backend worker running)
+    is saved here instead.
+    """
+    progress = None
+    if job.status not in states.READY_STATES:
+        result = AsyncResult(job.job_id, app=current_app)
+        if not result.ready():
+            job.status = result.status
+            if result.status == "PROGRESS":
+                progress = result.info
+        elif result.successful():
+            if not save_job_result(job, result.result):
+                job.refresh_from_db()
+        else:
+            job.status = result.status
+            job.result = str(result.result)
+            job.save(update_fields=["status", "result", "updated_at"])
+
+    return {
+        "job_id": job.job_id,
+        "status": job.status,
+        # Whether the status is final (SUCCESS, FAILURE, REVOKED, ...)
+        "ready": job.status in states.READY_STATES,
+        "result": job.result,
+        "progress": progress,
+    }
+
+
 class JobStatusView(APIView):
-    """Poll a clustering job and persist moodboards when complete."""
+    """Poll a clustering job.
+
+    While the worker is running, ``progress`` carries its latest report:
+    current stage, images downloaded/embedded/failed, throughput and ETA.
+    JobEventsView pushes the same payloads instead of being polled.
+    """
 
     authentication_classes = [TokenAuthentication]
     permission_classes = [IsAuthenticated]
@@ -107,86 +275,219 @@ class JobStatusView(APIView):
                 status=status.HTTP_404_NOT_FOUND,
             )
 
-        result = AsyncResult(job_id, app=current_app)
-        job.status = result.status
+        return Response(_job_status(job))
 
-        if result.ready():
-            try:
-                job.result = result.result
-            except Exception:
-                logger.exception("Failed to read result for job %s", job_id)
-                job.result = str(result.result)
 
-            if result.successful() and not job.boards_created:
-                self._create_boards(job, request.user)
+@asynccontextmanager
+async def _result_updates(job_id):
+    """Yield ``wait(timeout)``, returning once the job's result may have changed.
 
-        job.save()
+    The Redis result backend publishes every state the worker stores
+    (progress included) on the task's key, so with Redis this subscribes
+    to that channel; other backends are re-checked every
+    JOB_EVENTS_POLL_INTERVAL seconds.
+    """
+    if not settings.CELERY_RESULT_BACKEND.startswith(("redis://", "rediss://")):
+        async def wait(timeout):
+            await asyncio.sleep(min(timeout, JOB_EVENTS_POLL_INTERVAL))
 
-        return Response({
-            "job_id": job.job_id,
-            "status": job.status,
-            "result": job.result,
-        })
+        yield wait
+        return
 
+    client = redis.asyncio.from_url(settings.CELERY_RESULT_BACKEND)
+    pubsub = client.pubsub()
+    try:
+        await pubsub.subscribe(current_app.backend.get_key_for_task(job_id))
 
-    def _create_boards(self, job, user):
-        """Turn cluster results into Board + Image + Tag objects."""
-        clusters = job.result
+        async def wait(timeout):
+            await pubsub.get_message(ignore_subscribe_messages=True, timeout=timeout)
 
-        if not isinstance(clusters, dict) or "error" in clusters:
-            return
+        yield wait
+    finally:
+        await pubsub.aclose()
+        await client.aclose()
 
-        for cluster_id, data in clusters.items():
-            image_urls = data.get("images", [])
-            tags = data.get("tags", [])
 
-            board = Board.objects.create(
-                name=f"{job.board_name} — Group {int(cluster_id) + 1}",
-                cluster_job=job,
-                owner=user,
-            )
+class JobEventsView(View):
+    """Stream a job's status as Server-Sent Events until it finishes.
 
-            for url in image_urls:
-                Image.objects.create(board=board, url=url)
+    Each ``status`` event carries the JobStatusView payload and is sent
+    on connect and whenever it changes; the stream ends after the first
+    event whose ``ready`` is true, whichever final status it has. Browsers' EventSource cannot set headers, so
+    the token may also be passed as ``?token=``. Serve the project through
+    ASGI (visionboard_backend.asgi), where an open stream holds no thread.
+    """
 
-            for tag_name in tags:
-                tag, _ = Tag.objects.get_or_create(name=tag_name.lower())
-                board.tags.add(tag)
+    async def get(self, request, job_id):
+        user = await sync_to_async(self._authenticate)(request)
+        if user is None:
+            response = JsonResponse(
+                {"detail": "Authentication credentials were not provided."},
+                status=status.HTTP_401_UNAUTHORIZED,
+            )
+            response["WWW-Authenticate"] = "Token"
+            return response
 
-        job.boards_created = True
+        job = await ClusterJob.objects.filter(job_id=job_id, owner=user).afirst()
+        if job is None:
+            return JsonResponse(
+                {"error": "Job not found"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+
+        response = StreamingHttpResponse(
+            self._events(job), content_type="text/event-stream"
+        )
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"  # let nginx pass events through as sent
+        return response
+
+    def _authenticate(self, request):
+        header = request.headers.get("Authorization", "").split()
+        if len(header) == 2 and header[0] == "Token":
+            key = header[1]
+        else:
+            key = request.GET.get("token")
+        if not key:
+            return None
+        try:
+            user, _ = TokenAuthentication().authenticate_credentials(key)
+        except AuthenticationFailed:
+            return None
+        return user
+
+    async def _events(self, job):
+        # Subscribe before the first check, so no update falls in between
+        async with _result_updates(job.job_id) as wait:
+            last, last_sent = None, time.monotonic()
+            while True:
+                payload = await sync_to_async(_job_status)(job)
+                if payload != last:
+                    last, last_sent = payload, time.monotonic()
+                    yield f"event: status\ndata: {json.dumps(payload, cls=DjangoJSONEncoder)}\n\n"
+                elif time.monotonic() - last_sent >= JOB_EVENTS_KEEPALIVE:
+                    last_sent = time.monotonic()
+                    yield ": keep-alive\n\n"
+                if payload["ready"]:
+                    return
+                await wait(JOB_EVENTS_KEEPALIVE)
+
+
+def _encode_cursor(board):
+    """An opaque board-list cursor pointing just past ``board``."""
+    raw = json.dumps([board.created_at.isoformat(), board.id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor):
+    """The ``(created_at, id)`` a cursor points past; ValueError if it is malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, board_id = json.loads(raw)
+        created_at = parse_datetime(created_at)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid cursor {cursor!r}")
+    if created_at is None or not isinstance(board_id, int):
+        raise ValueError(f"Invalid cursor {cursor!r}")
+    return created_at, board_id
 
 
 class BoardListView(APIView):
-    """List the current user's moodboards."""
+    """List the current user's moodboards, newest first, one page at a time.
+
+    Pages are keyset-paginated on ``(created_at, id)``: the cursor names
+    the last board returned, and the next page starts right after it, so
+    every page costs one index range scan however many boards come
+    before it. The next page's URL is sent in a ``Link: rel="next"``
+    header. Only the related rows the selected fields need are loaded.
+    Pages are cached per user until one of their boards changes.
+    """
 
     authentication_classes = [TokenAuthentication]
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        boards = (
-            Board.objects.filter(owner=request.user)
-            .prefetch_related("images", "tags")
-            .order_by("-created_at")
-        )
+        # The Link header holds an absolute URL, so the host is part of the key
+        query = sorted(request.query_params.lists())
+        variant = hashlib.sha256(
+            json.dumps([request.get_host(), query]).encode("utf-8")
+        ).hexdigest()
+        return cached_response(request, LIST, lambda: self._page(request), variant=variant)
+
+    def _page(self, request):
+        params = request.query_params
+        try:
+            limit = int(params.get("limit", BOARD_PAGE_SIZE))
+        except ValueError:
+            limit = 0
+        if not 1 <= limit <= BOARD_PAGE_MAX:
+            return Response(
+                {"error": f"limit must be an integer from 1 to {BOARD_PAGE_MAX}."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
 
-        data = []
-        for board in boards:
-            data.append({
-                "id": board.id,
-                "name": board.name,
-                "created_at": board.created_at.isoformat(),
-                "images": [
-                    {"id": img.id, "url": img.url}
-                    for img in board.images.all()
-                ],
-                "tags": [tag.name for tag in board.tags.all()],
-            })
+        if "fields" in params:
+            fields = list(dict.fromkeys(
+                name.strip() for name in params["fields"].split(",") if name.strip()
+            ))
+            unknown = [name for name in fields if name not in BOARD_FIELDS]
+            if unknown or not fields:
+                return Response(
+                    {"error": f"fields must be a comma-separated list of: {', '.join(BOARD_FIELDS)}."},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+        elif params.get("compact", "").lower() in ("1", "true"):
+            fields = BOARD_COMPACT_FIELDS
+        else:
+            fields = BOARD_DEFAULT_FIELDS
+
+        boards = Board.objects.filter(owner=request.user)
+        if params.get("cursor"):
+            try:
+                created_at, board_id = _decode_cursor(params["cursor"])
+            except ValueError:
+                return Response(
+                    {"error": "Invalid cursor."},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            boards = boards.filter(
+                Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=board_id)
+            )
 
-        return Response(data)
+        boards = boards.only(
+            "id", "created_at", *(name for name in ("name", "palette") if name in fields)
+        )
+        images = Image.objects.only("id", "url", "board").order_by("id")
+        if "images" in fields:
+            boards = boards.prefetch_related(Prefetch("images", queryset=images))
+        if "preview" in fields:
+            boards = boards.prefetch_related(Prefetch(
+                "images", queryset=images[:BOARD_PREVIEW_IMAGES], to_attr="preview_images",
+            ))
+        if "tags" in fields:
+            boards = boards.prefetch_related("tags")
+        if "image_count" in fields:
+            boards = boards.annotate(image_count=Count("images"))
+
+        # One extra row tells whether there is a next page
+        page = list(boards.order_by("-created_at", "-id")[:limit + 1])
+        headers = {}
+        if len(page) > limit:
+            page = page[:limit]
+            query = params.copy()
+            query["cursor"] = _encode_cursor(page[-1])
+            next_url = request.build_absolute_uri(f"{request.path}?{query.urlencode()}")
+            headers["Link"] = f'<{next_url}>; rel="next"'
+
+        data = [{name: BOARD_FIELDS[name](board) for name in fields} for board in page]
+        return Response(data, headers=headers)
 
 
 class BoardDetailView(APIView):
-    """Get, update, or delete a single moodboard owned by the user."""
+    """Get, update, or delete a single moodboard owned by the user.
+
+    Details are cached per user until the board changes.
+    """
 
     authentication_classes = [TokenAuthentication]
     permission_classes = [IsAuthenticated]
@@ -201,6 +502,11 @@ class BoardDetailView(APIView):
             return None
 
     def get(self, request, board_id):
+        return cached_response(
+            request, board_scope(board_id), lambda: self._detail(request, board_id)
+        )
+
+    def _detail(self, request, board_id):
         board = self._get_board(request.user, board_id)
         if not board:
             return Response(
@@ -217,6 +523,7 @@ class BoardDetailView(APIView):
                 for img in board.images.all()
             ],
             "tags": [tag.name for tag in board.tags.all()],
+            "palette": board.palette,
         })
 
     def patch(self, request, board_id):
@@ -237,6 +544,7 @@ class BoardDetailView(APIView):
                 board.tags.add(tag)
 
         board.save()
+        invalidate(request.user.id, [board.id])
         return Response({"id": board.id, "name": board.name})
 
     def delete(self, request, board_id):
@@ -247,9 +555,71 @@ class BoardDetailView(APIView):
                 status=status.HTTP_404_NOT_FOUND,
             )
 
+        image_ids = [img.id for img in board.images.all()]
         board.delete()
+        invalidate(request.user.id, [board_id])
+        forget_images(request.user, image_ids)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+
+class SimilarImagesView(APIView):
+    """Find the user's images that look most like a given image."""
+
+    authentication_classes = [TokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, image_id):
+        try:
+            image = Image.objects.get(id=image_id, board__owner=request.user)
+        except Image.DoesNotExist:
+            return Response(
+                {"error": "Image not found"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+
+        if image.embedding is None:
+            return Response(
+                {"error": "Image has no stored embedding."},
+                status=status.HTTP_409_CONFLICT,
+            )
+
+        try:
+            limit = int(request.query_params.get("limit", 10))
+        except ValueError:
+            limit = 0
+        if not 1 <= limit <= 100:
+            return Response(
+                {"error": "limit must be an integer from 1 to 100."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        # Ask for a few extra in case another process deleted some of them
+        hits = user_index(request.user).search(
+            np.frombuffer(image.embedding, dtype=np.float32),
+            limit + 10,
+            exclude={image.id},
+        )
+        images = Image.objects.select_related("board").in_bulk(
+            [image_id for image_id, _ in hits]
+        )
+
+        data = []
+        for hit_id, score in hits:
+            hit = images.get(hit_id)
+            if hit is None or hit.board.owner_id != request.user.id:
+                continue
+            data.append({
+                "id": hit.id,
+                "url": hit.url,
+                "board_id": hit.board_id,
+                "board_name": hit.board.name,
+                "similarity": round(score, 4),
+            })
+            if len(data) == limit:
+                break
+
+        return Response(data)
+
 class AnonymousTokenView(APIView):
     """
     Issue a token for an anonymous demo user.
@@ -2,6 +2,8 @@
 ASGI config for visionboard_backend project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+This is how the backend is served, so job event streams (boards.views.JobEventsView)
+wait on the result backend without holding a thread each.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 
 from pathlib import Path
 import os
+import tempfile
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -131,11 +132,42 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 CELERY_BROKER_URL = os.environ.get("CELERY_BROKER_URL", "redis://localhost:6379/0")
 CELERY_RESULT_BACKEND = os.environ.get("CELERY_RESULT_BACKEND", "redis://localhost:6379/0")
 
+# Queue of the backend's own Celery worker, which saves finished jobs' boards
+PERSIST_QUEUE = os.environ.get("PERSIST_QUEUE", "boards")
+
+# Cache of board list and detail responses: Redis when CACHE_URL is set,
+# otherwise memory of each process, which a write in another process (such
+# as the backend worker saving a job) cannot invalidate
+CACHE_URL = os.environ.get("CACHE_URL", "")
+CACHES = {
+    "default": (
+        {"BACKEND": "django.core.cache.backends.redis.RedisCache", "LOCATION": CACHE_URL}
+        if CACHE_URL
+        else {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+    ),
+}
+# Seconds a cached board response is kept; bounds how stale a per-process
+# cache can get
+BOARD_CACHE_TIMEOUT = int(os.environ.get("BOARD_CACHE_TIMEOUT", "300"))
+
+# The worker's job states, which hold the embeddings its results refer to;
+# must be the worker's JOB_STATE_DIR, mounted read-only is enough
+JOB_STATE_DIR = os.environ.get(
+    "JOB_STATE_DIR",
+    os.path.join(tempfile.gettempdir(), "visionboard", "jobs"),
+)
+
+# Clustering jobs with more image URLs than this send them to the worker as a
+# stored manifest file instead of inline in the task message
+CLUSTER_MANIFEST_THRESHOLD = int(os.environ.get("CLUSTER_MANIFEST_THRESHOLD", "200"))
+
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:4200",
     "http://127.0.0.1:4200",
     "http://frontend:4200"
 ]
+# The board list sends the next page's URL in a Link header
+CORS_EXPOSE_HEADERS = ["Link"]
 
 AWS_ACCESS_KEY_ID = os.environ.get("AWS_ACCESS_KEY_ID")
 AWS_SECRET_ACCESS_KEY = os.environ.get("AWS_SECRET_ACCESS_KEY")
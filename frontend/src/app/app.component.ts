@@ -106,6 +106,7 @@ export class AppComponent implements OnInit, OnDestroy {
 
           const result: ClusterResult = {};
           for (const [id, data] of Object.entries<any>(job.result)) {
+            if (id === 'meta') continue; // worker run statistics, not a cluster
             result[id] = {
               images: data.images || [],
               tags: data.tags || [],
@@ -116,7 +117,8 @@ export class AppComponent implements OnInit, OnDestroy {
           this.showBoard = true;
           console.log('showBoard set to true, detecting changes');
           this.cdr.detectChanges();
-        } else if (job.status === 'FAILURE') {
+        } else if (job.ready) {
+          // FAILURE, REVOKED or any other final state
           this.clearPoll();
           this.uploading = false;
           this.error = 'Clustering failed. Please try again.';
@@ -1,7 +1,8 @@
 import { Injectable } from '@angular/core';
-import { HttpClient, HttpHeaders } from '@angular/common/http';
-import { Observable, firstValueFrom } from 'rxjs';
+import { HttpClient, HttpHeaders, HttpParams } from '@angular/common/http';
+import { Observable, firstValueFrom, map } from 'rxjs';
 import { environment } from '../../environments/environment';
+import { JobStatusResponse } from './api.types';
 
 export interface ImageData {
   id: number;
@@ -12,8 +13,36 @@ export interface BoardData {
   id: number;
   name: string;
   created_at: string;
-  images: { id: number; url: string }[];
+  images?: { id: number; url: string }[];
+  image_count?: number;
+  preview?: { id: number; url: string }[];
   tags: string[];
+  palette: PaletteColor[];
+}
+
+export interface BoardPage {
+  boards: BoardData[];
+  // URL of the next page, from the Link header; null on the last page
+  next: string | null;
+}
+
+export interface BoardListOptions {
+  limit?: number;
+  compact?: boolean;
+  fields?: (keyof BoardData)[];
+}
+
+export interface PaletteColor {
+  color: string;
+  share: number;
+}
+
+export interface SimilarImage {
+  id: number;
+  url: string;
+  board_id: number;
+  board_name: string;
+  similarity: number;
 }
 
 @Injectable({ providedIn: 'root' })
@@ -76,16 +105,69 @@ export class ApiService {
     );
   }
 
-  jobStatus(jobId: string): Observable<{ status: string; result?: any }> {
-    return this.http.get<{ status: string; result?: any }>(
+  jobStatus(jobId: string): Observable<JobStatusResponse> {
+    return this.http.get<JobStatusResponse>(
       `${this.base}/jobs/${jobId}/`,
       this.authHeaders()
     );
   }
 
-  getBoards(): Observable<BoardData[]> {
-    return this.http.get<BoardData[]>(
-      `${this.base}/boards/`,
+  /**
+   * Status updates pushed by the server until the job finishes. Completes
+   * after a `SUCCESS` update and errors after any other final one
+   * (`FAILURE`, `REVOKED`, ...).
+   */
+  jobEvents(jobId: string): Observable<JobStatusResponse> {
+    const url = `${this.base}/jobs/${jobId}/events/?token=${encodeURIComponent(this.token ?? '')}`;
+
+    return new Observable<JobStatusResponse>(subscriber => {
+      const source = new EventSource(url);
+      source.addEventListener('status', event => {
+        const update: JobStatusResponse = JSON.parse((event as MessageEvent).data);
+        subscriber.next(update);
+        if (update.ready) {
+          source.close();
+          if (update.status === 'SUCCESS') {
+            subscriber.complete();
+          } else {
+            subscriber.error(new Error(`Job ${update.status.toLowerCase()}`));
+          }
+        }
+      });
+      source.onerror = () => {
+        // EventSource reconnects by itself; give up only once it has closed
+        if (source.readyState === EventSource.CLOSED) {
+          subscriber.error(new Error('Job event stream closed'));
+        }
+      };
+      return () => source.close();
+    });
+  }
+
+  getBoards(options: BoardListOptions = {}, pageUrl?: string): Observable<BoardPage> {
+    let params = new HttpParams();
+    if (!pageUrl) {
+      if (options.limit) params = params.set('limit', options.limit);
+      if (options.compact) params = params.set('compact', '1');
+      if (options.fields) params = params.set('fields', options.fields.join(','));
+    }
+    return this.http
+      .get<BoardData[]>(pageUrl ?? `${this.base}/boards/`, {
+        ...this.authHeaders(),
+        params,
+        observe: 'response',
+      })
+      .pipe(
+        map((response) => ({
+          boards: response.body ?? [],
+          next: response.headers.get('Link')?.match(/<([^>]+)>;\s*rel="next"/)?.[1] ?? null,
+        }))
+      );
+  }
+
+  similarImages(imageId: number, limit = 10): Observable<SimilarImage[]> {
+    return this.http.get<SimilarImage[]>(
+      `${this.base}/images/${imageId}/similar/?limit=${limit}`,
       this.authHeaders()
     );
   }
@@ -7,8 +7,22 @@ export interface ClusterResponse {
   board_name: string;
 }
 
+export interface JobProgress {
+  stage: string;
+  total: number;
+  downloaded: number;
+  embedded: number;
+  failed: number;
+  elapsed_seconds: number;
+  images_per_second: number;
+  eta_seconds: number | null;
+}
+
 export interface JobStatusResponse {
   job_id: string;
-  status: 'PENDING' | 'STARTED' | 'SUCCESS' | 'FAILURE';
+  status: 'PENDING' | 'STARTED' | 'RETRY' | 'PROGRESS' | 'SUCCESS' | 'FAILURE' | 'REVOKED';
+  /** True once `status` is final, whichever final state it is. */
+  ready: boolean;
   result: any;
+  progress: JobProgress | null;
 }
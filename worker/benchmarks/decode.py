@@ -0,0 +1,115 @@
+"""Benchmark reduced-resolution decoding against full-resolution decoding.
+
+Generates large synthetic photos (JPEG and PNG) and decodes each one
+with the worker's previous full-resolution path
+(``Image.open(...).convert("RGB")``) and with ``decode.decode_image``.
+Reports median latency, peak memory added by the decode, and how far the
+224px centre crop the model sees drifts between the two paths.
+
+Peak memory is read from the kernel's resident high-water mark (Linux),
+since Pillow's buffers are not visible to tracemalloc.
+
+Run from the worker directory:
+
+    python -m benchmarks.decode --sizes 4032x3024 6000x4000
+"""
+import argparse
+import io
+import statistics
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+from decode import DECODE_MIN_SIDE, decode_image
+
+
+def _full_decode(data):
+    return Image.open(io.BytesIO(data)).convert("RGB")
+
+
+def _reduced_decode(data):
+    return decode_image(data, min_side=DECODE_MIN_SIDE or 224)
+
+
+PATHS = {"full": _full_decode, "reduced": _reduced_decode}
+
+
+def _synthetic_image(width, height, fmt):
+    """A smooth gradient with noise, so it compresses like a photo."""
+    rng = np.random.default_rng(0)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, np.newaxis]
+    pixels = np.stack(
+        [x + 0 * y, y + 0 * x, (x + y) / 2],
+        axis=-1,
+    )
+    pixels += rng.normal(0, 12, pixels.shape).astype(np.float32)
+    buf = io.BytesIO()
+    Image.fromarray(pixels.clip(0, 255).astype(np.uint8)).save(buf, fmt, quality=90)
+    return buf.getvalue()
+
+
+def _status_kb(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field):
+                return int(line.split()[1])
+    raise RuntimeError(f"{field} not found in /proc/self/status")
+
+
+def _measure_peak_mb(decode, data):
+    """Peak resident memory added while decoding, in MB (Linux only).
+
+    Writing 5 to clear_refs resets the process's high-water mark, so
+    VmHWM afterwards is the peak reached during this decode alone.
+    """
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+    before = _status_kb("VmRSS:")
+    img = decode(data)
+    peak = _status_kb("VmHWM:")
+    del img
+    return (peak - before) / 1024
+
+
+def _model_view(img, size=224):
+    """Approximate what CLIP sees: shortest side to ``size``, centre crop."""
+    width, height = img.size
+    scale = size / min(width, height)
+    img = img.resize((max(size, round(width * scale)), max(size, round(height * scale))), Image.BICUBIC)
+    left, top = (img.width - size) // 2, (img.height - size) // 2
+    return np.asarray(img.crop((left, top, left + size, top + size)), dtype=np.float32)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", nargs="+", default=["4032x3024", "6000x4000"])
+    parser.add_argument("--formats", nargs="+", default=["JPEG", "PNG"])
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    print(f"{'image':>18} {'path':>8} {'median ms':>10} {'peak MB':>8} {'decoded':>11}")
+    for size in args.sizes:
+        width, height = (int(v) for v in size.lower().split("x"))
+        for fmt in args.formats:
+            data = _synthetic_image(width, height, fmt)
+            views = {}
+            for path, decode in PATHS.items():
+                timings = []
+                for _ in range(args.repeats):
+                    started = time.perf_counter()
+                    img = decode(data)
+                    timings.append((time.perf_counter() - started) * 1000)
+                views[path] = _model_view(img)
+                print(
+                    f"{size + ' ' + fmt:>18} {path:>8} {statistics.median(timings):10.1f} "
+                    f"{_measure_peak_mb(decode, data):8.1f} {img.width:>5}x{img.height:<5}"
+                )
+            drift = np.abs(views["full"] - views["reduced"]).mean()
+            print(f"{'':>18} mean abs pixel difference of the 224px model input: {drift:.2f}/255")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+"""Compare the shared inference server against a model per task process.
+
+Starts ``--processes`` forked processes that each embed ``--requests``
+small batches, as concurrent Celery tasks would. In ``per-process`` mode
+every process loads its own model and runs its own forward passes; in
+``server`` mode a single server process holds the model and batches the
+requests of all of them. Reports throughput, the memory of all processes
+together (PSS, so shared pages are counted once) and, for the server,
+the average batch size it actually ran.
+
+Both modes get the same number of torch threads in total. The tiny
+stand-in model is used by default so this runs offline; ``--model clip``
+loads CLIP_MODEL_NAME from the local Hugging Face cache.
+
+Run from the worker directory:
+
+    python -m benchmarks.inference_server --processes 4 --requests 20 --batch 4
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+import inference_server
+import tasks
+from benchmarks.pipeline import _tiny_clip
+
+
+def _load(model_name):
+    if model_name == "tiny":
+        tasks.model, tasks.processor = _tiny_clip()
+    else:
+        tasks._load_clip()
+
+
+def _images(count, seed):
+    rng = np.random.default_rng(seed)
+    return [
+        Image.fromarray(rng.integers(0, 256, (224, 224, 3), dtype=np.uint8))
+        for _ in range(count)
+    ]
+
+
+def _client(index, args, address, ready, done, results):
+    """One simulated task process: embed ``args.requests`` batches."""
+    torch.set_num_threads(1)
+    if address:
+        client = inference_server.InferenceClient(address)
+        client.info()
+        embed = client.embed
+    else:
+        _load(args.model)
+        embed = tasks.embed_locally
+    batches = [_images(args.batch, seed=index * 1000 + i) for i in range(args.requests)]
+    embed(batches[0][:1])  # warm-up
+
+    ready.wait()
+    started = time.perf_counter()
+    for batch in batches:
+        embed(batch)
+    elapsed = time.perf_counter() - started
+    results.put((elapsed, tasks._memory_mb().get("pss_mb", 0.0)))
+    done.wait()  # stay alive until every process has measured its memory
+
+
+def _server(args, address, threads, done, results):
+    """The inference server, reporting its memory once the clients finish."""
+    torch.set_num_threads(threads)
+    _load(args.model)
+    info = {"model_id": args.model, "dim": tasks.model.config.projection_dim, "label_embeddings": None}
+
+    def report():
+        done.wait()
+        results.put(("server", tasks._memory_mb().get("pss_mb", 0.0)))
+
+    threading.Thread(target=report, daemon=True).start()
+    inference_server.serve(
+        address, tasks.embed_locally, info,
+        max_batch=args.max_batch, max_wait=args.max_wait_ms / 1000,
+    )
+
+
+def _run(mode, args):
+    ctx = multiprocessing.get_context("fork")
+    ready = ctx.Barrier(args.processes + 1)
+    done = ctx.Barrier(args.processes + 2 if mode == "server" else args.processes + 1)
+    results = ctx.Queue()
+    server = address = None
+
+    if mode == "server":
+        # The server gets the threads the per-process models would have used
+        address = os.path.join(tempfile.mkdtemp(prefix="visionboard-bench-"), "inference.sock")
+        server = ctx.Process(target=_server, args=(args, address, args.processes, done, results))
+        server.start()
+
+    clients = [
+        ctx.Process(target=_client, args=(i, args, address, ready, done, results))
+        for i in range(args.processes)
+    ]
+    for process in clients:
+        process.start()
+    ready.wait()
+    started = time.perf_counter()
+    client_results = [results.get() for _ in clients]
+    elapsed = time.perf_counter() - started
+
+    stats = None
+    if server is not None:
+        stats = inference_server.InferenceClient(address).stats()
+    done.wait()
+    pss = sum(pss for _, pss in client_results)
+    if server is not None:
+        pss += results.get()[1]
+        server.terminate()
+    for process in clients:
+        process.join()
+    return elapsed, pss, stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--processes", type=int, default=4, help="simulated task processes")
+    parser.add_argument("--requests", type=int, default=20, help="batches per process")
+    parser.add_argument("--batch", type=int, default=4, help="images per request")
+    parser.add_argument("--model", choices=["tiny", "clip"], default="tiny")
+    parser.add_argument("--max-batch", type=int, default=inference_server.INFERENCE_MAX_BATCH)
+    parser.add_argument("--max-wait-ms", type=float, default=inference_server.INFERENCE_MAX_WAIT_MS)
+    args = parser.parse_args(argv)
+
+    n_images = args.processes * args.requests * args.batch
+    print(
+        f"model: {args.model}, processes: {args.processes}, "
+        f"{args.requests} requests of {args.batch} images each ({n_images} images)"
+    )
+    print(f"{'mode':>12} {'images/s':>9} {'total PSS MB':>13}  batching")
+    for mode in ("per-process", "server"):
+        elapsed, pss, stats = _run(mode, args)
+        batching = ""
+        if stats:
+            mean = stats["images"] / max(1, stats["batches"])
+            batching = f"{stats['batches']} batches, mean {mean:.1f} images"
+        print(f"{mode:>12} {n_images / elapsed:>9.1f} {pss:>13.1f}  {batching}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
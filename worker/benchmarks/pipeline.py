@@ -0,0 +1,255 @@
+"""End-to-end benchmark of the clustering pipeline, fully offline.
+
+Serves generated JPEGs from a local HTTP server and runs the same code
+path as ``tasks.cluster_images`` (download, decode, embed, cluster, tag)
+for several job sizes. Reports throughput, p50/p99 job latency, peak
+resident memory and where the time went per stage.
+
+By default a tiny randomly initialised CLIP-shaped model stands in for
+the real checkpoint, so the benchmark needs no network, no GPU and no
+downloaded weights; the numbers then measure the pipeline around the
+model. Pass ``--model clip`` to load CLIP_MODEL_NAME instead (it must
+already be in the local Hugging Face cache).
+
+Run from the worker directory:
+
+    python -m benchmarks.pipeline --sizes 32 128 512 --repeats 5
+    python -m benchmarks.pipeline --json before.json   # compare in review
+"""
+import argparse
+import io
+import json
+import os
+import string
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+from PIL import Image
+from transformers import CLIPConfig, CLIPImageProcessor, CLIPModel, CLIPProcessor, CLIPTokenizer
+
+import dedup
+import fetch
+import tasks
+from embedding_cache import EmbeddingCache
+
+
+def _tiny_clip(seed=0):
+    """A randomly initialised CLIP with the real architecture at toy width.
+
+    The image processor matches CLIP's (224px shortest edge, centre crop),
+    so preprocessing costs what it does in production. The tokenizer has
+    a letters-only vocabulary, enough to encode the label prompts.
+    """
+    torch.manual_seed(seed)
+    config = CLIPConfig(
+        text_config={
+            "hidden_size": 64, "intermediate_size": 128, "num_hidden_layers": 2,
+            "num_attention_heads": 2, "vocab_size": 64, "max_position_embeddings": 77,
+            "bos_token_id": 0, "eos_token_id": 1, "pad_token_id": 1,
+        },
+        vision_config={
+            "hidden_size": 64, "intermediate_size": 128, "num_hidden_layers": 2,
+            "num_attention_heads": 2, "image_size": 224, "patch_size": 32,
+        },
+        projection_dim=32,
+    )
+    clip_model = CLIPModel(config).eval()
+    clip_model.requires_grad_(False)
+
+    vocab = {"<|startoftext|>": 0, "<|endoftext|>": 1}
+    for letter in string.ascii_lowercase:
+        vocab[letter] = len(vocab)
+        vocab[f"{letter}</w>"] = len(vocab)
+    vocab_dir = tempfile.mkdtemp(prefix="visionboard-tiny-clip-")
+    with open(os.path.join(vocab_dir, "vocab.json"), "w") as f:
+        json.dump(vocab, f)
+    with open(os.path.join(vocab_dir, "merges.txt"), "w") as f:
+        f.write("#version: 0.2\n")
+    clip_processor = CLIPProcessor(
+        image_processor=CLIPImageProcessor(),
+        tokenizer=CLIPTokenizer(
+            os.path.join(vocab_dir, "vocab.json"), os.path.join(vocab_dir, "merges.txt")
+        ),
+    )
+    return clip_model, clip_processor
+
+
+def _generate_images(count, width, height, groups=5, seed=0):
+    """Photo-like JPEGs in ``groups`` colour families, so clustering has structure.
+
+    Each image also gets its own coarse light-and-shade layout, so no two
+    are near-duplicates and the dedup stage does not skip any of them.
+    """
+    rng = np.random.default_rng(seed)
+    palettes = rng.integers(0, 256, (groups, 3))
+    images = []
+    for i in range(count):
+        base = palettes[i % groups].astype(np.float32)
+        layout = Image.fromarray(rng.integers(0, 256, (6, 8), dtype=np.uint8))
+        shade = np.asarray(layout.resize((width, height), Image.BICUBIC), dtype=np.float32)
+        shade = (shade - 128)[..., np.newaxis] * 0.6
+        pixels = base + shade + rng.normal(0, 10, (height, width, 3)).astype(np.float32)
+        buf = io.BytesIO()
+        Image.fromarray(pixels.clip(0, 255).astype(np.uint8)).save(buf, "JPEG", quality=85)
+        images.append(buf.getvalue())
+    return images
+
+
+class _ImageHandler(BaseHTTPRequestHandler):
+    images = []
+
+    def do_GET(self):
+        try:
+            body = self.images[int(self.path.strip("/").split(".")[0])]
+        except (ValueError, IndexError):
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", f'"{self.path.strip("/")}"')
+        self.end_headers()
+        if self.command == "GET":
+            self.wfile.write(body)
+
+    do_HEAD = do_GET
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _serve(images):
+    """Serve ``images`` at http://127.0.0.1:<port>/<index>.jpg from a thread."""
+    handler = type("Handler", (_ImageHandler,), {"images": images})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _status_kb(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field):
+                return int(line.split()[1])
+    raise RuntimeError(f"{field} not found in /proc/self/status")
+
+
+def _reset_peak_rss():
+    """Reset the kernel's resident high-water mark (VmHWM) for this process."""
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+
+
+def _run_job(urls, n_clusters, batch_size):
+    """One job through the same steps as tasks.cluster_images, minus Celery."""
+    timer = tasks.StageTimer()
+    progress = tasks._Progress(None, len(urls))
+    duplicates = tasks.Duplicates()
+    swatches = {}
+    valid_urls, X, _ = tasks._get_image_embeddings(
+        urls, batch_size=batch_size, progress=progress, timer=timer, duplicates=duplicates,
+        swatches=swatches,
+    )
+    if X is None:
+        raise RuntimeError("no image could be embedded; is the image server reachable?")
+    tasks._cluster_and_tag(
+        None, valid_urls, X, n_clusters, tasks.TAG_SAMPLE_SIZE, {}, progress, timer,
+        duplicates.of, swatches,
+    )
+    return timer
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", nargs="+", type=int, default=[32, 128, 512])
+    parser.add_argument("--repeats", type=int, default=5, help="timed jobs per size")
+    parser.add_argument("--clusters", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=tasks.EMBED_BATCH_SIZE)
+    parser.add_argument("--image-size", default="1024x768", help="generated JPEG size")
+    parser.add_argument("--model", choices=["tiny", "clip"], default="tiny")
+    parser.add_argument("--threads", type=int, default=1, help="torch CPU threads")
+    parser.add_argument(
+        "--cache", action="store_true",
+        help="use a fresh embedding cache (repeats after the first then hit it)",
+    )
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    torch.set_num_threads(args.threads)
+    tasks.device = "cpu"
+    if args.model == "tiny":
+        tasks.model, tasks.processor = _tiny_clip()
+        tasks.label_embeddings = tasks._compute_label_embeddings()
+        # An untrained model maps every image to almost the same direction,
+        # which the embedding dedup stage would collapse into one image
+        dedup.DEDUP_SIMILARITY = 0
+    else:
+        tasks.load_model()
+    tasks.embedding_cache = None
+    # Every repeat downloads its images; the HTTP cache is not what is measured
+    fetch.HTTP_CACHE_DIR = ""
+    if args.cache:
+        tasks.embedding_cache = EmbeddingCache(
+            tempfile.mkdtemp(prefix="visionboard-bench-cache-"),
+            args.model,
+            tasks.model.config.projection_dim,
+            swatch_pixels=tasks.SWATCH_PIXELS,
+        )
+
+    width, height = (int(v) for v in args.image_size.lower().split("x"))
+    images = _generate_images(max(args.sizes), width, height)
+    server = _serve(images)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    # Warm-up: first-call allocations and lazy imports are not what we measure
+    _run_job([f"{base_url}/{i}.jpg" for i in range(min(4, len(images)))], 2, args.batch_size)
+
+    print(
+        f"model: {args.model}, images: {width}x{height}, batch size: {args.batch_size}, "
+        f"threads: {args.threads}, cache: {'on' if args.cache else 'off'}"
+    )
+    print(f"{'images':>7} {'images/s':>9} {'p50 s':>8} {'p99 s':>8} {'peak MB':>8}  slowest stages")
+    results = []
+    for size in args.sizes:
+        urls = [f"{base_url}/{i}.jpg" for i in range(size)]
+        latencies, peaks, stages = [], [], {}
+        for _ in range(args.repeats):
+            _reset_peak_rss()
+            before = _status_kb("VmRSS:")
+            started = time.perf_counter()
+            timer = _run_job(urls, args.clusters, args.batch_size)
+            latencies.append(time.perf_counter() - started)
+            peaks.append((_status_kb("VmHWM:") - before) / 1024)
+            for stage, hist in timer.summary()["stages"].items():
+                stages[stage] = stages.get(stage, 0.0) + hist["seconds"] / args.repeats
+
+        row = {
+            "images": size,
+            "images_per_second": round(size / float(np.median(latencies)), 2),
+            "p50_seconds": round(float(np.percentile(latencies, 50)), 4),
+            "p99_seconds": round(float(np.percentile(latencies, 99)), 4),
+            "peak_rss_mb": round(max(peaks), 1),
+            "stage_seconds": {stage: round(seconds, 4) for stage, seconds in stages.items()},
+        }
+        results.append(row)
+        slowest = sorted(stages.items(), key=lambda item: -item[1])[:3]
+        print(
+            f"{size:>7} {row['images_per_second']:>9.1f} {row['p50_seconds']:>8.3f} "
+            f"{row['p99_seconds']:>8.3f} {row['peak_rss_mb']:>8.1f}  "
+            + ", ".join(f"{stage} {seconds:.3f}s" for stage, seconds in slowest)
+        )
+    print("stage seconds are summed over the fetch threads, so they can exceed the latency")
+
+    server.shutdown()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,113 @@
+"""Compare the int8 inference backend against fp32 on a set of images.
+
+Embeds the same images with both backends and reports throughput per
+CPU core alongside how much the results drift: embedding cosine
+similarity, agreement of KMeans cluster assignments (adjusted Rand
+index) and overlap of the aesthetic tags each image ends up with.
+
+Run from the worker directory:
+
+    python -m benchmarks.quantization path/to/images/ --clusters 5
+"""
+import argparse
+import copy
+import io
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+from sklearn.metrics import adjusted_rand_score
+
+import tasks
+from fetch import fetch_bytes
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif"}
+
+
+def _collect_sources(sources):
+    """Expand directories into image files; URLs and files pass through."""
+    found = []
+    for source in sources:
+        if os.path.isdir(source):
+            for name in sorted(os.listdir(source)):
+                if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                    found.append(os.path.join(source, name))
+        else:
+            found.append(source)
+    return found
+
+
+def _decode(source):
+    if source.startswith(("http://", "https://")):
+        return Image.open(io.BytesIO(fetch_bytes(source))).convert("RGB")
+    return Image.open(source).convert("RGB")
+
+
+def _run_backend(images, n_clusters, batch_size, repeats):
+    """Embed, cluster and tag ``images`` with whatever model tasks has loaded."""
+    tasks.label_embeddings = tasks._compute_label_embeddings()
+    batches = [images[i:i + batch_size] for i in range(0, len(images), batch_size)]
+
+    tasks._embed_images(batches[0][:1])  # warm-up
+    seconds = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        X = np.vstack([tasks._embed_images(batch) for batch in batches])
+        seconds.append(time.perf_counter() - started)
+
+    labels, centers, _ = tasks._cluster_embeddings(X, n_clusters)
+    cluster_tags = [
+        tasks._tag_cluster(X[labels == c], centroid=centers[c])
+        for c in range(len(centers))
+    ]
+    image_tags = [set(cluster_tags[label]) for label in labels]
+    return X, labels, image_tags, min(seconds)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("sources", nargs="+", help="image files, directories or URLs")
+    parser.add_argument("--clusters", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=tasks.EMBED_BATCH_SIZE)
+    parser.add_argument("--threads", type=int, default=1, help="torch CPU threads")
+    parser.add_argument("--repeats", type=int, default=3, help="timed passes; the best is kept")
+    args = parser.parse_args(argv)
+
+    images = [_decode(source) for source in _collect_sources(args.sources)]
+    if len(images) < 2:
+        parser.error("need at least two images")
+
+    torch.set_num_threads(args.threads)
+    tasks.device = "cpu"
+    tasks.INFERENCE_BACKEND = "fp32"
+    tasks.load_model()
+    fp32_model = tasks.model
+
+    fp32 = _run_backend(images, args.clusters, args.batch_size, args.repeats)
+    tasks.model = tasks.quantize_model(copy.deepcopy(fp32_model))
+    int8 = _run_backend(images, args.clusters, args.batch_size, args.repeats)
+    tasks.model = fp32_model
+
+    (X32, labels32, tags32, sec32), (X8, labels8, tags8, sec8) = fp32, int8
+    cosine = np.sum(
+        (X32 / np.linalg.norm(X32, axis=1, keepdims=True))
+        * (X8 / np.linalg.norm(X8, axis=1, keepdims=True)),
+        axis=1,
+    )
+    tag_jaccard = np.mean([len(a & b) / len(a | b) if a | b else 1.0 for a, b in zip(tags32, tags8)])
+
+    n = len(images)
+    print(f"images: {n}, clusters: {args.clusters}, threads: {args.threads}")
+    for name, sec in (("fp32", sec32), ("int8", sec8)):
+        print(f"{name}: {n / sec:8.1f} images/s  ({n / sec / args.threads:.1f} per core)")
+    print(f"speed-up: {sec32 / sec8:.2f}x")
+    print(f"embedding cosine similarity: mean {cosine.mean():.4f}, min {cosine.min():.4f}")
+    print(f"cluster agreement (adjusted Rand index): {adjusted_rand_score(labels32, labels8):.4f}")
+    print(f"tag agreement (mean Jaccard per image): {tag_jaccard:.4f}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
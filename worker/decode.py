@@ -0,0 +1,41 @@
+import io
+import mmap
+import os
+
+from PIL import Image
+
+# Decode images only as large as the model needs: the shortest side is brought
+# down to this many pixels (CLIP's input is 224). 0 decodes at full resolution.
+DECODE_MIN_SIDE = int(os.environ.get("DECODE_MIN_SIDE", "224"))
+
+
+def decode_image(data, min_side=DECODE_MIN_SIDE):
+    """Decode image bytes to RGB with the shortest side at most ``min_side``.
+
+    ``data`` may also be a memory map (see fetch.fetch). JPEGs use draft
+    mode, so libjpeg decodes straight to 1/2, 1/4 or 1/8 scale and a 12 MP
+    photo never exists in memory at full size. Other formats are decoded
+    normally and then downscaled. Images already smaller than
+    ``min_side`` are left alone.
+    """
+    # A memory map is read in place rather than copied into a buffer first
+    img = Image.open(data if isinstance(data, mmap.mmap) else io.BytesIO(data))
+
+    if min_side:
+        width, height = img.size
+        scale = min_side / min(width, height)
+        if scale < 1:
+            img.draft("RGB", (round(width * scale), round(height * scale)))
+
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    else:
+        img.load()  # decode now, so corrupt files fail here rather than mid-batch
+
+    if min_side and min(img.size) > min_side:
+        width, height = img.size
+        scale = min_side / min(width, height)
+        size = (max(min_side, round(width * scale)), max(min_side, round(height * scale)))
+        img = img.resize(size, Image.BICUBIC, reducing_gap=3.0)
+
+    return img
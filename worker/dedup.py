@@ -0,0 +1,143 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+from palette import swatch
+
+# Images whose 64-bit difference hashes differ in at most this many bits
+# are treated as the same shot and only the first is embedded (0 disables)
+DEDUP_HASH_DISTANCE = int(os.environ.get("DEDUP_HASH_DISTANCE", "4"))
+# A hash match is only a duplicate if the two images' colour swatches also
+# differ by at most this mean RGB distance per swatch pixel (0-441)
+DEDUP_COLOR_DISTANCE = float(os.environ.get("DEDUP_COLOR_DISTANCE", "16"))
+# Embeddings at least this cosine-similar to an earlier one within
+# DEDUP_WINDOW images are collapsed before clustering (0 disables)
+DEDUP_SIMILARITY = float(os.environ.get("DEDUP_SIMILARITY", "0.97"))
+DEDUP_WINDOW = int(os.environ.get("DEDUP_WINDOW", "256"))
+
+
+def dhash(img, size=8):
+    """64-bit difference hash: brightness gradients of a 9x8 grayscale thumbnail."""
+    pixels = np.asarray(
+        img.convert("L").resize((size + 1, size), Image.BILINEAR), dtype=np.int16
+    )
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+class HashIndex:
+    """Finds an earlier hash within ``max_distance`` bits of a new one.
+
+    The 64 bits are split into ``max_distance + 1`` bands. Two hashes that
+    differ in at most ``max_distance`` bits must agree exactly on at least
+    one band, so only hashes sharing a band are compared.
+    """
+
+    def __init__(self, max_distance=DEDUP_HASH_DISTANCE):
+        self.max_distance = max_distance
+        n_bands = max_distance + 1
+        edges = np.linspace(0, 64, n_bands + 1).astype(int)
+        self._bands = [
+            (int(lo), (1 << int(hi - lo)) - 1) for lo, hi in zip(edges[:-1], edges[1:])
+        ]
+        self._tables = [{} for _ in self._bands]
+
+    def find_or_add(self, h, value, confirm=None):
+        """Return the value stored with a near-identical hash, else store ``value``.
+
+        When ``confirm`` is given, a stored value only counts as a match
+        if ``confirm(stored_value)`` is true.
+        """
+        keys = [(h >> shift) & mask for shift, mask in self._bands]
+        for table, key in zip(self._tables, keys):
+            for other, other_value in table.get(key, ()):
+                if bin(h ^ other).count("1") <= self.max_distance and (
+                    confirm is None or confirm(other_value)
+                ):
+                    return other_value
+        for table, key in zip(self._tables, keys):
+            table.setdefault(key, []).append((h, value))
+        return None
+
+
+def color_distance(a, b):
+    """Mean Euclidean RGB distance between corresponding pixels of two swatches."""
+    diff = np.asarray(a, dtype=np.float32) - np.asarray(b, dtype=np.float32)
+    return float(np.sqrt((diff ** 2).sum(axis=1)).mean())
+
+
+class Duplicates:
+    """Collects near-duplicate images found while a job is embedded.
+
+    The difference hash only finds candidates: it sees brightness
+    gradients alone, so flat or recoloured images can share a hash. A
+    candidate is confirmed by comparing the two images' colour swatches,
+    and only confirmed copies are recorded. ``of`` maps each duplicate
+    URL to the URL of the image it duplicates.
+    """
+
+    def __init__(self, max_distance=DEDUP_HASH_DISTANCE, max_color_distance=None):
+        self.of = {}
+        self.max_color_distance = (
+            DEDUP_COLOR_DISTANCE if max_color_distance is None else max_color_distance
+        )
+        self._hashes = HashIndex(max_distance) if max_distance > 0 else None
+        self._swatches = {}
+
+    def check(self, url, img=None, colors=None, h=None):
+        """Record ``url`` as a duplicate and return True if an earlier image matches.
+
+        ``colors`` and ``h`` are the image's swatch and difference hash, if
+        already taken (say from the embedding cache); ``img`` is only needed
+        for what is missing.
+        """
+        if self._hashes is None:
+            return False
+        colors = swatch(img) if colors is None else colors
+        original = self._hashes.find_or_add(
+            dhash(img) if h is None else h, url,
+            confirm=lambda other: color_distance(colors, self._swatches[other])
+            <= self.max_color_distance,
+        )
+        if original is None:
+            self._swatches[url] = colors
+            return False
+        self.of[url] = original
+        return True
+
+
+def embedding_duplicates(X, threshold=None, window=None):
+    """Greedily collapse rows of ``X`` onto earlier, near-identical rows.
+
+    Each row is compared with the representatives among the ``window``
+    rows before it, since bursts of near-identical shots arrive together;
+    this keeps the cost linear in the job size. Returns an array mapping
+    every row to its representative (itself if it is one). ``threshold``
+    and ``window`` default to DEDUP_SIMILARITY and DEDUP_WINDOW.
+    """
+    threshold = DEDUP_SIMILARITY if threshold is None else threshold
+    window = DEDUP_WINDOW if window is None else window
+    n = len(X)
+    representative = np.arange(n)
+    if threshold <= 0 or n < 2:
+        return representative
+
+    window = max(1, window)
+    for start in range(0, n, window):
+        lo = max(0, start - window)
+        rows = np.asarray(X[lo:start + window], dtype=np.float32)
+        rows = rows / np.maximum(np.linalg.norm(rows, axis=1, keepdims=True), 1e-12)
+        similarity = rows[start - lo:] @ rows.T
+        for i in range(len(similarity)):
+            row = start + i
+            first = max(lo, row - window)
+            candidates = np.arange(first, row)
+            candidates = candidates[representative[first:row] == candidates]
+            if not len(candidates):
+                continue
+            scores = similarity[i, candidates - lo]
+            best = int(np.argmax(scores))
+            if scores[best] >= threshold:
+                representative[row] = candidates[best]
+    return representative
@@ -0,0 +1,268 @@
+import hashlib
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+EMBEDDING_CACHE_DIR = os.environ.get(
+    "EMBEDDING_CACHE_DIR",
+    os.path.join(tempfile.gettempdir(), "visionboard", "embeddings"),
+)
+# Max number of embeddings kept on disk; least recently used are evicted
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", "50000"))
+
+_HASH_MASK = (1 << 64) - 1
+
+
+def content_key(data):
+    """Cache key for an image's raw bytes."""
+    return hashlib.sha256(data).hexdigest()
+
+
+class EmbeddingCache:
+    """Content-addressed, size-bounded embedding store shared by worker processes.
+
+    Vectors live in a fixed-size memory-mapped float32 file with one slot
+    per entry; a small SQLite index maps content hashes to slots, tracks
+    LRU order and remembers which (url, validator) pairs resolved to which
+    content hash so unchanged URLs can skip the download entirely.
+
+    A slot is marked not-ready while its vector is being rewritten, and
+    readers re-check the slot after copying, so a concurrent eviction in
+    another process never hands back a half-written vector.
+
+    With ``swatch_pixels`` set, each slot also holds the image's colour
+    swatch (see palette.swatch) in a second memory-mapped file, so cache
+    hits still contribute to their cluster's palette. The index keeps each
+    image's difference hash (see dedup.dhash), so hits are checked for
+    near-duplicates like any other image.
+    """
+
+    def __init__(self, root, model_name, dim, capacity=EMBEDDING_CACHE_SIZE, swatch_pixels=0):
+        slug = re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name)
+        self.dir = os.path.join(root, slug)
+        self.dim = int(dim)
+        self.capacity = max(1, int(capacity))
+        self.swatch_pixels = int(swatch_pixels)
+        self._local = threading.local()
+        self._vectors = None
+        self._vectors_pid = None
+        self._swatches = None
+        self._swatches_pid = None
+        self._lock = threading.Lock()
+        os.makedirs(self.dir, exist_ok=True)
+
+        db = self._db()
+        with db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS slots ("
+                " slot INTEGER PRIMARY KEY, key TEXT UNIQUE,"
+                " last_used REAL NOT NULL, ready INTEGER NOT NULL DEFAULT 0)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS aliases ("
+                " url TEXT NOT NULL, validator TEXT NOT NULL, key TEXT NOT NULL,"
+                " PRIMARY KEY (url, validator))"
+            )
+            columns = {row[1] for row in db.execute("PRAGMA table_info(slots)")}
+            if "dhash" not in columns:
+                db.execute("ALTER TABLE slots ADD COLUMN dhash INTEGER")
+            db.execute("CREATE INDEX IF NOT EXISTS slots_lru ON slots (last_used)")
+            db.execute("CREATE INDEX IF NOT EXISTS aliases_key ON aliases (key)")
+            # Capacity may have shrunk since the file was created
+            db.execute(
+                "DELETE FROM aliases WHERE key IN"
+                " (SELECT key FROM slots WHERE slot >= ?)",
+                (self.capacity,),
+            )
+            db.execute("DELETE FROM slots WHERE slot >= ?", (self.capacity,))
+
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(os.path.join(self.dir, "index.sqlite3"), timeout=30)
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def _open_slots_file(self, name, dtype, row_shape):
+        """Memory-map ``name`` as one ``row_shape`` row per slot, growing it if needed."""
+        path = os.path.join(self.dir, name)
+        shape = (self.capacity, *row_shape)
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
+        return np.memmap(path, dtype=dtype, mode="r+", shape=shape)
+
+    def _vector_file(self):
+        with self._lock:
+            if self._vectors is None or self._vectors_pid != os.getpid():
+                self._vectors = self._open_slots_file(
+                    f"vectors-{self.dim}.f32", np.float32, (self.dim,)
+                )
+                self._vectors_pid = os.getpid()
+            return self._vectors
+
+    def _swatch_file(self):
+        # RGBA: alpha 255 marks a stored swatch, so slots written before
+        # swatches were kept (all zeros) read as missing rather than black
+        with self._lock:
+            if self._swatches is None or self._swatches_pid != os.getpid():
+                self._swatches = self._open_slots_file(
+                    f"swatches-{self.swatch_pixels}.u8", np.uint8, (self.swatch_pixels, 4)
+                )
+                self._swatches_pid = os.getpid()
+            return self._swatches
+
+    def known_validators(self, url):
+        """Validators (ETag / Last-Modified) previously seen for ``url``."""
+        rows = self._db().execute(
+            "SELECT validator FROM aliases WHERE url = ?", (url,)
+        ).fetchall()
+        return {row[0] for row in rows}
+
+    def alias_key(self, url, validator):
+        """The content key ``url`` had at ``validator``, or None."""
+        row = self._db().execute(
+            "SELECT key FROM aliases WHERE url = ? AND validator = ?",
+            (url, validator),
+        ).fetchone()
+        return row[0] if row else None
+
+    def get_alias(self, url, validator):
+        """Look up an embedding by URL and validator without the image bytes."""
+        key = self.alias_key(url, validator)
+        return self.get(key) if key else None
+
+    def get(self, key):
+        """Return a copy of the cached embedding for ``key``, or None."""
+        db = self._db()
+        row = db.execute(
+            "SELECT slot FROM slots WHERE key = ? AND ready = 1", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        slot = row[0]
+        vector = np.array(self._vector_file()[slot])
+        with db:
+            touched = db.execute(
+                "UPDATE slots SET last_used = ? WHERE slot = ? AND key = ? AND ready = 1",
+                (time.time(), slot, key),
+            ).rowcount
+        return vector if touched else None
+
+    def get_swatch(self, key):
+        """Return a copy of the colour swatch stored with ``key``, or None."""
+        if not self.swatch_pixels:
+            return None
+        db = self._db()
+        row = db.execute(
+            "SELECT slot FROM slots WHERE key = ? AND ready = 1", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        pixels = np.array(self._swatch_file()[row[0]])
+        still_there = db.execute(
+            "SELECT 1 FROM slots WHERE slot = ? AND key = ? AND ready = 1", (row[0], key)
+        ).fetchone()
+        if not still_there or not pixels[:, 3].all():
+            return None
+        return pixels[:, :3]
+
+    def get_dhash(self, key):
+        """Return the difference hash stored with ``key``, or None."""
+        row = self._db().execute(
+            "SELECT dhash FROM slots WHERE key = ? AND ready = 1", (key,)
+        ).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return row[0] & _HASH_MASK  # stored signed, as SQLite integers are
+
+    def put(self, key, vector, url=None, validator=None, swatch=None, dhash=None):
+        """Store ``vector``, ``swatch`` and ``dhash`` under ``key``, evicting the LRU entry if full."""
+        vector = np.asarray(vector, dtype=np.float32).reshape(self.dim)
+        db = self._db()
+        now = time.time()
+
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT slot FROM slots WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                slot = row[0]
+                db.execute("UPDATE slots SET ready = 0, last_used = ? WHERE slot = ?", (now, slot))
+            else:
+                (count,) = db.execute("SELECT COUNT(*) FROM slots").fetchone()
+                if count < self.capacity:
+                    (slot,) = db.execute(
+                        "SELECT COALESCE(MAX(slot) + 1, 0) FROM slots"
+                    ).fetchone()
+                    if slot >= self.capacity:
+                        # Holes left by a capacity change; take the lowest free slot
+                        (slot,) = db.execute(
+                            "SELECT MIN(s.slot + 1) FROM slots s WHERE s.slot + 1 < ?"
+                            " AND NOT EXISTS (SELECT 1 FROM slots t WHERE t.slot = s.slot + 1)",
+                            (self.capacity,),
+                        ).fetchone()
+                        if slot is None:
+                            slot = 0
+                    db.execute(
+                        "INSERT INTO slots (slot, key, last_used, ready) VALUES (?, ?, ?, 0)",
+                        (slot, key, now),
+                    )
+                else:
+                    slot, old_key = db.execute(
+                        "SELECT slot, key FROM slots ORDER BY last_used LIMIT 1"
+                    ).fetchone()
+                    db.execute("DELETE FROM aliases WHERE key = ?", (old_key,))
+                    db.execute(
+                        "UPDATE slots SET key = ?, last_used = ?, ready = 0 WHERE slot = ?",
+                        (key, now, slot),
+                    )
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+        vectors = self._vector_file()
+        vectors[slot] = vector
+        vectors.flush()
+        if self.swatch_pixels:
+            swatches = self._swatch_file()
+            if swatch is None:
+                swatches[slot] = 0  # do not leave the evicted entry's swatch
+            else:
+                swatches[slot, :, :3] = np.asarray(swatch, dtype=np.uint8).reshape(-1, 3)
+                swatches[slot, :, 3] = 255
+            swatches.flush()
+
+        if dhash is not None and dhash > _HASH_MASK >> 1:
+            dhash -= _HASH_MASK + 1
+        with db:
+            db.execute(
+                "UPDATE slots SET ready = 1, dhash = ? WHERE slot = ? AND key = ?",
+                (dhash, slot, key),
+            )
+            if url and validator:
+                db.execute(
+                    "INSERT OR REPLACE INTO aliases (url, validator, key) VALUES (?, ?, ?)",
+                    (url, validator, key),
+                )
+
+    def add_alias(self, url, validator, key):
+        """Remember that ``url`` at ``validator`` has content ``key``."""
+        if not url or not validator:
+            return
+        db = self._db()
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO aliases (url, validator, key) VALUES (?, ?, ?)",
+                (url, validator, key),
+            )
@@ -0,0 +1,231 @@
+import mmap
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from http_cache import HTTP_CACHE_DIR, HttpCache
+
+BACKEND_URL = os.environ.get("BACKEND_URL", "http://backend:8000")
+# Download threads per task, and the most concurrent requests sent to one host
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", "8"))
+DOWNLOAD_PER_HOST = int(os.environ.get("DOWNLOAD_PER_HOST", "4"))
+DOWNLOAD_TIMEOUT = 15
+# Where the backend's MEDIA_ROOT is mounted in this container (empty if it
+# is not). Backend URLs under LOCAL_MEDIA_URL are then read from disk
+# instead of being downloaded through the backend.
+LOCAL_MEDIA_ROOT = os.environ.get("LOCAL_MEDIA_ROOT", "")
+LOCAL_MEDIA_URL = os.environ.get("LOCAL_MEDIA_URL", "/media/")
+
+_lock = threading.Lock()
+_session = None
+_session_pid = None
+_host_slots = {}
+_http_cache = None
+
+
+def resolve_url(url):
+    """Rewrite localhost URLs to the backend service name for Docker networking."""
+    return url.replace("http://localhost:8000", BACKEND_URL).replace("http://127.0.0.1:8000", BACKEND_URL)
+
+
+def get_session():
+    """Return this process's shared keep-alive session.
+
+    The session is created lazily and recreated after a fork, so Celery
+    prefork children never share sockets with their parent.
+    """
+    global _session, _session_pid
+    with _lock:
+        if _session is None or _session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=16,
+                pool_maxsize=max(DOWNLOAD_WORKERS, DOWNLOAD_PER_HOST),
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+            _session_pid = os.getpid()
+            _host_slots.clear()
+        return _session
+
+
+def local_path(url):
+    """The mounted file behind a backend media URL, or None to use HTTP.
+
+    Only URLs on the backend (after resolve_url) under LOCAL_MEDIA_URL
+    qualify, and only if the file exists under LOCAL_MEDIA_ROOT; paths
+    escaping the root (e.g. through "..") are never read.
+    """
+    if not LOCAL_MEDIA_ROOT:
+        return None
+    parts = urlsplit(resolve_url(url))
+    backend = urlsplit(BACKEND_URL)
+    if (parts.scheme, parts.netloc) != (backend.scheme, backend.netloc):
+        return None
+    if not parts.path.startswith(LOCAL_MEDIA_URL):
+        return None
+    root = os.path.realpath(LOCAL_MEDIA_ROOT)
+    path = os.path.realpath(os.path.join(root, unquote(parts.path[len(LOCAL_MEDIA_URL):])))
+    if os.path.commonpath([root, path]) != root or not os.path.isfile(path):
+        return None
+    return path
+
+
+def _local_validator(stat):
+    """A validator for a local file, changing whenever the file is rewritten."""
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def _read_local(path):
+    """Memory-map a local file read-only; returns ``(data, validator)``.
+
+    The pages come straight from the page cache, and PIL decodes from the
+    map without the file first being copied into a bytes object. Uploads
+    are never rewritten in place, so the map cannot shrink under a reader.
+    """
+    with open(path, "rb") as f:
+        stat = os.fstat(f.fileno())
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if stat.st_size else b""
+    return data, _local_validator(stat)
+
+
+def get_http_cache():
+    """This process's HTTP cache, or None if HTTP_CACHE_DIR is empty."""
+    global _http_cache
+    if not HTTP_CACHE_DIR:
+        return None
+    with _lock:
+        if _http_cache is None:
+            _http_cache = HttpCache(HTTP_CACHE_DIR)
+        return _http_cache
+
+
+def _cached_body(cached):
+    """The cached response's body, or None if it was evicted meanwhile."""
+    try:
+        return cached.read()
+    except FileNotFoundError:
+        return None
+
+
+def _host_slot(url):
+    """Semaphore limiting concurrent requests to the URL's host."""
+    host = urlsplit(url).netloc
+    with _lock:
+        slot = _host_slots.get(host)
+        if slot is None:
+            slot = threading.BoundedSemaphore(max(1, DOWNLOAD_PER_HOST))
+            _host_slots[host] = slot
+        return slot
+
+
+def _validator(headers):
+    """The response's cache validator: its ETag, else its Last-Modified date."""
+    return headers.get("ETag") or headers.get("Last-Modified")
+
+
+def fetch(url):
+    """Download a URL through the shared session, or read it from disk.
+
+    Returns ``(body, validator)`` where ``validator`` is the ETag or
+    Last-Modified header (None if the server sent neither). Backend media
+    files that are mounted locally (see local_path) are memory-mapped
+    instead, so ``body`` is any read-only bytes-like object.
+
+    Responses go through the HTTP cache: a fresh copy is served without
+    a request, and a stale one is revalidated with If-None-Match /
+    If-Modified-Since, so an unchanged image costs a 304 and no body.
+    """
+    path = local_path(url)
+    if path is not None:
+        return _read_local(path)
+
+    http_cache = get_http_cache()
+    cached = http_cache.get(url) if http_cache is not None else None
+    if cached is not None and cached.fresh:
+        body = _cached_body(cached)
+        if body is not None:
+            return body, cached.validator
+
+    session = get_session()
+    resolved = resolve_url(url)
+    headers = cached.conditional_headers() if cached is not None else {}
+    with _host_slot(resolved):
+        resp = session.get(resolved, headers=headers, timeout=DOWNLOAD_TIMEOUT)
+    if resp.status_code == 304 and cached is not None:
+        body = _cached_body(cached)
+        if body is not None:
+            http_cache.refresh(url, resp.headers)
+            return body, _validator(resp.headers) or cached.validator
+        with _host_slot(resolved):  # evicted while revalidating; fetch it whole
+            resp = session.get(resolved, timeout=DOWNLOAD_TIMEOUT)
+    resp.raise_for_status()
+    if http_cache is not None and resp.status_code == 200:
+        http_cache.put(url, resp.content, resp.headers)
+    return resp.content, _validator(resp.headers)
+
+
+def fetch_bytes(url):
+    """Download (or read) a URL like fetch() and return just the body."""
+    return fetch(url)[0]
+
+
+def fetch_validator(url):
+    """Return the URL's current validator with a HEAD request, without the body.
+
+    A fresh response in the HTTP cache answers without any request.
+    """
+    path = local_path(url)
+    if path is not None:
+        return _local_validator(os.stat(path))
+
+    http_cache = get_http_cache()
+    cached = http_cache.get(url) if http_cache is not None else None
+    if cached is not None and cached.fresh and cached.validator:
+        return cached.validator
+
+    session = get_session()
+    resolved = resolve_url(url)
+    with _host_slot(resolved):
+        resp = session.head(resolved, timeout=DOWNLOAD_TIMEOUT, allow_redirects=True)
+    resp.raise_for_status()
+    return _validator(resp.headers)
+
+
+def fetch_many(urls, load, workers=None, prefetch=None):
+    """Run ``load(url)`` for each URL on a thread pool, yielding in input order.
+
+    Yields ``(url, value, error)`` tuples where exactly one of ``value`` and
+    ``error`` is set. At most ``prefetch`` loads are in flight, so the
+    caller can consume results (e.g. run inference) while the next ones
+    download without the whole job being buffered in memory.
+    """
+    workers = max(1, workers or DOWNLOAD_WORKERS)
+    prefetch = max(workers, prefetch or workers * 4)
+    pending = deque()
+    url_iter = iter(urls)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fetch") as pool:
+        def submit_next():
+            for url in url_iter:
+                pending.append((url, pool.submit(load, url)))
+                return True
+            return False
+
+        for _ in range(prefetch):
+            if not submit_next():
+                break
+
+        while pending:
+            url, future = pending.popleft()
+            submit_next()
+            try:
+                yield url, future.result(), None
+            except Exception as e:
+                yield url, None, e
@@ -0,0 +1,256 @@
+import email.utils
+import hashlib
+import json
+import mmap
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+HTTP_CACHE_DIR = os.environ.get(
+    "HTTP_CACHE_DIR",
+    os.path.join(tempfile.gettempdir(), "visionboard", "http"),
+)
+# Total size of cached response bodies; least recently used are evicted
+HTTP_CACHE_SIZE_MB = int(os.environ.get("HTTP_CACHE_SIZE_MB", "1024"))
+# A response with Last-Modified but no explicit lifetime is fresh for this
+# fraction of its age when it was served (RFC 9111 §4.2.2), up to a day
+HEURISTIC_FRACTION = 0.1
+HEURISTIC_MAX_LIFETIME = 24 * 3600
+# Headers kept with a stored response, so a 304 can update them
+STORED_HEADERS = ("Cache-Control", "Expires", "ETag", "Last-Modified")
+
+
+def _http_date(value):
+    """Seconds since the epoch of an HTTP date, or None if it is not one."""
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def _pick(headers, names):
+    return {name: headers[name] for name in names if headers.get(name)}
+
+
+def freshness_lifetime(headers, now=None):
+    """Seconds a response stays fresh, or None if it must not be stored.
+
+    Follows Cache-Control (``no-store``, ``no-cache``, ``max-age``, less
+    any Age) and falls back to Expires. Without either, a response with
+    Last-Modified gets a heuristic lifetime of HEURISTIC_FRACTION of the
+    time since that date. Other responses are stored only if they carry
+    an ETag, and are then revalidated on every use.
+    """
+    now = time.time() if now is None else now
+    directives = {}
+    for part in headers.get("Cache-Control", "").split(","):
+        name, _, value = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = value.strip('"')
+
+    if "no-store" in directives:
+        return None
+    if "no-cache" in directives:
+        return 0
+    try:
+        # Age: how long a CDN or proxy in between has already held it
+        age = int(headers.get("Age", "0"))
+    except ValueError:
+        age = 0
+    if "max-age" in directives:
+        try:
+            return max(0, int(directives["max-age"]) - age)
+        except ValueError:
+            return 0
+    expires = headers.get("Expires")
+    if expires:
+        expires = _http_date(expires)
+        return 0 if expires is None else max(0, expires - now)  # invalid means expired
+    last_modified = _http_date(headers.get("Last-Modified"))
+    if last_modified is not None:
+        date = _http_date(headers.get("Date")) or now
+        lifetime = min(HEURISTIC_MAX_LIFETIME, (date - last_modified) * HEURISTIC_FRACTION)
+        return max(0, lifetime - age)
+    if headers.get("ETag") or headers.get("Last-Modified"):
+        return 0
+    return None
+
+
+class CachedResponse:
+    """A stored response: its body file, validators and expiry time."""
+
+    def __init__(self, path, etag, last_modified, expires):
+        self.path = path
+        self.etag = etag
+        self.last_modified = last_modified
+        self.expires = expires
+
+    @property
+    def fresh(self):
+        return time.time() < self.expires
+
+    @property
+    def validator(self):
+        return self.etag or self.last_modified
+
+    def conditional_headers(self):
+        """Request headers that let the origin answer 304 Not Modified."""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    def read(self):
+        """Memory-map the stored body read-only.
+
+        Raises FileNotFoundError if another process evicted it meanwhile.
+        """
+        with open(self.path, "rb") as f:
+            if not os.fstat(f.fileno()).st_size:
+                return b""
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class HttpCache:
+    """Size-bounded, on-disk cache of HTTP response bodies shared by worker processes.
+
+    Each body is its own file; a small SQLite index maps URLs to files,
+    validators (ETag / Last-Modified) and expiry times, and tracks LRU
+    order. Bodies are written under a fresh name and only then indexed,
+    so a reader never sees a partly written file; a replaced or evicted
+    file is unlinked, which leaves existing memory maps of it intact.
+    """
+
+    def __init__(self, root, capacity_mb=HTTP_CACHE_SIZE_MB):
+        self.dir = root
+        self.capacity = max(1, int(capacity_mb)) * 1024 * 1024
+        self._local = threading.local()
+        os.makedirs(os.path.join(self.dir, "bodies"), exist_ok=True)
+
+        db = self._db()
+        with db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " url TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER NOT NULL,"
+                " etag TEXT, last_modified TEXT, expires REAL NOT NULL,"
+                " last_used REAL NOT NULL, headers TEXT)"
+            )
+            columns = {row[1] for row in db.execute("PRAGMA table_info(responses)")}
+            if "headers" not in columns:
+                db.execute("ALTER TABLE responses ADD COLUMN headers TEXT")
+            db.execute("CREATE INDEX IF NOT EXISTS responses_lru ON responses (last_used)")
+
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(os.path.join(self.dir, "index.sqlite3"), timeout=30)
+            # Losing the last few entries in a crash only costs re-downloads,
+            # so commits need not wait for fsync
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def get(self, url):
+        """The stored response for ``url`` (fresh or stale), or None."""
+        db = self._db()
+        row = db.execute(
+            "SELECT path, etag, last_modified, expires FROM responses WHERE url = ?", (url,)
+        ).fetchone()
+        if row is None:
+            return None
+        with db:
+            db.execute("UPDATE responses SET last_used = ? WHERE url = ?", (time.time(), url))
+        return CachedResponse(*row)
+
+    def put(self, url, body, headers):
+        """Store a 200 response if its headers allow it; evicts LRU entries past capacity."""
+        lifetime = freshness_lifetime(headers)
+        if lifetime is None or len(body) > self.capacity:
+            return
+
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        path = os.path.join(self.dir, "bodies", f"{key}-{uuid.uuid4().hex[:8]}")
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.dir, "bodies"), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(body)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+        now = time.time()
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            old = db.execute("SELECT path FROM responses WHERE url = ?", (url,)).fetchone()
+            db.execute(
+                "INSERT OR REPLACE INTO responses"
+                " (url, path, size, etag, last_modified, expires, last_used, headers)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (url, path, len(body), headers.get("ETag"), headers.get("Last-Modified"),
+                 now + lifetime, now, json.dumps(_pick(headers, STORED_HEADERS))),
+            )
+            evicted = self._evict(db)
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            os.unlink(path)
+            raise
+        for stale in ([old[0]] if old else []) + evicted:
+            try:
+                os.unlink(stale)
+            except FileNotFoundError:
+                pass
+
+    def refresh(self, url, headers):
+        """Record a 304 revalidation: new expiry and any updated validators.
+
+        As in RFC 9111 §4.3.4, the stored response's headers are updated
+        with the 304's and its freshness is worked out again from them. A
+        304 that only confirms the validator thus renews the stored
+        max-age, or heuristic lifetime, counted from the 304's Date and Age.
+        """
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT headers FROM responses WHERE url = ?", (url,)).fetchone()
+            if row is not None:
+                updated = {**json.loads(row[0] or "{}"), **_pick(headers, STORED_HEADERS)}
+                lifetime = freshness_lifetime({**updated, **_pick(headers, ("Date", "Age"))}) or 0
+                now = time.time()
+                db.execute(
+                    "UPDATE responses SET expires = ?, last_used = ?, headers = ?,"
+                    " etag = COALESCE(?, etag), last_modified = COALESCE(?, last_modified)"
+                    " WHERE url = ?",
+                    (now + lifetime, now, json.dumps(updated), headers.get("ETag"),
+                     headers.get("Last-Modified"), url),
+                )
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def _evict(self, db):
+        """Drop LRU rows until the bodies fit; returns the files to unlink."""
+        (total,) = db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()
+        evicted = []
+        if total <= self.capacity:
+            return evicted
+        for url, path, size in db.execute(
+            "SELECT url, path, size FROM responses ORDER BY last_used"
+        ).fetchall():
+            if total <= self.capacity:
+                break
+            db.execute("DELETE FROM responses WHERE url = ?", (url,))
+            evicted.append(path)
+            total -= size
+        return evicted
@@ -0,0 +1,303 @@
+"""Node-local CLIP inference server with dynamic batching.
+
+One process holds the model; every Celery process on the node sends it
+decoded images over a Unix socket. Requests arriving within
+INFERENCE_MAX_WAIT_MS of each other are run as one forward pass of up to
+INFERENCE_MAX_BATCH images, so many small tasks share large batches and
+only one copy of the weights is resident.
+
+Run from the worker directory, with the same model settings
+(CLIP_MODEL_NAME, INFERENCE_BACKEND) a worker would use:
+
+    INFERENCE_SERVER=/run/visionboard/inference.sock python -m inference_server
+"""
+import os
+import queue
+import secrets
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener, answer_challenge, deliver_challenge
+
+import numpy as np
+
+# Most images run through the model in one forward pass
+INFERENCE_MAX_BATCH = int(os.environ.get("INFERENCE_MAX_BATCH", "64"))
+# How long the first request of a batch waits for others to join it
+INFERENCE_MAX_WAIT_MS = float(os.environ.get("INFERENCE_MAX_WAIT_MS", "10"))
+# Seconds a worker keeps retrying to reach a server that is still starting
+INFERENCE_CONNECT_TIMEOUT = 30
+# Seconds a worker waits for a reply before giving up on a hung server
+INFERENCE_TIMEOUT = float(os.environ.get("INFERENCE_TIMEOUT", "120"))
+# Secret every connection must prove it knows before anything is unpickled.
+# Unless it is set, the server writes a random one next to the socket,
+# readable by the socket's owner and group, and workers read it from there
+INFERENCE_AUTHKEY = os.environ.get("INFERENCE_AUTHKEY", "")
+
+
+class Batcher:
+    """Runs ``embed(images)`` over requests from many threads in shared batches.
+
+    A request is a list of images; submit() returns a Future resolving to
+    its (n, dim) embeddings. A background thread takes the oldest request,
+    waits up to ``max_wait`` seconds for more while the batch holds fewer
+    than ``max_batch`` images, then embeds everything gathered in one call.
+    A single request larger than ``max_batch`` is split across passes.
+    """
+
+    def __init__(self, embed, max_batch=INFERENCE_MAX_BATCH, max_wait=INFERENCE_MAX_WAIT_MS / 1000):
+        self.embed = embed
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0.0, max_wait)
+        self.batches = 0
+        self.images = 0
+        self._requests = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def submit(self, images):
+        future = Future()
+        if not images:
+            future.set_result(None)
+            return future
+        with self._lock:
+            # Threads do not survive a fork, so each process starts its own
+            if self._pid != os.getpid():
+                self._requests = queue.Queue()
+                self._pid = os.getpid()
+                threading.Thread(
+                    target=self._run, args=(self._requests,), name="batcher", daemon=True
+                ).start()
+            self._requests.put((list(images), future))
+        return future
+
+    def _run(self, requests):
+        while True:
+            pending = [requests.get()]
+            size = len(pending[0][0])
+            deadline = time.monotonic() + self.max_wait
+            while size < self.max_batch:
+                try:
+                    request = requests.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                pending.append(request)
+                size += len(request[0])
+            self._embed(pending)
+
+    def _embed(self, pending):
+        images = [img for request_images, _ in pending for img in request_images]
+        try:
+            embeddings = np.vstack([
+                self.embed(images[start:start + self.max_batch])
+                for start in range(0, len(images), self.max_batch)
+            ])
+        except Exception as e:
+            for _, future in pending:
+                future.set_exception(e)
+            return
+
+        self.batches += -(-len(images) // self.max_batch)
+        self.images += len(images)
+        start = 0
+        for request_images, future in pending:
+            future.set_result(embeddings[start:start + len(request_images)])
+            start += len(request_images)
+
+
+class LocalInference:
+    """In-process stand-in for the server: same batching, no socket.
+
+    Used with ``INFERENCE_SERVER=local`` so tests and single-process runs
+    exercise the batched path without a second process.
+    """
+
+    model_id = None
+
+    def __init__(self, embed):
+        self._batcher = Batcher(embed)
+
+    def embed(self, images):
+        return self._batcher.submit(images).result()
+
+
+def _key_path(address):
+    return f"{address}.key"
+
+
+def _read_authkey(address):
+    if INFERENCE_AUTHKEY:
+        return INFERENCE_AUTHKEY.encode()
+    with open(_key_path(address), "rb") as f:
+        return f.read()
+
+
+def _create_authkey(address):
+    """The server's key: INFERENCE_AUTHKEY, or a new random one written for the workers."""
+    if INFERENCE_AUTHKEY:
+        return INFERENCE_AUTHKEY.encode()
+    key = secrets.token_hex(32).encode()
+    path = _key_path(address)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        os.fchmod(fd, 0o640)
+        os.write(fd, key)
+    finally:
+        os.close(fd)
+    os.replace(tmp_path, path)
+    return key
+
+
+class InferenceClient:
+    """A task process's connection to the node's inference server.
+
+    The connection is opened lazily and reopened after a fork, so prefork
+    children never share a socket with their parent. A call raises
+    TimeoutError if the server has not replied within ``timeout`` seconds.
+    """
+
+    def __init__(self, address, connect_timeout=INFERENCE_CONNECT_TIMEOUT, timeout=INFERENCE_TIMEOUT):
+        self.address = address
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.model_id = None
+        self._info = None
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        if self._conn is None or self._pid != os.getpid():
+            deadline = time.monotonic() + self.connect_timeout
+            while True:
+                try:
+                    # The key is read on every connect, as a restarted server has a new one
+                    self._conn = Client(
+                        self.address, family="AF_UNIX", authkey=_read_authkey(self.address)
+                    )
+                    break
+                except (FileNotFoundError, ConnectionRefusedError, AuthenticationError):
+                    if time.monotonic() > deadline:
+                        raise
+                    time.sleep(0.5)
+            self._pid = os.getpid()
+        return self._conn
+
+    def _call(self, *message):
+        with self._lock:
+            conn = self._connection()
+            try:
+                conn.send(message)
+                if not conn.poll(self.timeout):
+                    conn.close()  # a late reply must not be read as the next call's
+                    raise TimeoutError(f"No reply from the inference server in {self.timeout:g}s")
+                status, payload = conn.recv()
+            except (EOFError, OSError):
+                self._conn = None  # the server restarted or hung; reconnect next time
+                raise
+        if status == "error":
+            raise RuntimeError(f"Inference server error: {payload}")
+        return payload
+
+    def info(self):
+        """The served model's id, embedding size and label embeddings."""
+        if self._info is None:
+            self._info = self._call("info")
+            self.model_id = self._info["model_id"]
+        return self._info
+
+    def stats(self):
+        """Batches and images the server has run since it started."""
+        return self._call("stats")
+
+    def embed(self, images):
+        """Embed decoded images on the server; returns an (n, dim) array."""
+        return self._call("embed", [np.asarray(img) for img in images])
+
+
+def _handle(conn, batcher, info, authkey):
+    """Serve one task process's requests until it disconnects.
+
+    The client is authenticated first, in this thread, so one that stalls
+    the handshake holds up neither the other clients nor new connections.
+    """
+    with conn:
+        try:
+            deliver_challenge(conn, authkey)
+            answer_challenge(conn, authkey)
+        except (AuthenticationError, EOFError, OSError) as e:
+            print(f"Rejected an inference client ({e!r})")
+            return
+        while True:
+            try:
+                command, *args = conn.recv()
+            except (EOFError, OSError):
+                return
+            try:
+                if command == "embed":
+                    reply = ("ok", batcher.submit(args[0]).result())
+                elif command == "info":
+                    reply = ("ok", info)
+                elif command == "stats":
+                    reply = ("ok", {"batches": batcher.batches, "images": batcher.images})
+                else:
+                    reply = ("error", f"unknown command {command!r}")
+            except Exception as e:
+                reply = ("error", repr(e))
+            conn.send(reply)
+
+
+def serve(address, embed, info, max_batch=INFERENCE_MAX_BATCH, max_wait=INFERENCE_MAX_WAIT_MS / 1000):
+    """Accept task processes on the Unix socket ``address`` until interrupted.
+
+    Messages are pickled, so only clients that know the shared key (see
+    INFERENCE_AUTHKEY) get a request read, and the socket is created
+    accessible to its owner and group alone; keep it in a directory
+    shared with the workers only.
+    """
+    batcher = Batcher(embed, max_batch=max_batch, max_wait=max_wait)
+    if os.path.exists(address):
+        os.unlink(address)  # left over from a previous run
+    os.makedirs(os.path.dirname(address) or ".", exist_ok=True)
+    authkey = _create_authkey(address)
+    # Set before binding: a chmod afterwards would leave a window in which
+    # anyone could connect
+    umask = os.umask(0o117)
+    try:
+        listener = Listener(address, family="AF_UNIX")
+    finally:
+        os.umask(umask)
+    with listener:
+        print(
+            f"Serving {info['model_id']} on {address} "
+            f"(max batch {batcher.max_batch}, max wait {batcher.max_wait * 1000:g}ms)"
+        )
+        while True:
+            conn = listener.accept()
+            threading.Thread(
+                target=_handle, args=(conn, batcher, info, authkey), daemon=True
+            ).start()
+
+
+def main():
+    import tasks
+
+    address = tasks.INFERENCE_SERVER
+    if not address or address == "local":
+        sys.exit("Set INFERENCE_SERVER to the socket path to serve on")
+
+    tasks._load_clip()
+    tasks.model.to(tasks.device)
+    info = {
+        "model_id": tasks._model_id(),
+        "dim": tasks.model.config.projection_dim,
+        "label_embeddings": tasks.label_embeddings,
+    }
+    serve(address, tasks.embed_locally, info)
+
+
+if __name__ == "__main__":
+    main()
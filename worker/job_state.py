@@ -0,0 +1,224 @@
+import fcntl
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+
+# Where completed jobs keep their embeddings and centroids for incremental
+# adds; must be shared by every worker that can pick up an add task
+JOB_STATE_DIR = os.environ.get("JOB_STATE_DIR") or os.path.join(
+    tempfile.gettempdir(), "visionboard", "jobs"
+)
+# The default is local to each host, so only a JOB_STATE_DIR that was set
+# is trusted to be shared; fanned-out jobs need that, as any worker may
+# embed a chunk or reduce them
+JOB_STATE_SHARED = bool(os.environ.get("JOB_STATE_DIR"))
+
+# Days a finished job's state is kept after it was last used; adding
+# images to a job whose state expired fails (0 keeps states forever)
+JOB_STATE_TTL_DAYS = float(os.environ.get("JOB_STATE_TTL_DAYS", "30"))
+# Chunks of fanned-out jobs older than this were never reduced (the job
+# failed) and are removed
+CHUNK_MAX_AGE = 24 * 3600
+# Seconds between sweeps for expired states in each process
+SWEEP_INTERVAL = 3600
+
+_JOB_ID_RE = re.compile(r"^[A-Za-z0-9_-]+$")
+_last_sweep = 0.0
+
+
+def _path(job_id, suffix):
+    if not _JOB_ID_RE.match(job_id):
+        raise ValueError(f"Invalid job id {job_id!r}")
+    return os.path.join(JOB_STATE_DIR, f"{job_id}{suffix}")
+
+
+@contextmanager
+def job_state_lock(job_id):
+    """Hold an exclusive lock on a job's state across processes."""
+    os.makedirs(JOB_STATE_DIR, exist_ok=True)
+    with open(_path(job_id, ".lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def save_job_state(job_id, urls, embeddings, labels, centers, copies=()):
+    """Persist a job's clustering so later images can be added to it.
+
+    ``copies`` are the job's URLs that were not clustered themselves
+    because they duplicate one of ``urls``.
+    """
+    os.makedirs(JOB_STATE_DIR, exist_ok=True)
+    _sweep()
+    path = _path(job_id, ".npz")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(
+            f,
+            urls=np.asarray(urls, dtype=str),
+            embeddings=np.asarray(embeddings, dtype=np.float32),
+            labels=np.asarray(labels, dtype=np.int64),
+            centers=np.asarray(centers, dtype=np.float64),
+            copies=np.asarray(list(copies), dtype=str),
+        )
+    os.replace(tmp_path, path)
+
+
+def load_job_state(job_id):
+    """Return ``(urls, embeddings, labels, centers, copies)`` for a job, or None.
+
+    Loading a state renews its expiry.
+    """
+    path = _path(job_id, ".npz")
+    try:
+        with np.load(path) as state:
+            loaded = (
+                state["urls"].tolist(),
+                state["embeddings"],
+                state["labels"],
+                state["centers"],
+                state["copies"].tolist() if "copies" in state else [],
+            )
+    except FileNotFoundError:
+        return None
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass  # expired meanwhile; it is still returned this once
+    return loaded
+
+
+def job_state_urls(job_id):
+    """Every URL already in a job (clustered or a copy), or None if it has no state.
+
+    Reads only the URL arrays, not the embeddings.
+    """
+    try:
+        with np.load(_path(job_id, ".npz")) as state:
+            urls = set(state["urls"].tolist())
+            if "copies" in state:
+                urls.update(state["copies"].tolist())
+            return urls
+    except FileNotFoundError:
+        return None
+
+
+def _sweep(now=None):
+    """Delete expired job states and abandoned chunks, at most every SWEEP_INTERVAL.
+
+    Every worker shares the directory, so whichever process saves a state
+    next cleans up after all of them.
+    """
+    global _last_sweep
+    now = time.time() if now is None else now
+    if now - _last_sweep < SWEEP_INTERVAL:
+        return
+    _last_sweep = now
+
+    for entry in os.scandir(JOB_STATE_DIR):
+        try:
+            age = now - entry.stat().st_mtime
+        except FileNotFoundError:
+            continue
+        if JOB_STATE_TTL_DAYS > 0 and entry.name.endswith(".npz") and age > JOB_STATE_TTL_DAYS * 86400:
+            job_id = entry.name[:-len(".npz")]
+            with job_state_lock(job_id):
+                # Unless it was used while we waited for the lock
+                try:
+                    expired = now - os.stat(entry.path).st_mtime > JOB_STATE_TTL_DAYS * 86400
+                    if expired:
+                        os.unlink(entry.path)
+                except FileNotFoundError:
+                    expired = True
+            if expired:
+                try:
+                    os.unlink(_path(job_id, ".lock"))
+                except FileNotFoundError:
+                    pass
+        elif entry.name.endswith(".tmp") and age > CHUNK_MAX_AGE:
+            try:
+                os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+
+    chunks_dir = os.path.join(JOB_STATE_DIR, "chunks")
+    if os.path.isdir(chunks_dir):
+        for entry in os.scandir(chunks_dir):
+            try:
+                if now - entry.stat().st_mtime > CHUNK_MAX_AGE:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+            except FileNotFoundError:
+                pass
+
+
+def _chunk_path(name):
+    if not _JOB_ID_RE.match(name):
+        raise ValueError(f"Invalid chunk name {name!r}")
+    return os.path.join(JOB_STATE_DIR, "chunks", name)
+
+
+def save_chunk(job_id, urls, embeddings, duplicates, swatches, hashes=None):
+    """Store one embedded chunk of a fanned-out job; returns the chunk's name.
+
+    Only the name travels through the broker and result backend, so the
+    reducing task gets the chunk by reference from the shared directory.
+    ``swatches`` and ``hashes`` map URLs to their colour swatches and
+    difference hashes.
+    """
+    hashes = hashes or {}
+    name = f"{job_id or 'job'}-{uuid.uuid4().hex}"
+    path = _chunk_path(name)
+    tmp_path = f"{path}.tmp"
+    os.makedirs(tmp_path)
+    try:
+        np.save(os.path.join(tmp_path, "embeddings.npy"), np.asarray(embeddings, dtype=np.float32))
+        swatch_urls = list(swatches)
+        if swatch_urls:
+            np.save(os.path.join(tmp_path, "swatches.npy"), np.stack([swatches[u] for u in swatch_urls]))
+        with open(os.path.join(tmp_path, "index.json"), "w") as f:
+            json.dump(
+                {
+                    "urls": urls,
+                    "duplicates": duplicates,
+                    "swatch_urls": swatch_urls,
+                    "hashes": [hashes.get(url) for url in urls],
+                },
+                f,
+            )
+        os.replace(tmp_path, path)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    return name
+
+
+def load_chunk(name):
+    """Return ``(urls, embeddings, duplicates, swatches, hashes)`` of a stored chunk.
+
+    The embeddings and swatches are memory-mapped, so a chunk costs no
+    memory until its rows are copied out.
+    """
+    path = _chunk_path(name)
+    with open(os.path.join(path, "index.json")) as f:
+        index = json.load(f)
+    embeddings = np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r")
+    swatches = {}
+    if index["swatch_urls"]:
+        stacked = np.load(os.path.join(path, "swatches.npy"), mmap_mode="r")
+        swatches = dict(zip(index["swatch_urls"], stacked))
+    hashes = {url: h for url, h in zip(index["urls"], index.get("hashes", ())) if h is not None}
+    return index["urls"], embeddings, index["duplicates"], swatches, hashes
+
+
+def remove_chunk(name):
+    """Delete a stored chunk once its job has been reduced."""
+    shutil.rmtree(_chunk_path(name), ignore_errors=True)
@@ -0,0 +1,208 @@
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Port the worker serves Prometheus metrics on (0 disables the exporter)
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+# Where each worker process writes its totals for the exporter to merge
+METRICS_DIR = os.environ.get(
+    "METRICS_DIR",
+    os.path.join(tempfile.gettempdir(), "visionboard", "metrics"),
+)
+
+# Histogram upper bounds in seconds; the last bucket (+Inf) is implicit
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_lock = threading.Lock()
+_totals = {}
+_totals_pid = None
+_process_file = None
+
+
+class StageTimer:
+    """Per-stage duration histograms for one task run.
+
+    Safe to use from the fetch pool's threads. Each observation also
+    carries an item count, so a batched stage (inference) reports both
+    how many batches ran and how many images went through them.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def time(self, stage, items=1):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started, items)
+
+    def observe(self, stage, seconds, items=1):
+        index = next((i for i, bound in enumerate(BUCKETS) if seconds <= bound), len(BUCKETS))
+        with self._lock:
+            hist = self.stages.get(stage)
+            if hist is None:
+                hist = self.stages[stage] = _empty_histogram()
+            hist["buckets"][index] += 1
+            hist["count"] += 1
+            hist["items"] += items
+            hist["seconds"] += seconds
+
+    def merge(self, summary):
+        """Add another timer's summary() (e.g. from a fan-out chunk)."""
+        with self._lock:
+            _merge_stages(self.stages, summary["stages"])
+
+    def summary(self):
+        """JSON-safe histograms for a task result's metadata.
+
+        ``buckets`` are per-bucket (not cumulative) counts aligned with
+        ``le``, the last one being everything slower than ``le[-1]``.
+        """
+        with self._lock:
+            stages = {
+                stage: {**hist, "buckets": list(hist["buckets"]), "seconds": round(hist["seconds"], 6)}
+                for stage, hist in self.stages.items()
+            }
+        return {"le": list(BUCKETS), "stages": stages}
+
+
+def _empty_histogram():
+    return {"count": 0, "items": 0, "seconds": 0.0, "buckets": [0] * (len(BUCKETS) + 1)}
+
+
+def _merge_stages(into, stages):
+    for stage, hist in stages.items():
+        target = into.setdefault(stage, _empty_histogram())
+        target["count"] += hist["count"]
+        target["items"] += hist["items"]
+        target["seconds"] += hist["seconds"]
+        target["buckets"] = [a + b for a, b in zip(target["buckets"], hist["buckets"])]
+
+
+@contextmanager
+def task_timer(task_name):
+    """Yield a StageTimer and add it to this process's totals when the task ends.
+
+    The totals are written to METRICS_DIR after every task, whether it
+    succeeded or not, for the exporter to serve.
+    """
+    timer = StageTimer()
+    try:
+        yield timer
+    finally:
+        record(task_name, timer)
+
+
+def record(task_name, timer):
+    """Add a finished task's timings to this process's totals and persist them."""
+    global _totals, _totals_pid, _process_file
+    with _lock:
+        if _totals_pid != os.getpid():
+            # Fresh totals (and file) per process, so a forked child
+            # never re-reports what its parent had already counted
+            _totals = {}
+            _totals_pid = os.getpid()
+            _process_file = os.path.join(METRICS_DIR, f"{os.getpid()}-{uuid.uuid4().hex}.json")
+        task = _totals.setdefault(task_name, {"runs": 0, "stages": {}})
+        task["runs"] += 1
+        _merge_stages(task["stages"], timer.summary()["stages"])
+
+        try:
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            tmp_path = f"{_process_file}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(_totals, f)
+            os.replace(tmp_path, _process_file)
+        except OSError as e:
+            print(f"Could not write metrics to {METRICS_DIR}: {e}")
+
+
+def collect():
+    """Merge the totals written by every worker process."""
+    merged = {}
+    for path in glob.glob(os.path.join(METRICS_DIR, "*.json")):
+        try:
+            with open(path) as f:
+                totals = json.load(f)
+        except (OSError, ValueError):
+            continue  # a process is mid-write or the file was just removed
+        for task_name, task in totals.items():
+            target = merged.setdefault(task_name, {"runs": 0, "stages": {}})
+            target["runs"] += task["runs"]
+            _merge_stages(target["stages"], task["stages"])
+    return merged
+
+
+def render(totals):
+    """Format merged totals in the Prometheus text exposition format."""
+    lines = [
+        "# HELP visionboard_task_runs_total Tasks finished by this worker.",
+        "# TYPE visionboard_task_runs_total counter",
+    ]
+    for task_name, task in sorted(totals.items()):
+        lines.append(f'visionboard_task_runs_total{{task="{task_name}"}} {task["runs"]}')
+
+    lines += [
+        "# HELP visionboard_stage_items_total Images (or clusters) processed per pipeline stage.",
+        "# TYPE visionboard_stage_items_total counter",
+    ]
+    for task_name, task in sorted(totals.items()):
+        for stage, hist in sorted(task["stages"].items()):
+            lines.append(
+                f'visionboard_stage_items_total{{task="{task_name}",stage="{stage}"}} {hist["items"]}'
+            )
+
+    lines += [
+        "# HELP visionboard_stage_duration_seconds Time spent per pipeline stage.",
+        "# TYPE visionboard_stage_duration_seconds histogram",
+    ]
+    for task_name, task in sorted(totals.items()):
+        for stage, hist in sorted(task["stages"].items()):
+            labels = f'task="{task_name}",stage="{stage}"'
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), hist["buckets"]):
+                cumulative += count
+                lines.append(f'visionboard_stage_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"visionboard_stage_duration_seconds_sum{{{labels}}} {hist['seconds']:.6f}")
+            lines.append(f"visionboard_stage_duration_seconds_count{{{labels}}} {hist['count']}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render(collect()).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes every few seconds would drown out the task logs
+
+
+def start_exporter(port=METRICS_PORT):
+    """Serve /metrics from a daemon thread in the main worker process.
+
+    Clears totals left by a previous run first, so counters restart from
+    zero together with the worker.
+    """
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    for path in glob.glob(os.path.join(METRICS_DIR, "*.json")):
+        os.remove(path)
+    server = ThreadingHTTPServer(("", port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print(f"Serving worker metrics on :{port}/metrics")
+    return server
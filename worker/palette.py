@@ -0,0 +1,85 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+# Colours in each cluster's dominant palette (0 disables palettes)
+PALETTE_SIZE = int(os.environ.get("PALETTE_SIZE", "5"))
+# Each decoded image keeps a SWATCH_SIDE x SWATCH_SIDE thumbnail of its colours
+SWATCH_SIDE = 10
+SWATCH_PIXELS = SWATCH_SIDE * SWATCH_SIDE
+# Pixels sampled from a cluster's swatches for its k-means
+PALETTE_MAX_PIXELS = 20000
+# Palette colours closer than this (Euclidean, in RGB) are merged into one
+PALETTE_MIN_DISTANCE = 24
+
+
+def swatch(img):
+    """A (SWATCH_PIXELS, 3) uint8 colour sample of a decoded image.
+
+    Box-filtered, so each pixel is the mean colour of one block of the
+    image and single noisy pixels do not become palette colours.
+    """
+    thumb = img.convert("RGB").resize((SWATCH_SIDE, SWATCH_SIDE), Image.BOX)
+    return np.asarray(thumb, dtype=np.uint8).reshape(SWATCH_PIXELS, 3)
+
+
+def dominant_colors(pixels, k=None, iterations=10, max_pixels=PALETTE_MAX_PIXELS, seed=0):
+    """The ``k`` dominant colours of an (n, 3) RGB array, by k-means.
+
+    Returns ``[{"color": "#rrggbb", "share": 0.42}, ...]``, most common
+    first, where ``share`` is the fraction of pixels nearest that colour.
+    Near-identical colours are merged into the more common one, so a
+    nearly uniform cluster gets fewer than ``k`` colours. Seeding is
+    k-means++ with a fixed seed, so the same pixels always give the same
+    palette. ``k`` defaults to PALETTE_SIZE.
+    """
+    k = PALETTE_SIZE if k is None else k
+    pixels = np.asarray(pixels, dtype=np.float32).reshape(-1, 3)
+    if k <= 0 or not len(pixels):
+        return []
+
+    rng = np.random.default_rng(seed)
+    if len(pixels) > max_pixels:
+        pixels = pixels[rng.choice(len(pixels), max_pixels, replace=False)]
+    k = min(k, len(np.unique(pixels, axis=0)))
+
+    centers = pixels[[rng.integers(len(pixels))]]
+    nearest = ((pixels - centers[0]) ** 2).sum(axis=1)
+    for _ in range(1, k):
+        center = pixels[rng.choice(len(pixels), p=nearest / nearest.sum())]
+        centers = np.vstack([centers, center])
+        nearest = np.minimum(nearest, ((pixels - center) ** 2).sum(axis=1))
+
+    squared_norms = (pixels ** 2).sum(axis=1, keepdims=True)
+    for _ in range(iterations + 1):
+        distances = squared_norms - 2 * pixels @ centers.T + (centers ** 2).sum(axis=1)
+        labels = np.argmin(distances, axis=1)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.stack(
+            [np.bincount(labels, weights=pixels[:, c], minlength=k) for c in range(3)], axis=1
+        )
+        # Empty clusters keep their previous centre
+        moved = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centers)
+        converged = np.abs(moved - centers).max() < 0.5
+        centers = moved
+        if converged:
+            break
+
+    kept = []
+    for i in np.argsort(-counts, kind="stable"):
+        if not counts[i]:
+            continue
+        close = [j for j in kept if np.linalg.norm(centers[i] - centers[j]) < PALETTE_MIN_DISTANCE]
+        if close:
+            counts[close[0]] += counts[i]
+        else:
+            kept.append(i)
+    kept.sort(key=lambda i: -counts[i])
+    return [
+        {
+            "color": "#{:02x}{:02x}{:02x}".format(*np.clip(np.rint(centers[i]), 0, 255).astype(int)),
+            "share": round(float(counts[i]) / len(pixels), 3),
+        }
+        for i in kept
+    ]
@@ -1,28 +1,71 @@
+import gc
+import hashlib
 import os
-from celery import Celery
+import re
+import tempfile
+import time
+from functools import partial
+
+from celery import Celery, chord
+from celery.backends.redis import RedisBackend
+from celery.signals import worker_init, worker_process_init
 import torch
-import requests
-import io
 import numpy as np
-from PIL import Image
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import silhouette_score
 from transformers import CLIPProcessor, CLIPModel
 
+from decode import DECODE_MIN_SIDE, decode_image
+from dedup import DEDUP_HASH_DISTANCE, Duplicates, dhash, embedding_duplicates
+from embedding_cache import EMBEDDING_CACHE_DIR, EmbeddingCache, content_key
+from fetch import fetch, fetch_bytes, fetch_many, fetch_validator
+from inference_server import InferenceClient, LocalInference
+from job_state import (
+    JOB_STATE_SHARED, job_state_lock, job_state_urls, load_chunk, load_job_state, remove_chunk,
+    save_chunk, save_job_state,
+)
+from metrics import METRICS_PORT, StageTimer, start_exporter, task_timer
+from palette import (
+    PALETTE_SIZE, SWATCH_PIXELS, dominant_colors, swatch,
+)
+
 app = Celery(
     "worker",
     broker=os.environ.get("CELERY_BROKER_URL", "redis://localhost:6379/0"),
     backend=os.environ.get("CELERY_RESULT_BACKEND", "redis://localhost:6379/0"),
 )
-BACKEND_URL = os.environ.get("BACKEND_URL", "http://backend:8000")
-device = "cuda" if torch.cuda.is_available() else "cpu"
+# Number of decoded images sent through the CLIP image encoder per forward pass
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", "32"))
+# Jobs with more images than this keep their embedding matrix in an on-disk memmap
+EMBED_MEMMAP_THRESHOLD = int(os.environ.get("EMBED_MEMMAP_THRESHOLD", "5000"))
+EMBED_MEMMAP_DIR = os.environ.get("EMBED_MEMMAP_DIR") or None
+# Jobs with more images than this are split into chunks embedded in parallel
+# across workers (0 disables fan-out); each failed chunk is retried on its own
+FANOUT_CHUNK_SIZE = int(os.environ.get("FANOUT_CHUNK_SIZE", "256"))
+FANOUT_CHUNK_RETRIES = int(os.environ.get("FANOUT_CHUNK_RETRIES", "3"))
+# Minimum seconds between progress updates published to the result backend
+PROGRESS_INTERVAL = float(os.environ.get("PROGRESS_INTERVAL", "1.0"))
+CLIP_MODEL_NAME = os.environ.get("CLIP_MODEL_NAME", "openai/clip-vit-base-patch32")
+# "lazy" loads CLIP on the first task in each process; "preload" loads it in the
+# Celery parent before the pool forks so children share the weights copy-on-write
+MODEL_LOAD = os.environ.get("MODEL_LOAD", "lazy")
+# "fp32" runs the checkpoint as published; "int8" dynamically quantizes the
+# encoders' linear layers for faster CPU-only inference
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "fp32")
+INFERENCE_BACKENDS = ("fp32", "int8")
+device = "cuda" if torch.cuda.is_available() and INFERENCE_BACKEND == "fp32" else "cpu"
+# Socket path of the node's inference server (see inference_server.py), so
+# task processes share one batched model instead of loading their own;
+# "local" runs the same batching in-process. Empty uses a model per process
+INFERENCE_SERVER = os.environ.get("INFERENCE_SERVER", "")
 
-
-def _resolve_url(url):
-    """Rewrite localhost URLs to the backend service name for Docker networking."""
-    return url.replace("http://localhost:8000", BACKEND_URL).replace("http://127.0.0.1:8000", BACKEND_URL)
-
-model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32").to(device)
-processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
+# Populated by load_model()
+model = None
+processor = None
+inference = None
+label_embeddings = None
+embedding_cache = None
+startup_stats = {}
 
 # Aesthetic vocabulary for zero-shot tagging
 AESTHETIC_LABELS = [
@@ -35,97 +78,1110 @@ AESTHETIC_LABELS = [
     "food and drink", "fashion", "architecture", "travel", "portrait",
     "flat lay", "landscape", "texture", "pattern", "typography",
 ]
+# "kmeans" always runs full-batch KMeans, "minibatch" always runs MiniBatchKMeans
+# on normalised embeddings, "auto" switches to minibatch above MINIBATCH_THRESHOLD
+CLUSTER_ALGORITHM = os.environ.get("CLUSTER_ALGORITHM", "auto")
+MINIBATCH_THRESHOLD = int(os.environ.get("MINIBATCH_THRESHOLD", "2000"))
+MINIBATCH_SIZE = 1024
+# Bounds for n_clusters="auto": largest k tried and rows sampled to score each k
+AUTO_K_MAX = int(os.environ.get("AUTO_K_MAX", "12"))
+AUTO_K_SAMPLE = int(os.environ.get("AUTO_K_SAMPLE", "2000"))
+# Cosine distance from the nearest centroid beyond which an added image starts
+# a new cluster instead of joining an existing one
+NEW_CLUSTER_DISTANCE = float(os.environ.get("NEW_CLUSTER_DISTANCE", "0.25"))
+LABEL_PROMPT = "a photo that is {}"
+# Cluster members (closest to the centroid) scored when tagging; 0 tags the centroid
+TAG_SAMPLE_SIZE = int(os.environ.get("TAG_SAMPLE_SIZE", "6"))
+# Directory to persist the label embedding matrix in; empty to recompute at startup
+LABEL_EMBEDDINGS_DIR = os.environ.get("LABEL_EMBEDDINGS_DIR", "")
+# Colour swatches feed the palettes and confirm perceptual-hash duplicates
+KEEP_SWATCHES = PALETTE_SIZE > 0 or DEDUP_HASH_DISTANCE > 0
 
 
-def _get_image_embedding(url):
-    """Download an image and return its CLIP embedding."""
-    resp = requests.get(_resolve_url(url), timeout=15)
-    resp.raise_for_status()
-    img = Image.open(io.BytesIO(resp.content)).convert("RGB")
-    inputs = processor(images=img, return_tensors="pt").to(device)
+def _compute_label_embeddings():
+    """Encode every aesthetic label prompt and L2-normalise the rows."""
+    text_inputs = processor(
+        text=[LABEL_PROMPT.format(label) for label in AESTHETIC_LABELS],
+        return_tensors="pt",
+        padding=True,
+    ).to(model.device)
     with torch.no_grad():
-        emb = model.get_image_features(**inputs)
-    return emb.cpu().numpy()
+        text_features = model.get_text_features(**text_inputs)
+    text_features = text_features / text_features.norm(dim=-1, keepdim=True)
+    return text_features.cpu().numpy().astype(np.float32)
 
 
-def _tag_cluster(image_urls, top_k=4):
-    """Use CLIP zero-shot to find the best aesthetic tags for a group of images.
+def _load_label_embeddings():
+    """Return the (n_labels, dim) label matrix, reusing a persisted copy if present.
 
-    Loads a sample of images from the cluster, scores them against
-    AESTHETIC_LABELS, and returns the top_k labels.
+    The file name includes a hash of the model name, prompt and labels, so
+    changing any of them never picks up a stale matrix.
     """
-    # Sample up to 6 images to keep tagging fast
-    sample = image_urls[:6]
-    images = []
-    for url in sample:
+    if not LABEL_EMBEDDINGS_DIR:
+        return _compute_label_embeddings()
+
+    digest = hashlib.sha256(
+        "\n".join([_model_id(), LABEL_PROMPT, *AESTHETIC_LABELS]).encode()
+    ).hexdigest()[:16]
+    slug = re.sub(r"[^A-Za-z0-9_.-]+", "_", _model_id())
+    path = os.path.join(LABEL_EMBEDDINGS_DIR, f"{slug}-labels-{digest}.npy")
+    try:
+        return np.load(path)
+    except (OSError, ValueError):
+        pass
+
+    label_embeddings = _compute_label_embeddings()
+    os.makedirs(LABEL_EMBEDDINGS_DIR, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, label_embeddings)
+    os.replace(tmp_path, path)
+    return label_embeddings
+
+
+def _memory_mb():
+    """Resident (RSS) and proportional (PSS) memory of this process in MB.
+
+    PSS splits shared pages between the processes mapping them, so it shows
+    what a prefork child really costs once the weights are shared.
+    """
+    usage = {}
+    for path, field, key in (
+        ("/proc/self/status", "VmRSS:", "rss_mb"),
+        ("/proc/self/smaps_rollup", "Pss:", "pss_mb"),
+    ):
         try:
-            resp = requests.get(_resolve_url(url), timeout=15)
-            resp.raise_for_status()
-            images.append(
-                Image.open(io.BytesIO(resp.content)).convert("RGB")
+            with open(path) as f:
+                for line in f:
+                    if line.startswith(field):
+                        usage[key] = round(int(line.split()[1]) / 1024, 1)
+                        break
+        except OSError:
+            pass
+    return usage
+
+
+def _model_id():
+    """Checkpoint name plus inference backend, since their embeddings differ."""
+    if inference is not None and inference.model_id:
+        return inference.model_id  # whatever the server runs
+    if INFERENCE_BACKEND == "fp32":
+        return CLIP_MODEL_NAME
+    return f"{CLIP_MODEL_NAME}@{INFERENCE_BACKEND}"
+
+
+def quantize_model(clip_model):
+    """Return ``clip_model`` with its linear layers dynamically quantized to int8.
+
+    Weights are stored as int8 and activations quantized on the fly, which
+    speeds up the transformer's matmuls on CPU at a small accuracy cost.
+    """
+    return torch.ao.quantization.quantize_dynamic(
+        clip_model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+
+
+def _load_clip():
+    """Load the CLIP weights, processor and label embeddings into this process."""
+    global model, processor, label_embeddings
+
+    if INFERENCE_BACKEND not in INFERENCE_BACKENDS:
+        raise ValueError(
+            f"INFERENCE_BACKEND must be one of {INFERENCE_BACKENDS}, got {INFERENCE_BACKEND!r}"
+        )
+    model = CLIPModel.from_pretrained(CLIP_MODEL_NAME).eval()
+    model.requires_grad_(False)
+    if INFERENCE_BACKEND == "int8":
+        model = quantize_model(model)
+    processor = CLIPProcessor.from_pretrained(CLIP_MODEL_NAME)
+    # The vocabulary never changes, so encode it once per worker
+    label_embeddings = _load_label_embeddings()
+
+
+def load_model(move_to_device=True):
+    """Load CLIP, the label embeddings and the embedding cache (idempotent).
+
+    With INFERENCE_SERVER set to a socket path, no weights are loaded:
+    images are embedded by the node's inference server, which also
+    provides the label embeddings.
+
+    Weights are always loaded on the CPU first. Pass
+    ``move_to_device=False`` before forking: CUDA cannot be initialised in
+    a parent process, so each child moves the weights itself.
+    """
+    global inference, label_embeddings, embedding_cache
+
+    if model is None and inference is None:
+        started = time.perf_counter()
+        if INFERENCE_SERVER and INFERENCE_SERVER != "local":
+            inference = InferenceClient(INFERENCE_SERVER)
+            label_embeddings = inference.info()["label_embeddings"]
+        else:
+            _load_clip()
+            if INFERENCE_SERVER == "local":
+                inference = LocalInference(embed_locally)
+        # Set EMBEDDING_CACHE_DIR to an empty string to disable the cache. It
+        # is named after the decode size too, which changes what the model sees
+        if EMBEDDING_CACHE_DIR:
+            embedding_cache = EmbeddingCache(
+                EMBEDDING_CACHE_DIR, f"{_model_id()}@decode{DECODE_MIN_SIDE}", _embedding_dim(),
+                swatch_pixels=SWATCH_PIXELS if KEEP_SWATCHES else 0,
             )
+        startup_stats["model_load_seconds"] = round(time.perf_counter() - started, 3)
+        startup_stats["loaded_in_pid"] = os.getpid()
+        print(
+            f"Loaded {_model_id()} in {startup_stats['model_load_seconds']}s "
+            f"(pid {os.getpid()}, {_memory_mb()})"
+        )
+
+    if move_to_device and model is not None and model.device.type != device:
+        model.to(device)
+
+
+def _embedding_dim():
+    """Length of the image embeddings, from the local model or the server."""
+    if model is not None:
+        return model.config.projection_dim
+    return inference.info()["dim"]
+
+
+@worker_init.connect
+def _preload_model(**kwargs):
+    if MODEL_LOAD != "preload":
+        return
+    # Use a single thread so no OpenMP pool exists in the parent when it forks
+    threads = torch.get_num_threads()
+    torch.set_num_threads(1)
+    try:
+        load_model(move_to_device=False)
+    finally:
+        torch.set_num_threads(threads)
+    # Keep the garbage collector from touching (and so copying) shared pages
+    gc.freeze()
+
+
+@worker_init.connect
+def _start_metrics_exporter(**kwargs):
+    if METRICS_PORT:
+        start_exporter(METRICS_PORT)
+
+
+@worker_process_init.connect
+def _report_child_startup(**kwargs):
+    if MODEL_LOAD == "preload":
+        load_model()
+    print(f"Worker process {os.getpid()} ready ({MODEL_LOAD} model load, {_memory_mb()})")
+
+
+def _embed_images(images, timer=None):
+    """Return CLIP embeddings for a list of decoded images, one row per image."""
+    timer = timer or StageTimer()
+    if inference is not None:
+        # Preprocessing runs batched on the server too
+        with timer.time("inference", items=len(images)):
+            return inference.embed(images)
+    return embed_locally(images, timer)
+
+
+def embed_locally(images, timer=None):
+    """Embed decoded images with this process's own model."""
+    timer = timer or StageTimer()
+    with timer.time("preprocess", items=len(images)):
+        inputs = processor(images=images, return_tensors="pt").to(device)
+    with timer.time("inference", items=len(images)), torch.no_grad():
+        emb = model.get_image_features(**inputs)
+        emb = emb.cpu().numpy()
+    return emb
+
+
+def _fingerprint(img):
+    """``(swatch, hash)`` of a decoded image, each None when nothing uses it."""
+    return (
+        swatch(img) if KEEP_SWATCHES else None,
+        dhash(img) if DEDUP_HASH_DISTANCE > 0 else None,
+    )
+
+
+def _cached_fingerprint(key):
+    """``(swatch, hash)`` stored with a cached embedding, or None if one is missing."""
+    colors = embedding_cache.get_swatch(key)
+    h = embedding_cache.get_dhash(key)
+    if (KEEP_SWATCHES and colors is None) or (DEDUP_HASH_DISTANCE > 0 and h is None):
+        return None
+    return colors, h
+
+
+def _load_for_embedding(url, timer=None):
+    """Fetch one image for embedding, short-circuiting through the cache.
+
+    Returns ``(embedding, image, key, validator, swatch, hash)``. On a
+    cache hit ``embedding`` is set and ``image`` is None; otherwise
+    ``image`` is the decoded image and ``key``/``validator`` are what to
+    store it under. ``swatch`` is the image's colour sample and ``hash``
+    its difference hash, for palettes and duplicate detection (None when
+    those are off). They come from the decoded image or the cache; a hit
+    cached without them is decoded once to fill them in. A URL we have
+    seen before is revalidated with a HEAD request, so an unchanged image
+    is not downloaded at all.
+    """
+    timer = timer or StageTimer()
+    if embedding_cache is None:
+        with timer.time("download"):
+            data = fetch_bytes(url)
+        with timer.time("decode"):
+            img = decode_image(data)
+            return (None, img, None, None, *_fingerprint(img))
+
+    if embedding_cache.known_validators(url):
+        try:
+            with timer.time("download", items=0):  # a HEAD, not an image
+                validator = fetch_validator(url)
         except Exception:
-            continue
+            validator = None  # e.g. HEAD not allowed; fall back to a full download
+        key = embedding_cache.alias_key(url, validator) if validator else None
+        emb = embedding_cache.get(key) if key else None
+        cached = _cached_fingerprint(key) if emb is not None else None
+        if cached is not None:
+            return (emb, None, key, validator, *cached)
 
-    if not images:
-        return []
+    with timer.time("download"):
+        data, validator = fetch(url)
+    key = content_key(data)
+    emb = embedding_cache.get(key)
+    if emb is not None:
+        embedding_cache.add_alias(url, validator, key)
+        cached = _cached_fingerprint(key)
+        if cached is not None:
+            return (emb, None, key, validator, *cached)
+    with timer.time("decode"):
+        img = decode_image(data)
+        colors, h = _fingerprint(img)
+    if emb is not None:
+        embedding_cache.put(key, emb, url=url, validator=validator, swatch=colors, dhash=h)
+        return emb, None, key, validator, colors, h
+    return None, img, key, validator, colors, h
 
-    text_inputs = processor(
-        text=[f"a photo that is {label}" for label in AESTHETIC_LABELS],
-        return_tensors="pt",
-        padding=True,
-    ).to(device)
-    image_inputs = processor(images=images, return_tensors="pt").to(device)
 
-    with torch.no_grad():
-        image_features = model.get_image_features(**image_inputs)
-        text_features = model.get_text_features(**text_inputs)
+def _allocate_rows(n_rows, dim):
+    """A float32 (n_rows, dim) array, disk-backed past EMBED_MEMMAP_THRESHOLD rows.
 
-    # Normalise and compute similarities
-    image_features = image_features / image_features.norm(dim=-1, keepdim=True)
-    text_features = text_features / text_features.norm(dim=-1, keepdim=True)
+    The memmap lives in an unlinked temporary file, so it is cleaned up as
+    soon as the array is garbage collected.
+    """
+    if n_rows <= EMBED_MEMMAP_THRESHOLD:
+        return np.empty((n_rows, dim), dtype=np.float32)
+    return np.memmap(
+        tempfile.TemporaryFile(dir=EMBED_MEMMAP_DIR),
+        dtype=np.float32,
+        mode="w+",
+        shape=(n_rows, dim),
+    )
 
-    # Average similarity across all images in the cluster
-    similarities = (image_features @ text_features.T).mean(dim=0)
-    top_indices = similarities.topk(top_k).indices.tolist()
-    return [AESTHETIC_LABELS[i] for i in top_indices]
 
+class _Progress:
+    """Publishes a job's progress as PROGRESS task state metadata.
+
+    Counts images downloaded, embedded and failed, and derives throughput
+    and an ETA from them. Publishing is throttled to once every
+    PROGRESS_INTERVAL seconds, except on stage changes.
+    """
+
+    def __init__(self, task_id, total):
+        self.task_id = task_id
+        self.total = total
+        self.stage = "embedding"
+        self.counts = {"downloaded": 0, "embedded": 0, "failed": 0}
+        self._started = time.monotonic()
+        self._published = 0.0
+
+    def add(self, **counts):
+        for key, value in counts.items():
+            self.counts[key] += value
+        self.publish()
 
-@app.task(name="tasks.cluster_images")
-def cluster_images(image_urls, n_clusters=5):
-    """Cluster images by visual similarity and tag each cluster with aesthetics."""
-    embeddings = []
+    def set_stage(self, stage):
+        self.stage = stage
+        self.publish(force=True)
+
+    def elapsed(self):
+        return time.monotonic() - self._started
+
+    def snapshot(self):
+        counts = self.current_counts()
+        elapsed = self.elapsed()
+        rate = counts["embedded"] / elapsed if elapsed > 0 else 0.0
+        remaining = max(0, self.total - counts["embedded"] - counts["failed"])
+        return {
+            "stage": self.stage,
+            "total": self.total,
+            **counts,
+            "elapsed_seconds": round(elapsed, 1),
+            "images_per_second": round(rate, 2),
+            "eta_seconds": round(remaining / rate, 1) if rate > 0 and remaining else None,
+        }
+
+    def current_counts(self):
+        return self.counts
+
+    def publish(self, force=False):
+        if not self.task_id:
+            return  # called directly rather than as a task
+        now = time.monotonic()
+        if not force and now - self._published < PROGRESS_INTERVAL:
+            return
+        self._published = now
+        try:
+            app.backend.store_result(self.task_id, self.snapshot(), "PROGRESS")
+        except Exception as e:
+            print(f"Could not publish progress for {self.task_id} ({e})")
+
+
+class _ChunkProgress(_Progress):
+    """Progress for one embed_chunk of a fanned-out job.
+
+    Counts are summed across all chunks in a Redis hash, so each chunk
+    publishes the whole job's progress under the job's own task id. The
+    hash also holds the job's start time, set by whichever chunk (or the
+    fanning-out task) gets there first, so throughput and ETA cover the
+    whole job even for chunks that start late. With a non-Redis result
+    backend, or once Redis fails, each chunk reports only its own counts
+    and time.
+    """
+
+    def __init__(self, job_id, total):
+        super().__init__(job_id, total)
+        self._client = None
+        self._key = f"visionboard-progress:{job_id}"
+        self._job_started = None
+        if not isinstance(app.backend, RedisBackend):
+            return
+        try:
+            self._client = app.backend.client
+            pipe = self._client.pipeline()
+            pipe.hsetnx(self._key, "started", time.time())
+            pipe.hget(self._key, "started")
+            pipe.expire(self._key, 86400)
+            _, started, _ = pipe.execute()
+            self._job_started = float(started)
+        except Exception as e:
+            self._unshare(e)
+
+    def _unshare(self, e):
+        """Fall back to this chunk's own counts; progress is not worth failing the chunk."""
+        print(f"Could not share progress for {self.task_id} ({e}); reporting this chunk only")
+        self._client = None
+        self._job_started = None
+
+    def elapsed(self):
+        if self._job_started is None:
+            return super().elapsed()
+        return max(0.0, time.time() - self._job_started)
+
+    def add(self, **counts):
+        if self._client is not None:
+            try:
+                pipe = self._client.pipeline()
+                for key, value in counts.items():
+                    pipe.hincrby(self._key, key, value)
+                pipe.expire(self._key, 86400)
+                pipe.execute()
+            except Exception as e:
+                self._unshare(e)
+        super().add(**counts)
+
+    def current_counts(self):
+        if self._client is None:
+            return self.counts
+        try:
+            stored = self._client.hgetall(self._key)
+        except Exception as e:
+            self._unshare(e)
+            return self.counts
+        counts = {key: 0 for key in self.counts}
+        for key, value in stored.items():
+            key = key.decode() if isinstance(key, bytes) else key
+            if key in counts:
+                counts[key] = min(int(value), self.total)  # retried chunks count twice
+        return counts
+
+
+def _get_image_embeddings(
+    image_urls, batch_size=EMBED_BATCH_SIZE, progress=None, timer=None, duplicates=None,
+    swatches=None, hashes=None,
+):
+    """Download and embed images in batches.
+
+    A streaming pipeline: downloads and decodes run concurrently on the
+    fetch pool with a bounded prefetch window, each full batch is embedded
+    and written straight into a preallocated matrix, and its decoded
+    images are dropped. Memory is therefore flat in the number of images
+    (the matrix itself goes to disk for very large jobs). Images already
+    in the embedding cache are not embedded again, and neither are
+    near-identical copies of an earlier image when a ``duplicates``
+    collector is given (they are recorded there instead of returned).
+    Cache hits are checked for duplicates too, from the hash and swatch
+    cached with them, so the groups found do not depend on what is cached.
+    The colour swatch and difference hash of each returned image are put
+    in the ``swatches`` and ``hashes`` dicts, if given, under its URL. Images that fail to download or decode
+    are logged and skipped; the rest of their batch is still embedded. A
+    batch that fails to embed is retried one image at a time, and the
+    images that still fail are skipped along with their duplicates.
+
+    Returns the list of URLs that were embedded, the matching (n, dim)
+    embedding matrix (None if nothing could be embedded) and a dict of
+    cache hit/miss counts. Counts are reported to ``progress`` and stage
+    timings to ``timer`` if given.
+    """
+    batch_size = max(1, int(batch_size))
+    progress = progress or _Progress(None, len(image_urls))
+    timer = timer or StageTimer()
+    X = _allocate_rows(len(image_urls), _embedding_dim())
     valid_urls = []
+    batch = []
+    stats = {"hits": 0, "misses": 0}
+
+    failed = set()
 
-    for url in image_urls:
+    def flush():
         try:
-            emb = _get_image_embedding(url)
-            embeddings.append(emb)
-            valid_urls.append(url)
+            embeddings = _embed_images([img for _, img, _, _, _, _ in batch], timer)
         except Exception as e:
-            print(f"Skipping invalid URL: {url} ({e})")
+            # Find the image at fault by embedding the batch one at a time
+            print(f"Embedding a batch of {len(batch)} images failed ({e}); retrying one by one")
+            embeddings = []
+            for row, img, _, _, _, _ in batch:
+                try:
+                    embeddings.append(_embed_images([img], timer)[0])
+                except Exception as e:
+                    print(f"Skipping image that could not be embedded: {valid_urls[row]} ({e})")
+                    embeddings.append(None)
+                    failed.add(row)
+        for (row, _, key, validator, colors, h), emb in zip(batch, embeddings):
+            if emb is None:
+                progress.add(failed=1)
+                continue
+            X[row] = emb
+            if embedding_cache is not None:
+                embedding_cache.put(
+                    key, emb, url=valid_urls[row], validator=validator, swatch=colors, dhash=h
+                )
+            progress.add(embedded=1)
+        batch.clear()
 
-    if not embeddings:
-        return {"error": "no valid images"}
+    load = partial(_load_for_embedding, timer=timer)
+    results = fetch_many(image_urls, load, prefetch=batch_size * 2)
+    for url, loaded, error in results:
+        if error is not None:
+            print(f"Skipping invalid URL: {url} ({error})")
+            progress.add(failed=1)
+            continue
+        emb, img, key, validator, colors, h = loaded
+        if duplicates is not None:
+            with timer.time("dedup"):
+                is_duplicate = duplicates.check(url, img, colors, h)
+            if is_duplicate:
+                progress.add(downloaded=1, embedded=1)
+                continue
+        row = len(valid_urls)
+        valid_urls.append(url)
+        if swatches is not None and colors is not None:
+            swatches[url] = colors
+        if hashes is not None and h is not None:
+            hashes[url] = h
+        if emb is not None:
+            X[row] = emb
+            stats["hits"] += 1
+            progress.add(downloaded=1, embedded=1)
+            continue
+        progress.add(downloaded=1)
+        stats["misses"] += 1
+        batch.append((row, img, key, validator, colors, h))
+        if len(batch) >= batch_size:
+            flush()
+
+    if batch:
+        flush()
+
+    if failed:
+        lost = {valid_urls[row] for row in failed}
+        keep = [row for row in range(len(valid_urls)) if row not in failed]
+        X = _take_rows(X, keep)
+        valid_urls = [valid_urls[row] for row in keep]
+        for found in (swatches, hashes):
+            for url in lost & set(found or ()):
+                del found[url]
+        if duplicates is not None:
+            # Copies of a skipped image have nothing left to join
+            duplicates.of = {
+                url: original for url, original in duplicates.of.items() if original not in lost
+            }
+
+    if not valid_urls:
+        return valid_urls, None, stats
+    return valid_urls, X[:len(valid_urls)], stats
+
+
+def _read_manifest(manifest_url):
+    """Fetch a stored manifest of image URLs, one per line."""
+    text = str(fetch_bytes(manifest_url), "utf-8")
+    return [line.strip() for line in text.splitlines() if line.strip()]
+
+
+def _tag_cluster(embeddings, centroid=None, top_k=4, sample_size=TAG_SAMPLE_SIZE):
+    """Use CLIP zero-shot to find the best aesthetic tags for a group of images.
+
+    Scores the cluster's already computed image embeddings against
+    AESTHETIC_LABELS and returns the top_k labels, so tagging needs no
+    extra downloads or forward passes. Uses the ``sample_size`` members
+    closest to the centroid, or the centroid alone when ``sample_size``
+    is 0.
+    """
+    if len(embeddings) == 0:
+        return []
 
-    X = np.vstack(embeddings)
+    if centroid is None:
+        centroid = embeddings.mean(axis=0)
+
+    if sample_size > 0:
+        distances = np.linalg.norm(embeddings - centroid, axis=1)
+        image_features = embeddings[np.argsort(distances, kind="stable")[:sample_size]]
+    else:
+        image_features = centroid[np.newaxis, :]
+
+    image_features = image_features / np.linalg.norm(image_features, axis=1, keepdims=True)
+
+    # Average similarity across the sampled images
+    similarities = (image_features @ label_embeddings.T).mean(axis=0)
+    top_indices = np.argsort(-similarities, kind="stable")[:top_k]
+    return [AESTHETIC_LABELS[i] for i in top_indices]
+
+
+def _normalize(X):
+    """L2-normalise rows so Euclidean distance tracks cosine similarity.
+
+    Large inputs are normalised in chunks into a matrix from
+    _allocate_rows(), so a memmapped job never gets a full in-memory copy.
+    """
+    if len(X) <= EMBED_MEMMAP_THRESHOLD:
+        return X / np.maximum(np.linalg.norm(X, axis=1, keepdims=True), 1e-12)
+
+    out = _allocate_rows(len(X), X.shape[1])
+    for start in range(0, len(X), EMBED_MEMMAP_THRESHOLD):
+        chunk = np.asarray(X[start:start + EMBED_MEMMAP_THRESHOLD])
+        out[start:start + len(chunk)] = chunk / np.maximum(
+            np.linalg.norm(chunk, axis=1, keepdims=True), 1e-12
+        )
+    return out
+
+
+def _choose_k(X, k_max=AUTO_K_MAX, sample_size=AUTO_K_SAMPLE):
+    """Pick k by the silhouette score of a fixed-size sample.
+
+    Each candidate k is fitted and scored on the same random sample of at
+    most ``sample_size`` normalised rows, so the cost does not grow with
+    the job. Returns ``(k, silhouette)``; when no k splits the sample at
+    all (e.g. every embedding is the same) that is ``(1, None)``.
+    """
+    n = len(X)
+    if n < 3:
+        return 1, None
+
+    rng = np.random.default_rng(42)
+    sample = X if n <= sample_size else X[rng.choice(n, sample_size, replace=False)]
+    sample = _normalize(sample)
+
+    best_k, best_score = 1, None
+    for k in range(2, min(k_max, len(sample) - 1) + 1):
+        labels = MiniBatchKMeans(
+            n_clusters=k, random_state=42, n_init=3, batch_size=MINIBATCH_SIZE
+        ).fit_predict(sample)
+        if len(np.unique(labels)) < 2:
+            continue
+        score = silhouette_score(sample, labels)
+        if best_score is None or score > best_score:
+            best_k, best_score = k, score
+    if best_score is None:
+        return best_k, None
+    return best_k, round(float(best_score), 4)
+
+
+def _cluster_embeddings(X, n_clusters, algorithm=CLUSTER_ALGORITHM):
+    """Cluster the embedding rows.
+
+    ``n_clusters`` may be "auto" to choose k with _choose_k(). Returns
+    ``(labels, centroids, info)``: centroids are member means in the space
+    of ``X``, cluster ids are contiguous from 0 (empty clusters are
+    dropped) and ``info`` describes the run for the result metadata.
+    """
+    info = {}
+    if n_clusters == "auto":
+        n_clusters, silhouette = _choose_k(X)
+        if silhouette is not None:
+            info["silhouette"] = silhouette
 
     # Don't request more clusters than we have images
-    k = min(n_clusters, len(valid_urls))
-    labels = KMeans(n_clusters=k, random_state=42, n_init="auto").fit_predict(X)
+    k = min(n_clusters, len(X))
+    if algorithm == "auto":
+        algorithm = "minibatch" if len(X) > MINIBATCH_THRESHOLD else "kmeans"
+
+    if algorithm == "minibatch":
+        labels = MiniBatchKMeans(
+            n_clusters=k, random_state=42, n_init=3, batch_size=MINIBATCH_SIZE
+        ).fit_predict(_normalize(X))
+    elif algorithm == "kmeans":
+        labels = KMeans(n_clusters=k, random_state=42, n_init="auto").fit_predict(X)
+    else:
+        raise ValueError(f"Unknown CLUSTER_ALGORITHM {algorithm!r}")
+
+    used, labels = np.unique(labels, return_inverse=True)
+    centers = np.zeros((len(used), X.shape[1]), dtype=np.float64)
+    np.add.at(centers, labels, X)
+    centers /= np.bincount(labels)[:, np.newaxis]
+
+    info.update({"algorithm": algorithm, "k": len(used)})
+    return labels, centers, info
+
+
+def _assign_to_clusters(X, centers, counts, distance_threshold):
+    """Assign new embedding rows to existing clusters one at a time.
+
+    Each row joins its nearest centroid by cosine distance, which then
+    moves to the running mean of its members; a row further than
+    ``distance_threshold`` from every centroid starts a new cluster that
+    later rows may join. Returns ``(labels, centers)``.
+    """
+    centers = np.array(centers, dtype=np.float64)
+    counts = np.array(counts, dtype=np.int64)
+    labels = np.empty(len(X), dtype=np.int64)
+
+    for i, emb in enumerate(X):
+        distances = 1.0 - _normalize(centers) @ (emb / max(np.linalg.norm(emb), 1e-12))
+        best = int(np.argmin(distances))
+        if distances[best] > distance_threshold:
+            centers = np.vstack([centers, emb])
+            counts = np.append(counts, 1)
+            best = len(centers) - 1
+        else:
+            counts[best] += 1
+            centers[best] += (emb - centers[best]) / counts[best]
+        labels[i] = best
+
+    return labels, centers
+
+
+def _embedding_ref(job_id, rows):
+    """Where the backend finds the embeddings of ``rows`` in a job's stored state.
+
+    Consecutive rows are merged into ``[start, stop)`` ranges, so a
+    cluster stored in one block costs a few bytes however large it is.
+    """
+    ranges = []
+    for row in (int(row) for row in rows):
+        if ranges and ranges[-1][1] == row:
+            ranges[-1][1] = row + 1
+        else:
+            ranges.append([row, row + 1])
+    return {"job_id": job_id, "rows": ranges}
+
+
+def _take_rows(X, rows):
+    """``X[rows]`` into a matrix from _allocate_rows(), copied chunk by chunk."""
+    out = _allocate_rows(len(rows), X.shape[1])
+    for start in range(0, len(rows), EMBED_MEMMAP_THRESHOLD):
+        chunk = rows[start:start + EMBED_MEMMAP_THRESHOLD]
+        out[start:start + len(chunk)] = X[chunk]
+    return out
+
 
-    # Group URLs by cluster
-    clusters = {int(c): [] for c in range(k)}
-    for i, label in enumerate(labels):
-        clusters[int(label)].append(valid_urls[i])
+def _palette(urls, swatches):
+    """Dominant colours of the images at ``urls``, from their stored swatches."""
+    pixels = [swatches[url] for url in urls if url in swatches]
+    if not pixels:
+        return []
+    return dominant_colors(np.concatenate(pixels))
+
+
+def _cluster_and_tag(
+    job_id, valid_urls, X, n_clusters, tag_sample_size, meta, progress, timer, duplicates=None,
+    swatches=None,
+):
+    """Cluster embedded images, store the job state and build the task result.
+
+    ``duplicates`` maps URLs that were not embedded to the URL of the
+    near-identical image they copy. Rows of ``X`` that are near-identical
+    to an earlier row are collapsed too; only the remaining images are
+    clustered and tagged, and every duplicate is then listed in its
+    original's cluster. Each cluster's colour palette comes from the
+    ``swatches`` of its images.
+    """
+    swatches = swatches or {}
+    duplicates = dict(duplicates or {})
+    hash_duplicates = len(duplicates)
+    progress.set_stage("clustering")
+    with timer.time("dedup", items=len(X)):
+        representative = embedding_duplicates(X)
+    unique = np.flatnonzero(representative == np.arange(len(X)))
+    if len(unique) < len(X):
+        for row in np.flatnonzero(representative != np.arange(len(X))):
+            duplicates[valid_urls[row]] = valid_urls[representative[row]]
+        X = _take_rows(X, unique)
+        valid_urls = [valid_urls[i] for i in unique]
+
+    with timer.time("kmeans", items=len(X)):
+        labels, centers, cluster_info = _cluster_embeddings(X, n_clusters)
+
+    # Stored cluster by cluster, so each cluster's rows are one block of the state
+    order = np.argsort(labels, kind="stable")
+    if np.any(order != np.arange(len(order))):
+        X = _take_rows(X, order)
+        valid_urls = [valid_urls[i] for i in order]
+        labels = labels[order]
 
-    # Tag each cluster with aesthetic keywords
+    if job_id:
+        # Kept so images can later be added with tasks.add_to_clusters
+        save_job_state(job_id, valid_urls, X, labels, centers, copies=duplicates)
+
+    # Each duplicate joins its original's cluster, sharing its embedding
+    row_of = {url: row for row, url in enumerate(valid_urls)}
+    attached = [[] for _ in range(len(centers))]
+    for url, original in duplicates.items():
+        while original not in row_of:
+            original = duplicates[original]
+        row = row_of[original]
+        attached[labels[row]].append((url, row))
+
+    # Group URLs by cluster and tag each one from its members' embeddings
+    progress.set_stage("tagging")
     result = {}
-    for cluster_id, urls in clusters.items():
-        tags = _tag_cluster(urls)
-        result[cluster_id] = {
-            "images": urls,
-            "tags": tags,
+    with timer.time("tagging", items=len(centers)):
+        for cluster_id in range(len(centers)):
+            members = np.flatnonzero(labels == cluster_id)
+            rows = np.concatenate([members, [row for _, row in attached[cluster_id]]]).astype(int)
+            result[cluster_id] = {
+                "images": [valid_urls[i] for i in members] + [url for url, _ in attached[cluster_id]],
+                "tags": _tag_cluster(
+                    np.asarray(X[members]),
+                    centroid=centers[cluster_id],
+                    sample_size=tag_sample_size,
+                ),
+            }
+            if job_id:
+                # Rows match "images"; the backend loads them from the job
+                # state for similarity search, keeping the result small
+                result[cluster_id]["embeddings"] = _embedding_ref(job_id, rows)
+    with timer.time("palette", items=len(centers)):
+        for cluster_id in range(len(centers)):
+            result[cluster_id]["palette"] = _palette(result[cluster_id]["images"], swatches)
+
+    result["meta"] = {
+        **meta,
+        "clustering": cluster_info,
+        "dedup": {
+            "hash": hash_duplicates,
+            "embedding": len(duplicates) - hash_duplicates,
+        },
+        "timings": timer.summary(),
+        "worker": {"pid": os.getpid(), **startup_stats, **_memory_mb()},
+    }
+    return result
+
+
+@app.task(bind=True, name="tasks.cluster_images")
+def cluster_images(
+    self,
+    image_urls=None,
+    n_clusters=5,
+    batch_size=EMBED_BATCH_SIZE,
+    tag_sample_size=TAG_SAMPLE_SIZE,
+    manifest_url=None,
+    chunk_size=FANOUT_CHUNK_SIZE,
+):
+    """Cluster images by visual similarity and tag each cluster with aesthetics.
+
+    ``n_clusters`` is a positive integer or "auto" to pick it from the data.
+    Large jobs pass ``manifest_url`` (a stored text file with one image URL
+    per line) instead of ``image_urls``, keeping the task message small.
+
+    Jobs with more than ``chunk_size`` images are fanned out: this task is
+    replaced by a chord of embed_chunk tasks, which run in parallel on any
+    worker, and a reduce_embeddings task that clusters and tags. The chord
+    keeps this task's id, so callers track the job exactly as before. The
+    chunks are passed through JOB_STATE_DIR, so jobs are only fanned out
+    when it is configured to be shared.
+    """
+    if manifest_url:
+        image_urls = _read_manifest(manifest_url)
+
+    progress = _Progress(self.request.id, len(image_urls))
+    fan_out = chunk_size and len(image_urls) > chunk_size
+    if fan_out and not JOB_STATE_SHARED:
+        # Another host could take a chunk or the reduce and miss the files
+        print(
+            f"Embedding {len(image_urls)} images in one task: fanning out needs "
+            "JOB_STATE_DIR set to a directory shared by every worker"
+        )
+        fan_out = False
+    if fan_out:
+        # Records the job's start time for the chunks' throughput and ETA
+        progress = _ChunkProgress(self.request.id, len(image_urls))
+        progress.set_stage("embedding")
+        chunks = [
+            image_urls[start:start + chunk_size]
+            for start in range(0, len(image_urls), chunk_size)
+        ]
+        chunk_options = {
+            "batch_size": batch_size,
+            "job_id": self.request.id,
+            "total": len(image_urls),
         }
+        return self.replace(
+            chord(
+                [embed_chunk.s(chunk, **chunk_options) for chunk in chunks],
+                reduce_embeddings.s(n_clusters=n_clusters, tag_sample_size=tag_sample_size),
+            )
+        )
+
+    progress.set_stage("loading model")
+    load_model()
+    progress.set_stage("embedding")
+    duplicates = Duplicates()
+    swatches = {}
+    with task_timer(self.name) as timer:
+        valid_urls, X, cache_stats = _get_image_embeddings(
+            image_urls, batch_size=batch_size, progress=progress, timer=timer,
+            duplicates=duplicates, swatches=swatches,
+        )
+
+        if X is None:
+            return {"error": "no valid images"}
+
+        return _cluster_and_tag(
+            self.request.id, valid_urls, X, n_clusters, tag_sample_size,
+            {"embedding_cache": cache_stats}, progress, timer, duplicates.of, swatches,
+        )
+
+
+@app.task(
+    name="tasks.embed_chunk",
+    autoretry_for=(Exception,),
+    retry_backoff=True,
+    max_retries=FANOUT_CHUNK_RETRIES,
+)
+def embed_chunk(image_urls, batch_size=EMBED_BATCH_SIZE, job_id=None, total=None):
+    """Embed one chunk of a fanned-out job.
+
+    Individual bad images are skipped as usual; any other failure retries
+    just this chunk. Progress is added to the job's (``job_id``) totals.
+    The embeddings, URLs, swatches and hashes are written to JOB_STATE_DIR, and
+    only the stored chunk's name and counts are returned, so the chord's
+    messages stay small however large the job is.
+    """
+    load_model()
+    progress = _ChunkProgress(job_id, total or len(image_urls)) if job_id else None
+    duplicates = Duplicates()
+    swatches = {}
+    hashes = {}
+    with task_timer(embed_chunk.name) as timer:
+        valid_urls, X, cache_stats = _get_image_embeddings(
+            image_urls, batch_size=batch_size, progress=progress, timer=timer,
+            duplicates=duplicates, swatches=swatches, hashes=hashes,
+        )
+    return {
+        "chunk": (
+            None if X is None
+            else save_chunk(job_id, valid_urls, X, duplicates.of, swatches, hashes)
+        ),
+        "images": len(valid_urls) + len(duplicates.of),
+        "rows": len(valid_urls),
+        "embedding_cache": cache_stats,
+        "timings": timer.summary(),
+    }
 
-    return result
\ No newline at end of file
+
+@app.task(bind=True, name="tasks.reduce_embeddings")
+def reduce_embeddings(self, chunk_results, n_clusters=5, tag_sample_size=TAG_SAMPLE_SIZE):
+    """Combine the stored embed_chunk results, then cluster and tag the whole job.
+
+    Each chunk's embeddings are copied from its memory-mapped file into
+    the job's matrix (itself disk-backed for large jobs). The chunk files
+    are deleted once the job is clustered; if that fails they are kept
+    until the expiry sweep, so the job can be inspected. Chunks only found the
+    near-duplicates within themselves, so their stored hashes and swatches
+    are checked again across chunks, as a single task would have.
+    """
+    load_model()
+    progress = _Progress(self.request.id, sum(chunk["images"] for chunk in chunk_results))
+    names = [chunk["chunk"] for chunk in chunk_results if chunk["chunk"] is not None]
+    cache_stats = {"hits": 0, "misses": 0}
+    valid_urls = []
+    duplicates = {}
+    swatches = {}
+
+    if not names:
+        return {"error": "no valid images"}
+
+    X = None
+    # Chunk timings go into the job's result, but the process totals
+    # (already counted by each embed_chunk) only get this task's stages
+    job_timer = StageTimer()
+    for chunk in chunk_results:
+        for key in cache_stats:
+            cache_stats[key] += chunk["embedding_cache"][key]
+        job_timer.merge(chunk["timings"])
+    across_chunks = Duplicates()
+    for name in names:
+        urls, embeddings, chunk_duplicates, chunk_swatches, chunk_hashes = load_chunk(name)
+        if X is None:
+            X = _allocate_rows(sum(chunk["rows"] for chunk in chunk_results), embeddings.shape[1])
+        keep = []
+        for row, url in enumerate(urls):
+            if url in chunk_hashes and url in chunk_swatches and across_chunks.check(
+                url, colors=chunk_swatches[url], h=chunk_hashes[url]
+            ):
+                continue  # a copy of an image in an earlier chunk
+            keep.append(row)
+        start = len(valid_urls)
+        X[start:start + len(keep)] = embeddings[keep]
+        valid_urls.extend(urls[row] for row in keep)
+        duplicates.update(chunk_duplicates)
+        swatches.update(chunk_swatches)
+    duplicates.update(across_chunks.of)
+    X = X[:len(valid_urls)]
+    progress.counts.update(downloaded=progress.total, embedded=progress.total)
+
+    with task_timer(self.name) as timer:
+        result = _cluster_and_tag(
+            self.request.id, valid_urls, X, n_clusters, tag_sample_size,
+            {"embedding_cache": cache_stats, "chunks": len(names)}, progress, timer,
+            duplicates, swatches,
+        )
+    # Only once the job succeeded; the chunks of a failed one are left for
+    # inspection until the expiry sweep removes them
+    for name in names:
+        remove_chunk(name)
+    job_timer.merge(timer.summary())
+    result["meta"]["timings"] = job_timer.summary()
+    return result
+
+
+@app.task(bind=True, name="tasks.add_to_clusters")
+def add_to_clusters(
+    self,
+    job_id,
+    image_urls,
+    distance_threshold=NEW_CLUSTER_DISTANCE,
+    batch_size=EMBED_BATCH_SIZE,
+    tag_sample_size=TAG_SAMPLE_SIZE,
+):
+    """Add images to a finished cluster_images job without re-clustering it.
+
+    Only the new images are embedded; each is assigned to the nearest
+    existing cluster, or starts a new one past ``distance_threshold``.
+    The result lists, per cluster that received images, just the added
+    URLs, the cluster's tags and whether the cluster is new. Near-identical
+    copies within the added images are not embedded and go with their
+    original. URLs already in the job are skipped.
+    """
+    known = job_state_urls(job_id)
+    if known is None:
+        return {"error": f"no stored clusters for job {job_id}"}
+    image_urls = [url for url in dict.fromkeys(image_urls) if url not in known]
+    if not image_urls:
+        return {"error": "no new images"}
+
+    progress = _Progress(self.request.id, len(image_urls))
+    progress.set_stage("loading model")
+    load_model()
+    progress.set_stage("embedding")
+    duplicates = Duplicates()
+    swatches = {}
+    with task_timer(self.name) as timer:
+        new_urls, X_new, cache_stats = _get_image_embeddings(
+            image_urls, batch_size=batch_size, progress=progress, timer=timer,
+            duplicates=duplicates, swatches=swatches,
+        )
+
+        if X_new is None:
+            return {"error": "no valid images"}
+
+        progress.set_stage("clustering")
+        with job_state_lock(job_id):
+            state = load_job_state(job_id)
+            if state is None:
+                return {"error": f"no stored clusters for job {job_id}"}
+            urls, X, labels, centers, stored_copies = state
+
+            # Another add to this job may have stored some of them meanwhile
+            known = set(urls) | set(stored_copies)
+            keep = [row for row, url in enumerate(new_urls) if url not in known]
+            if len(keep) < len(new_urls):
+                X_new = X_new[keep]
+                new_urls = [new_urls[row] for row in keep]
+                kept = set(new_urls)
+                duplicates.of = {
+                    url: original for url, original in duplicates.of.items()
+                    if url not in known and original in kept
+                }
+            if not new_urls:
+                return {"error": "no new images"}
+
+            n_existing = len(centers)
+            counts = np.bincount(labels, minlength=n_existing)
+            with timer.time("kmeans", items=len(X_new)):
+                new_labels, centers = _assign_to_clusters(X_new, centers, counts, distance_threshold)
+
+            # Appended cluster by cluster, as in _cluster_and_tag
+            order = np.argsort(new_labels, kind="stable")
+            X_new = np.asarray(X_new)[order]
+            new_urls = [new_urls[i] for i in order]
+            new_labels = new_labels[order]
+            first_row = len(urls)
+
+            X = np.vstack([X, X_new])
+            labels = np.concatenate([labels, new_labels])
+            save_job_state(
+                job_id, urls + new_urls, X, labels, centers, copies=stored_copies + list(duplicates.of)
+            )
+
+        row_of = {url: row for row, url in enumerate(new_urls)}
+        copies = np.array([row_of[original] for original in duplicates.of.values()], dtype=int)
+        copy_urls = list(duplicates.of)
+
+        progress.set_stage("tagging")
+        result = {}
+        touched = np.unique(new_labels)
+        with timer.time("tagging", items=len(touched)):
+            for cluster_id in touched:
+                added = np.flatnonzero(new_labels == cluster_id)
+                copied = np.flatnonzero(new_labels[copies] == cluster_id)
+                added_urls = [new_urls[i] for i in added] + [copy_urls[i] for i in copied]
+                result[int(cluster_id)] = {
+                    "images": added_urls,
+                    "tags": _tag_cluster(
+                        X[labels == cluster_id],
+                        centroid=centers[cluster_id],
+                        sample_size=tag_sample_size,
+                    ),
+                    "new": bool(cluster_id >= n_existing),
+                    "embeddings": _embedding_ref(
+                        job_id, first_row + np.concatenate([added, copies[copied]])
+                    ),
+                }
+        with timer.time("palette", items=len(touched)):
+            for cluster_id in touched:
+                # Of the added images only; the backend uses it for new boards
+                result[int(cluster_id)]["palette"] = _palette(
+                    result[int(cluster_id)]["images"], swatches
+                )
+
+        result["meta"] = {
+            "embedding_cache": cache_stats,
+            "incremental": {
+                "job_id": job_id,
+                "new_clusters": len(centers) - n_existing,
+            },
+            "dedup": {"hash": len(copy_urls), "embedding": 0},
+            "timings": timer.summary(),
+            "worker": {"pid": os.getpid(), **startup_stats, **_memory_mb()},
+        }
+        return result
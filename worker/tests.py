@@ -0,0 +1,791 @@
+import email.utils
+import itertools
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import AuthenticationError, Pipe
+from multiprocessing.connection import Client
+from unittest import mock
+
+import numpy as np
+from PIL import Image
+
+import fetch
+import inference_server
+import job_state
+import tasks
+from dedup import Duplicates, dhash
+from embedding_cache import EmbeddingCache
+from http_cache import HttpCache, freshness_lifetime
+
+
+def _image(rgb, size=64):
+    return Image.new("RGB", (size, size), rgb)
+
+
+def _gradient(tint=(1.0, 1.0, 1.0), size=64):
+    ramp = np.linspace(0, 255, size, dtype=np.float32)
+    pixels = np.stack([np.tile(ramp * t, (size, 1)) for t in tint], axis=2)
+    return Image.fromarray(pixels.astype(np.uint8))
+
+
+class DuplicatesTests(unittest.TestCase):
+    def test_flat_images_of_different_colours_are_not_merged(self):
+        red, blue = _image((220, 30, 30)), _image((30, 30, 220))
+        self.assertEqual(dhash(red), dhash(blue))
+
+        duplicates = Duplicates()
+        self.assertFalse(duplicates.check("red", red))
+        self.assertFalse(duplicates.check("blue", blue))
+        self.assertEqual(duplicates.of, {})
+
+    def test_recoloured_shot_is_not_merged(self):
+        grey, warm = _gradient(), _gradient((1.0, 0.6, 0.2))
+        self.assertEqual(dhash(grey), dhash(warm))
+
+        duplicates = Duplicates()
+        self.assertFalse(duplicates.check("grey", grey))
+        self.assertFalse(duplicates.check("warm", warm))
+        self.assertEqual(duplicates.of, {})
+
+    def test_near_identical_copy_is_merged(self):
+        original = _gradient()
+        copy = Image.fromarray(np.clip(np.asarray(original, dtype=np.int16) + 3, 0, 255).astype(np.uint8))
+
+        duplicates = Duplicates()
+        self.assertFalse(duplicates.check("a", original))
+        self.assertTrue(duplicates.check("b", copy))
+        self.assertEqual(duplicates.of, {"b": "a"})
+
+    def test_match_against_any_confirmed_candidate(self):
+        duplicates = Duplicates()
+        duplicates.check("red", _image((220, 30, 30)))
+        duplicates.check("blue", _image((30, 30, 220)))
+        self.assertTrue(duplicates.check("blue again", _image((32, 30, 218))))
+        self.assertEqual(duplicates.of, {"blue again": "blue"})
+
+
+class JobStateTests(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        patcher = mock.patch.object(job_state, "JOB_STATE_DIR", tmp.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _save(self, job_id):
+        job_state.save_job_state(
+            job_id, ["a", "b"], np.eye(2), np.array([0, 1]), np.eye(2), copies=["c"]
+        )
+
+    def test_state_lists_clustered_urls_and_copies(self):
+        self._save("job-1")
+        self.assertEqual(job_state.job_state_urls("job-1"), {"a", "b", "c"})
+        self.assertEqual(job_state.load_job_state("job-1")[4], ["c"])
+        self.assertIsNone(job_state.job_state_urls("job-2"))
+
+    def test_sweep_removes_expired_states_only(self):
+        self._save("old")
+        self._save("recent")
+        expired = time.time() - (job_state.JOB_STATE_TTL_DAYS + 1) * 86400
+        os.utime(os.path.join(job_state.JOB_STATE_DIR, "old.npz"), (expired, expired))
+
+        with mock.patch.object(job_state, "_last_sweep", 0.0):
+            job_state._sweep()
+        self.assertIsNone(job_state.load_job_state("old"))
+        self.assertIsNotNone(job_state.load_job_state("recent"))
+
+    def test_loading_a_state_renews_it(self):
+        self._save("job-1")
+        path = os.path.join(job_state.JOB_STATE_DIR, "job-1.npz")
+        os.utime(path, (0, 0))
+        job_state.load_job_state("job-1")
+        self.assertGreater(os.stat(path).st_mtime, time.time() - 60)
+
+    def test_chunk_round_trip_and_removal(self):
+        X = np.arange(6, dtype=np.float32).reshape(2, 3)
+        swatch = np.full((100, 3), 7, dtype=np.uint8)
+        name = job_state.save_chunk("job-1", ["a", "b"], X, {"c": "a"}, {"b": swatch}, {"a": 2 ** 64 - 1})
+
+        urls, embeddings, duplicates, swatches, hashes = job_state.load_chunk(name)
+        self.assertEqual(urls, ["a", "b"])
+        np.testing.assert_array_equal(embeddings, X)
+        self.assertEqual(duplicates, {"c": "a"})
+        np.testing.assert_array_equal(swatches["b"], swatch)
+        self.assertEqual(hashes, {"a": 2 ** 64 - 1})
+
+        job_state.remove_chunk(name)
+        self.assertEqual(os.listdir(os.path.join(job_state.JOB_STATE_DIR, "chunks")), [])
+
+    def test_chunk_names_cannot_escape_the_directory(self):
+        with self.assertRaises(ValueError):
+            job_state.load_chunk("../../etc")
+
+
+class EmbeddingCacheTests(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = tmp.name
+        # Strictly increasing timestamps, so LRU order never ties
+        patcher = mock.patch("embedding_cache.time.time", side_effect=itertools.count(1))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _cache(self, capacity, **kwargs):
+        return EmbeddingCache(self.root, "model/x", 4, capacity=capacity, **kwargs)
+
+    def _vector(self, value):
+        return np.full(4, value, dtype=np.float32)
+
+    def test_put_and_get(self):
+        cache = self._cache(4)
+        cache.put("a", self._vector(1))
+        np.testing.assert_array_equal(cache.get("a"), self._vector(1))
+        self.assertIsNone(cache.get("b"))
+
+    def test_evicts_least_recently_used(self):
+        cache = self._cache(2)
+        cache.put("a", self._vector(1), url="https://x/a.jpg", validator='"1"')
+        cache.put("b", self._vector(2), url="https://x/b.jpg", validator='"2"')
+        cache.get("a")
+        cache.put("c", self._vector(3))
+
+        self.assertIsNone(cache.get("b"))
+        np.testing.assert_array_equal(cache.get("a"), self._vector(1))
+        np.testing.assert_array_equal(cache.get("c"), self._vector(3))
+        # The evicted entry's aliases go with it
+        self.assertEqual(cache.known_validators("https://x/b.jpg"), set())
+        self.assertEqual(cache.known_validators("https://x/a.jpg"), {'"1"'})
+
+    def test_alias_lookups(self):
+        cache = self._cache(4)
+        cache.put("a", self._vector(1), url="https://x/a.jpg", validator='"v1"')
+        cache.add_alias("https://x/copy.jpg", '"v9"', "a")
+
+        self.assertEqual(cache.alias_key("https://x/a.jpg", '"v1"'), "a")
+        self.assertIsNone(cache.alias_key("https://x/a.jpg", '"v2"'))
+        np.testing.assert_array_equal(cache.get_alias("https://x/copy.jpg", '"v9"'), self._vector(1))
+        self.assertIsNone(cache.get_alias("https://x/unknown.jpg", '"v1"'))
+
+    def test_capacity_shrink_drops_and_reuses_slots(self):
+        cache = self._cache(4)
+        for i, key in enumerate("abcd"):
+            cache.put(key, self._vector(i), url=f"https://x/{key}.jpg", validator='"1"')
+
+        cache = self._cache(2)
+        self.assertIsNone(cache.get("c"))
+        self.assertIsNone(cache.get("d"))
+        self.assertEqual(cache.known_validators("https://x/d.jpg"), set())
+        np.testing.assert_array_equal(cache.get("a"), self._vector(0))
+
+        # A new entry evicts within the smaller file instead of growing past it
+        cache.put("e", self._vector(5))
+        np.testing.assert_array_equal(cache.get("e"), self._vector(5))
+        self.assertEqual(sum(cache.get(key) is not None for key in "abe"), 2)
+
+    def test_entry_being_rewritten_is_not_returned(self):
+        cache = self._cache(4)
+        cache.put("a", self._vector(1))
+        with cache._db() as db:
+            db.execute("UPDATE slots SET ready = 0 WHERE key = 'a'")
+        self.assertIsNone(cache.get("a"))
+
+    def test_swatches_stored_with_vectors(self):
+        cache = self._cache(1, swatch_pixels=2)
+        swatch = np.array([[10, 20, 30], [40, 50, 60]], dtype=np.uint8)
+        cache.put("a", self._vector(1), swatch=swatch)
+        np.testing.assert_array_equal(cache.get_swatch("a"), swatch)
+
+        # Evicted by an entry without one: no stale swatch is left behind
+        cache.put("b", self._vector(2))
+        self.assertIsNone(cache.get_swatch("a"))
+        self.assertIsNone(cache.get_swatch("b"))
+
+    def test_hashes_stored_with_vectors(self):
+        cache = self._cache(2)
+        cache.put("a", self._vector(1), dhash=2 ** 64 - 2)
+        cache.put("b", self._vector(2), dhash=5)
+        cache.put("c", self._vector(3))
+        self.assertIsNone(cache.get_dhash("a"))  # evicted
+        self.assertEqual(cache.get_dhash("b"), 5)
+        self.assertIsNone(cache.get_dhash("c"))
+
+        cache.put("b", self._vector(2), dhash=2 ** 64 - 2)
+        self.assertEqual(cache.get_dhash("b"), 2 ** 64 - 2)
+
+
+class FreshnessLifetimeTests(unittest.TestCase):
+    def test_cache_control(self):
+        self.assertEqual(freshness_lifetime({"Cache-Control": "public, max-age=600"}), 600)
+        self.assertEqual(freshness_lifetime({"Cache-Control": "no-cache", "ETag": '"1"'}), 0)
+        self.assertIsNone(freshness_lifetime({"Cache-Control": "no-store, max-age=600"}))
+
+    def test_age_is_subtracted(self):
+        self.assertEqual(freshness_lifetime({"Cache-Control": "max-age=600", "Age": "100"}), 500)
+        self.assertEqual(freshness_lifetime({"Cache-Control": "max-age=60", "Age": "100"}), 0)
+
+    def test_expires(self):
+        now = 1_700_000_000
+        expires = email.utils.formatdate(now + 300, usegmt=True)
+        self.assertEqual(freshness_lifetime({"Expires": expires}, now=now), 300)
+        # max-age wins over Expires
+        self.assertEqual(freshness_lifetime({"Expires": expires, "Cache-Control": "max-age=5"}, now=now), 5)
+
+    def test_invalid_expires_means_expired(self):
+        self.assertEqual(freshness_lifetime({"Expires": "0"}), 0)
+        self.assertEqual(freshness_lifetime({"Expires": "not a date"}), 0)
+
+    def test_validator_only_responses_are_stored_but_stale(self):
+        self.assertEqual(freshness_lifetime({"ETag": '"1"'}), 0)
+        self.assertEqual(freshness_lifetime({"Last-Modified": "not a date"}), 0)
+        self.assertIsNone(freshness_lifetime({}))
+
+    def test_heuristic_lifetime_from_last_modified(self):
+        now = 1_700_000_000
+        modified = email.utils.formatdate(now - 5 * 3600, usegmt=True)
+        self.assertEqual(freshness_lifetime({"Last-Modified": modified}, now=now), 1800)
+        self.assertEqual(freshness_lifetime({"Last-Modified": modified, "Age": "600"}, now=now), 1200)
+        # Counted from the response's Date, not the time it is read
+        date = email.utils.formatdate(now - 3600, usegmt=True)
+        self.assertEqual(freshness_lifetime({"Last-Modified": modified, "Date": date}, now=now), 1440)
+        # Up to a day, however old the resource
+        self.assertEqual(freshness_lifetime({"Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT"}), 86400)
+
+
+class HttpCacheTests(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.cache = HttpCache(tmp.name, capacity_mb=1)
+
+    def test_put_and_get(self):
+        self.cache.put("https://x/a", b"body", {"Cache-Control": "max-age=60", "ETag": '"1"'})
+        cached = self.cache.get("https://x/a")
+        self.assertTrue(cached.fresh)
+        self.assertEqual(cached.conditional_headers(), {"If-None-Match": '"1"'})
+        self.assertEqual(bytes(cached.read()), b"body")
+
+    def test_uncacheable_responses_are_not_stored(self):
+        self.cache.put("https://x/a", b"body", {"Cache-Control": "no-store"})
+        self.cache.put("https://x/b", b"body", {})
+        self.assertIsNone(self.cache.get("https://x/a"))
+        self.assertIsNone(self.cache.get("https://x/b"))
+
+    def test_evicts_least_recently_used_past_capacity(self):
+        headers = {"Cache-Control": "max-age=60"}
+        body = b"x" * (400 * 1024)
+        with mock.patch("http_cache.time.time", side_effect=itertools.count(1)):
+            self.cache.put("https://x/a", body, headers)
+            self.cache.put("https://x/b", body, headers)
+            self.cache.get("https://x/a")
+            self.cache.put("https://x/c", body, headers)
+
+        self.assertIsNone(self.cache.get("https://x/b"))
+        self.assertIsNotNone(self.cache.get("https://x/a"))
+        self.assertIsNotNone(self.cache.get("https://x/c"))
+        self.assertEqual(len(os.listdir(os.path.join(self.cache.dir, "bodies"))), 2)
+
+    def test_refresh_renews_expiry(self):
+        self.cache.put("https://x/a", b"body", {"ETag": '"1"'})
+        self.assertFalse(self.cache.get("https://x/a").fresh)
+        self.cache.refresh("https://x/a", {"Cache-Control": "max-age=60", "ETag": '"2"'})
+        cached = self.cache.get("https://x/a")
+        self.assertTrue(cached.fresh)
+        self.assertEqual(cached.etag, '"2"')
+
+    def test_refresh_without_freshness_headers_keeps_stored_lifetime(self):
+        self.cache.put("https://x/a", b"body", {"Cache-Control": "max-age=60", "ETag": '"1"'})
+        with mock.patch("http_cache.time.time", return_value=time.time() + 120):
+            self.assertFalse(self.cache.get("https://x/a").fresh)
+            self.cache.refresh("https://x/a", {"ETag": '"1"'})
+            self.assertTrue(self.cache.get("https://x/a").fresh)
+            self.cache.refresh("https://x/a", {"ETag": '"1"', "Age": "60"})
+            self.assertFalse(self.cache.get("https://x/a").fresh)
+
+    def test_refresh_applies_heuristic_from_the_304_date(self):
+        now = time.time()
+        modified = email.utils.formatdate(now - 10 * 3600, usegmt=True)
+        self.cache.put("https://x/a", b"body", {"Last-Modified": modified, "Cache-Control": "no-cache"})
+        self.assertFalse(self.cache.get("https://x/a").fresh)
+        # The origin drops no-cache; the 304 has only its Date
+        self.cache.refresh("https://x/a", {"Cache-Control": "public", "Date": email.utils.formatdate(now, usegmt=True)})
+        cached = self.cache.get("https://x/a")
+        self.assertTrue(cached.fresh)
+        self.assertAlmostEqual(cached.expires - now, 3600, delta=5)
+
+
+class _Origin(BaseHTTPRequestHandler):
+    """Serves one body with an ETag and answers matching conditional GETs with 304."""
+
+    body = b"image bytes"
+    etag = '"v1"'
+    cache_control = "no-cache"
+    requests = []
+
+    def do_GET(self):
+        type(self).requests.append(self.headers.get("If-None-Match"))
+        if self.headers.get("If-None-Match") == self.etag:
+            self.send_response(304)
+            self.send_header("ETag", self.etag)
+            self.send_header("Cache-Control", self.cache_control)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", self.etag)
+        self.send_header("Cache-Control", self.cache_control)
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FetchTests(unittest.TestCase):
+    def setUp(self):
+        _Origin.requests = []
+        _Origin.cache_control = "no-cache"
+        server = ThreadingHTTPServer(("127.0.0.1", 0), _Origin)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.url = f"http://127.0.0.1:{server.server_port}/a.jpg"
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.cache = HttpCache(tmp.name)
+        for name, value in (("HTTP_CACHE_DIR", tmp.name), ("_http_cache", self.cache)):
+            patcher = mock.patch.object(fetch, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_fresh_response_is_served_without_a_request(self):
+        _Origin.cache_control = "max-age=60"
+        self.assertEqual(fetch.fetch(self.url), (b"image bytes", '"v1"'))
+        body, validator = fetch.fetch(self.url)
+        self.assertEqual((bytes(body), validator), (b"image bytes", '"v1"'))
+        self.assertEqual(_Origin.requests, [None])
+
+    def test_stale_response_is_revalidated(self):
+        fetch.fetch(self.url)
+        body, validator = fetch.fetch(self.url)
+        self.assertEqual((bytes(body), validator), (b"image bytes", '"v1"'))
+        self.assertEqual(_Origin.requests, [None, '"v1"'])
+
+    def test_revalidated_body_evicted_meanwhile_is_downloaded_again(self):
+        fetch.fetch(self.url)
+        real_get = self.cache.get
+
+        def get_then_evict(url):
+            cached = real_get(url)
+            os.unlink(cached.path)  # another process evicts it before the 304 arrives
+            return cached
+
+        with mock.patch.object(self.cache, "get", get_then_evict):
+            body, validator = fetch.fetch(self.url)
+        self.assertEqual((bytes(body), validator), (b"image bytes", '"v1"'))
+        self.assertEqual(_Origin.requests, [None, '"v1"', None])
+
+
+class LocalMediaTests(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = os.path.join(os.path.realpath(tmp.name), "media")
+        os.makedirs(os.path.join(self.root, "sub"))
+        for name in ("a.jpg", "with space.jpg", "sub/b.jpg"):
+            with open(os.path.join(self.root, name), "wb") as f:
+                f.write(b"local bytes")
+        self.secret = os.path.join(os.path.dirname(self.root), "secret.txt")
+        with open(self.secret, "wb") as f:
+            f.write(b"secret")
+        os.symlink(self.secret, os.path.join(self.root, "escape.jpg"))
+        os.symlink("a.jpg", os.path.join(self.root, "inside.jpg"))
+
+        self.backend = "http://backend:8000"
+        self._patch("LOCAL_MEDIA_ROOT", self.root)
+        self._patch("BACKEND_URL", self.backend)
+
+    def _patch(self, name, value):
+        patcher = mock.patch.object(fetch, name, value)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_media_urls_map_onto_the_mount(self):
+        a = os.path.join(self.root, "a.jpg")
+        self.assertEqual(fetch.local_path(f"{self.backend}/media/a.jpg"), a)
+        self.assertEqual(fetch.local_path("http://localhost:8000/media/a.jpg"), a)
+        self.assertEqual(fetch.local_path(f"{self.backend}/media/inside.jpg"), a)
+        self.assertEqual(
+            fetch.local_path(f"{self.backend}/media/with%20space.jpg"),
+            os.path.join(self.root, "with space.jpg"),
+        )
+        self.assertEqual(
+            fetch.local_path(f"{self.backend}/media/sub/b.jpg"), os.path.join(self.root, "sub", "b.jpg")
+        )
+
+    def test_paths_escaping_the_root_are_refused(self):
+        for path in (
+            "/media/../secret.txt",
+            "/media/sub/../../secret.txt",
+            "/media/%2e%2e/secret.txt",
+            "/media/%2E%2E%2Fsecret.txt",
+            "/media/sub%2F..%2F..%2Fsecret.txt",
+            f"/media/{self.secret}",
+            f"/media/{self.secret.replace('/', '%2F')}",
+            "/media/escape.jpg",
+        ):
+            with self.subTest(path=path):
+                self.assertIsNone(fetch.local_path(f"{self.backend}{path}"))
+
+    def test_other_urls_are_not_local(self):
+        for url in (
+            "http://cdn.example.com/media/a.jpg",
+            "https://backend:8000/media/a.jpg",
+            "http://backend:8001/media/a.jpg",
+            f"{self.backend}/static/a.jpg",
+            f"{self.backend}/mediafiles/a.jpg",
+            f"{self.backend}/media/missing.jpg",
+            f"{self.backend}/media/sub",
+        ):
+            with self.subTest(url=url):
+                self.assertIsNone(fetch.local_path(url))
+
+        self._patch("LOCAL_MEDIA_ROOT", "")
+        self.assertIsNone(fetch.local_path(f"{self.backend}/media/a.jpg"))
+
+    def test_fetch_reads_media_from_disk_and_the_rest_over_http(self):
+        _Origin.requests = []
+        server = ThreadingHTTPServer(("127.0.0.1", 0), _Origin)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        origin = f"http://127.0.0.1:{server.server_port}"
+        self._patch("BACKEND_URL", origin)
+        self._patch("HTTP_CACHE_DIR", "")
+
+        body, _ = fetch.fetch(f"{origin}/media/a.jpg")
+        self.assertEqual(bytes(body), b"local bytes")
+        self.assertEqual(_Origin.requests, [])
+
+        for path in ("/api/images/1/", "/media/%2e%2e/secret.txt", "/media/missing.jpg"):
+            with self.subTest(path=path):
+                body, _ = fetch.fetch(f"{origin}{path}")
+                self.assertEqual(bytes(body), b"image bytes")
+        self.assertEqual(len(_Origin.requests), 3)
+
+
+class ChooseKTests(unittest.TestCase):
+    def test_separated_groups(self):
+        rng = np.random.default_rng(0)
+        X = np.vstack([rng.normal(loc, 0.01, size=(20, 8)) for loc in np.eye(8)[:3]])
+        k, silhouette = tasks._choose_k(X)
+        self.assertEqual(k, 3)
+        self.assertGreater(silhouette, 0.5)
+
+    def test_identical_embeddings_have_no_score(self):
+        X = np.ones((30, 8), dtype=np.float32)
+        self.assertEqual(tasks._choose_k(X), (1, None))
+
+        labels, centers, info = tasks._cluster_embeddings(X, "auto")
+        self.assertEqual(info["k"], 1)
+        self.assertNotIn("silhouette", info)
+        self.assertEqual(set(labels), {0})
+
+
+class ClusterResultTests(unittest.TestCase):
+    def setUp(self):
+        state_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(state_dir.cleanup)
+        for patcher in (
+            mock.patch.object(job_state, "JOB_STATE_DIR", state_dir.name),
+            mock.patch.object(tasks, "_tag_cluster", return_value=["calm"]),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _cluster(self, X, n_clusters=4):
+        self.urls = [f"https://example.com/{i}.jpg" for i in range(len(X))]
+        return tasks._cluster_and_tag(
+            "job-1", self.urls, X, n_clusters, tasks.TAG_SAMPLE_SIZE, {},
+            tasks._Progress(None, len(X)), tasks.StageTimer(),
+        )
+
+    def test_result_refers_to_the_stored_embeddings(self):
+        rng = np.random.default_rng(0)
+        X = rng.normal(size=(40, 16)).astype(np.float32)
+        result = self._cluster(X)
+
+        urls, stored, _, _, _ = job_state.load_job_state("job-1")
+        stored_row = {url: row for row, url in enumerate(urls)}
+        input_row = {url: row for row, url in enumerate(self.urls)}
+        for cluster_id in range(4):
+            cluster = result[cluster_id]
+            rows = [row for start, stop in cluster["embeddings"]["rows"] for row in range(start, stop)]
+            self.assertEqual(cluster["embeddings"]["job_id"], "job-1")
+            self.assertEqual(rows, [stored_row[url] for url in cluster["images"]])
+            np.testing.assert_array_equal(stored[rows], X[[input_row[url] for url in cluster["images"]]])
+
+    def test_result_size_does_not_grow_with_the_embeddings(self):
+        rng = np.random.default_rng(0)
+        X = rng.normal(size=(5000, 512)).astype(np.float32)
+        result = self._cluster(X)
+
+        refs = json.dumps([result[cluster_id]["embeddings"] for cluster_id in range(4)])
+        # One row range per cluster, where the matrix would take ~10 MB
+        self.assertLess(len(refs), 500)
+        self.assertLess(len(json.dumps(result, default=str)), 200 * len(X))
+
+
+class ChunkProgressTests(unittest.TestCase):
+    def _patch_backend(self, backend):
+        for patcher in (
+            mock.patch.object(tasks, "RedisBackend", mock.Mock),
+            mock.patch.object(type(tasks.app), "backend", new_callable=mock.PropertyMock, return_value=backend),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_unreachable_redis_falls_back_to_the_chunks_own_counts(self):
+        backend = mock.Mock()
+        backend.client.pipeline.return_value.execute.side_effect = ConnectionError("refused")
+        backend.client.hgetall.side_effect = ConnectionError("refused")
+        self._patch_backend(backend)
+
+        progress = tasks._ChunkProgress("job-1", 10)
+        progress.add(downloaded=3, embedded=2)
+        snapshot = progress.snapshot()
+        self.assertEqual((snapshot["downloaded"], snapshot["embedded"]), (3, 2))
+        backend.store_result.assert_called()
+
+    def test_redis_failing_mid_job_stops_sharing(self):
+        backend = mock.Mock()
+        pipe = backend.client.pipeline.return_value
+        pipe.execute.side_effect = [[1, b"100.0", True], ConnectionError("reset")]
+        self._patch_backend(backend)
+
+        progress = tasks._ChunkProgress("job-1", 10)
+        progress.add(embedded=4)
+        self.assertEqual(progress.current_counts()["embedded"], 4)
+        backend.client.hgetall.assert_not_called()
+
+
+class PipelineTests(unittest.TestCase):
+    """Embedding and clustering tasks, with images read from a media mount and a stand-in model."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.media = os.path.join(tmp.name, "media")
+        os.makedirs(self.media)
+        rng = np.random.default_rng(0)
+        original = _gradient()
+        images = {
+            "a": original,
+            "a-copy": Image.fromarray(np.clip(np.asarray(original, dtype=np.int16) + 3, 0, 255).astype(np.uint8)),
+        }
+        for i in range(4):
+            images[f"noise-{i}"] = Image.fromarray(rng.integers(0, 256, (64, 64, 3), dtype=np.uint8))
+        for name, img in images.items():
+            img.save(os.path.join(self.media, f"{name}.png"))
+
+        # Random embeddings, so only the hash stage can find the copies
+        def embed(images, timer=None):
+            return rng.normal(size=(len(images), 8)).astype(np.float32)
+
+        cache = EmbeddingCache(os.path.join(tmp.name, "embeddings"), "test", 8, swatch_pixels=100)
+        for patcher in (
+            mock.patch.object(fetch, "LOCAL_MEDIA_ROOT", self.media),
+            mock.patch.object(fetch, "BACKEND_URL", "http://backend:8000"),
+            mock.patch.object(job_state, "JOB_STATE_DIR", os.path.join(tmp.name, "jobs")),
+            mock.patch.object(tasks, "embedding_cache", cache),
+            mock.patch.object(tasks, "_embed_images", embed),
+            mock.patch.object(tasks, "_embedding_dim", return_value=8),
+            mock.patch.object(tasks, "load_model"),
+            mock.patch.object(tasks, "_tag_cluster", return_value=[]),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _urls(self, *names):
+        return [f"http://backend:8000/media/{name}.png" for name in names]
+
+    def test_cached_images_are_checked_for_duplicates(self):
+        urls = self._urls("noise-0", "a", "noise-1", "a-copy")
+        found = []
+        for _ in range(2):
+            duplicates = tasks.Duplicates()
+            valid_urls, _, stats = tasks._get_image_embeddings(urls, batch_size=2, duplicates=duplicates)
+            found.append((valid_urls, duplicates.of, stats))
+
+        (cold_urls, cold, cold_stats), (warm_urls, warm, warm_stats) = found
+        self.assertEqual(cold, {urls[3]: urls[1]})
+        self.assertEqual(warm, cold)
+        self.assertEqual(warm_urls, cold_urls)
+        self.assertEqual((cold_stats["hits"], warm_stats["hits"]), (0, 3))
+
+    def test_copies_in_different_chunks_are_merged(self):
+        chunks = [
+            tasks.embed_chunk.run(self._urls("a", "noise-0", "noise-1")),
+            tasks.embed_chunk.run(self._urls("noise-2", "a-copy", "noise-3")),
+        ]
+        self.assertEqual([chunk["rows"] for chunk in chunks], [3, 3])
+        result = tasks.reduce_embeddings.run(chunks, n_clusters=2)
+
+        a, a_copy = self._urls("a", "a-copy")
+        clusters = [result[i]["images"] for i in range(2)]
+        self.assertEqual(sum(len(images) for images in clusters), 6)
+        self.assertTrue(any(a in images and a_copy in images for images in clusters))
+        self.assertEqual(result["meta"]["dedup"]["hash"], 1)
+
+    def test_image_that_fails_to_embed_is_skipped(self):
+        urls = self._urls("noise-0", "a", "noise-1", "a-copy", "noise-2")
+        bad = np.asarray(Image.open(os.path.join(self.media, "a.png")).convert("RGB"))
+        embed = tasks._embed_images
+
+        def embed_or_fail(images, timer=None):
+            if any(np.array_equal(np.asarray(img), bad) for img in images):
+                raise RuntimeError("bad image")
+            return embed(images, timer)
+
+        duplicates, swatches = tasks.Duplicates(), {}
+        with mock.patch.object(tasks, "_embed_images", embed_or_fail):
+            valid_urls, X, _ = tasks._get_image_embeddings(
+                urls, batch_size=3, duplicates=duplicates, swatches=swatches
+            )
+
+        kept = [urls[0], urls[2], urls[4]]
+        self.assertEqual(valid_urls, kept)
+        self.assertEqual(X.shape, (3, 8))
+        self.assertTrue(np.all(np.linalg.norm(X, axis=1) > 0))
+        self.assertEqual(duplicates.of, {})
+        self.assertEqual(sorted(swatches), sorted(kept))
+        # The rest were cached; the bad image is tried again next time
+        _, _, stats = tasks._get_image_embeddings(urls, batch_size=3, duplicates=tasks.Duplicates())
+        self.assertEqual((stats["hits"], stats["misses"]), (3, 1))
+
+    def _chunk_dirs(self):
+        return os.listdir(os.path.join(job_state.JOB_STATE_DIR, "chunks"))
+
+    def test_chunks_are_kept_until_the_job_is_clustered(self):
+        chunks = [
+            tasks.embed_chunk.run(self._urls("a", "noise-0")),
+            tasks.embed_chunk.run(self._urls("noise-1")),
+        ]
+        with mock.patch.object(tasks, "_cluster_embeddings", side_effect=RuntimeError("boom")):
+            with self.assertRaises(RuntimeError):
+                tasks.reduce_embeddings.run(chunks, n_clusters=2)
+        self.assertEqual(len(self._chunk_dirs()), 2)
+
+        tasks.reduce_embeddings.run(chunks, n_clusters=2)
+        self.assertEqual(self._chunk_dirs(), [])
+
+    def test_fan_out_needs_a_shared_job_state_dir(self):
+        urls = self._urls("a", "noise-0", "noise-1", "noise-2")
+        with mock.patch.object(tasks.cluster_images, "replace") as replace:
+            with mock.patch.object(tasks, "JOB_STATE_SHARED", False):
+                result = tasks.cluster_images.run(urls, 2, chunk_size=2)
+            replace.assert_not_called()
+            self.assertEqual(sum(len(result[i]["images"]) for i in range(2)), 4)
+
+            with mock.patch.object(tasks, "JOB_STATE_SHARED", True), mock.patch.object(tasks, "_ChunkProgress"):
+                tasks.cluster_images.run(urls, 2, chunk_size=2)
+            replace.assert_called_once()
+
+
+class BatcherTests(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+
+    def _embed(self, images):
+        self.calls.append(list(images))
+        return np.array([[img] for img in images], dtype=np.float32)
+
+    def test_requests_arriving_together_share_a_batch(self):
+        batcher = inference_server.Batcher(self._embed, max_batch=64, max_wait=0.5)
+        futures = [batcher.submit([i, i + 10]) for i in range(3)]
+
+        results = [future.result(timeout=5) for future in futures]
+        self.assertEqual(self.calls, [[0, 10, 1, 11, 2, 12]])
+        for i, result in enumerate(results):
+            np.testing.assert_array_equal(result, [[i], [i + 10]])
+        self.assertEqual((batcher.batches, batcher.images), (1, 6))
+
+    def test_batches_are_capped_at_max_batch(self):
+        batcher = inference_server.Batcher(self._embed, max_batch=2, max_wait=0.5)
+        first, second = batcher.submit([1, 2, 3]), batcher.submit([4, 5])
+
+        np.testing.assert_array_equal(first.result(timeout=5), [[1], [2], [3]])
+        np.testing.assert_array_equal(second.result(timeout=5), [[4], [5]])
+        self.assertTrue(all(len(call) <= 2 for call in self.calls))
+        self.assertEqual(sum(self.calls, []), [1, 2, 3, 4, 5])
+
+    def test_a_failed_batch_fails_every_request_in_it(self):
+        def embed(images):
+            if 0 in images:
+                raise ValueError("bad image")
+            return self._embed(images)
+
+        batcher = inference_server.Batcher(embed, max_wait=0.5)
+        futures = [batcher.submit([i]) for i in range(3)]
+        for future in futures:
+            with self.assertRaisesRegex(ValueError, "bad image"):
+                future.result(timeout=5)
+
+        # The batching thread carries on
+        np.testing.assert_array_equal(batcher.submit([7]).result(timeout=5), [[7]])
+
+
+def _sum_pixels(images):
+    return np.array([[img.sum()] for img in images], dtype=np.float32)
+
+
+class InferenceServerTests(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.address = os.path.join(tmp.name, "inference.sock")
+        info = {"model_id": "test", "dim": 1, "label_embeddings": None}
+        # In its own process, which is killed afterwards like a real server
+        server = multiprocessing.get_context("fork").Process(
+            target=inference_server.serve, args=(self.address, _sum_pixels, info), daemon=True
+        )
+        server.start()
+        self.addCleanup(server.join)
+        self.addCleanup(server.terminate)
+
+    def test_clients_with_the_key_are_served(self):
+        client = inference_server.InferenceClient(self.address, connect_timeout=5)
+        self.assertEqual(client.info()["model_id"], "test")
+        np.testing.assert_array_equal(client.embed([np.ones((2, 2))]), [[4.0]])
+
+        self.assertEqual(os.stat(self.address).st_mode & 0o777, 0o660)
+        self.assertEqual(os.stat(f"{self.address}.key").st_mode & 0o777, 0o640)
+
+    def test_clients_without_the_key_are_rejected(self):
+        inference_server.InferenceClient(self.address, connect_timeout=5).info()  # server is up
+        with self.assertRaises(AuthenticationError):
+            Client(self.address, family="AF_UNIX", authkey=b"guess")
+
+        # and the server keeps serving the others
+        client = inference_server.InferenceClient(self.address, connect_timeout=5)
+        self.assertEqual(client.stats(), {"batches": 0, "images": 0})
+
+    def test_client_gives_up_on_a_server_that_does_not_reply(self):
+        client = inference_server.InferenceClient(self.address, timeout=0.1)
+        client._conn, server_end = Pipe()  # a server that never answers
+        client._pid = os.getpid()
+        with self.assertRaises(TimeoutError):
+            client.stats()
+        self.assertIsNone(client._conn)
+        server_end.close()
+
+
+if __name__ == "__main__":
+    unittest.main()